@@ -1,24 +1,126 @@
-from flask import Flask, request, jsonify
+import time
+_import_started = time.perf_counter()
+
+from flask import Flask, Blueprint, Response, request, jsonify, make_response, send_from_directory, current_app, g
 from flask_cors import CORS
+from werkzeug.middleware.proxy_fix import ProxyFix
 import os
+import random
+from functools import wraps
 from face_auth import register_user, login_user  # Import from the module
-import cv2
-import time
-from face_auth.utils import upload_to_cloudinary,users_collection
-import face_recognition
-from dotenv import load_dotenv
+from face_auth.utils import upload_to_cloudinary, delete_cloudinary_image, users_collection
+from face_auth.preprocess import decode_upload, stage_timer
+from face_auth.encodings import image_update
+from face_auth.workers import (encode_image, warm_up_models, FacePoolError, request_deadline,
+                               FACE_POOL_WORKERS, FACE_POOL_START_METHOD)
+from face_auth.admission import (admission, user_limiter, ip_limiter, admission_stats, request_deadline_from,
+                                 ADMISSION_QUEUE_TIMEOUT, ADMISSION_RETRY_AFTER, TRUSTED_PROXY_HOPS)
+from face_auth.cache import encoding_cache
+from face_auth.capture import capture_face
+from face_auth.gallery import gallery, ensure_gallery_loaded, IDENTIFY_THRESHOLD
+from face_auth.shared_store import encoding_store, publish_encoding, unpublish_encoding
+from face_auth.db import pool_stats
+from face_auth.users import ensure_indexes, find_user
+from face_auth.http_session import http_stats
+from face_auth.resilience import breaker_stats, CircuitOpenError, DeadlineExceeded
+from face_auth.singleflight import single_flight, request_fingerprint
+from face_auth import profiler
+from face_auth.metrics import REQUEST_SECONDS, metrics_payload, observe_timings, record_outcome
 
-app = Flask(__name__)
-CORS(app)
-load_dotenv()
+CLOUDINARY_FOLDER = os.getenv("CLOUDINARY_FOLDER", "face_recognition")
+# Warm the dlib models while creating the app, when whoever encodes can share them:
+# with gunicorn preload_app the master does this once and workers (FACE_POOL_WORKERS=0)
+# or forked pool processes (FACE_POOL_START_METHOD=fork) get the models copy-on-write.
+# Spawned pools are started and warmed per worker by gunicorn.conf.py instead.
+FACE_PRELOAD = os.getenv("FACE_PRELOAD", "false").lower() in ("1", "true", "yes")
 
-UPLOAD_FOLDER = "uploads"
-os.makedirs(UPLOAD_FOLDER, exist_ok=True)
-app.config["UPLOAD_FOLDER"] = UPLOAD_FOLDER
+bp = Blueprint("face_auth", __name__)
 
-CLOUDINARY_FOLDER = os.getenv("CLOUDINARY_FOLDER", "face_recognition")
 
-@app.route('/register', methods=['POST'])
+def bounded_int(value, default, maximum):
+    """Parse an optional request parameter as a positive int capped at maximum; None if it is not one."""
+    if value is None or value == "":
+        return default
+    try:
+        number = int(value)
+    except ValueError:
+        return None
+    return min(number, maximum) if number >= 1 else None
+
+
+def admission_controlled(endpoint):
+    """Rate-limit, queue or shed a CPU-heavy endpoint before any face work starts.
+
+    Over-quota users or IPs get 429, a saturated worker 503, both with
+    Retry-After. Admitted requests run with their deadline set, so face pool
+    work is dropped once the client has stopped waiting for it.
+    """
+    def decorator(view):
+        @wraps(view)
+        def wrapper(*args, **kwargs):
+            deadline = request_deadline_from(request.headers)
+            for limiter, key in ((ip_limiter, request.remote_addr), (user_limiter, request.form.get("email"))):
+                allowed, retry_after = limiter.allow(key)
+                if not allowed:
+                    record_outcome(endpoint, "rate_limited")
+                    response = jsonify({"error": "Too many requests. Try again later.", "Status": "False"})
+                    return response, 429, {"Retry-After": str(retry_after)}
+
+            if not admission.acquire(timeout=min(ADMISSION_QUEUE_TIMEOUT, deadline - time.time())):
+                record_outcome(endpoint, "shed")
+                response = jsonify({"error": "Server is busy. Try again shortly.", "Status": "False"})
+                return response, 503, {"Retry-After": str(ADMISSION_RETRY_AFTER)}
+            token = request_deadline.set(deadline)
+            try:
+                response = make_response(view(*args, **kwargs))
+            finally:
+                request_deadline.reset(token)
+                admission.release()
+            if response.status_code == 503:
+                response.headers.setdefault("Retry-After", str(ADMISSION_RETRY_AFTER))
+            return response
+        return wrapper
+    return decorator
+
+
+def single_flight_per_user(endpoint):
+    """Answer concurrent identical requests for a user (same form and image) with one execution.
+
+    Runs outside admission control, so a double-submitted request takes one
+    slot and one rate-limit token, and different requests for the same user
+    are handled one at a time.
+    """
+    def decorator(view):
+        @wraps(view)
+        def wrapper(*args, **kwargs):
+            email = request.form.get("email")
+            if not email:
+                return view(*args, **kwargs)
+            image_file = request.files.get("image")
+            data = b""
+            if image_file is not None:
+                data = image_file.read()
+                image_file.seek(0)  # The view reads the upload again
+            fingerprint = request_fingerprint(data, sorted(request.form.items()))
+
+            def run():
+                response = make_response(view(*args, **kwargs))
+                # Each waiting request builds its own Response from these
+                return response.get_data(), response.status_code, dict(response.headers)
+
+            timeout = request_deadline_from(request.headers) - time.time()
+            try:
+                body, status, headers = single_flight.do(email, endpoint, fingerprint, run, timeout)
+            except DeadlineExceeded as e:
+                return jsonify({"error": str(e), "Status": "False"}), 503, {"Retry-After": str(ADMISSION_RETRY_AFTER)}
+            return Response(body, status=status, headers=headers)
+        return wrapper
+    return decorator
+
+
+@bp.route('/register', methods=['POST'])
+@single_flight_per_user("register")
+@admission_controlled("register")
 def register():
     try:
         name = request.form.get("name")
@@ -29,20 +131,22 @@ def register():
         if not name or not email or not mobile or not image_file:
             return jsonify({"error": "Name, Email, Mobile, and Image are required"}), 400
 
-        # image_path = None  # Default value for webcam case
-        # if image_file:
-        image_path = os.path.join(app.config["UPLOAD_FOLDER"], image_file.filename)
-        image_file.save(image_path)
+        # Decode the upload once, in memory
+        timings = {}
+        image = decode_upload(image_file.read(), timings=timings)
+        if image is None:
+            return jsonify({"error": "Invalid image file"}), 400
 
-        # Pass image_path (even if None)
-        response = register_user(name, email, mobile, image_path)
+        response = register_user(name, email, mobile, image, timings=timings)
 
-        return jsonify(response), 201 if "message" in response else 400
+        return jsonify(response), 201 if "message" in response else response.get("code", 400)
 
     except Exception as e:
         return jsonify({"error": str(e)}), 500
 
-@app.route('/login', methods=['POST'])
+@bp.route('/login', methods=['POST'])
+@single_flight_per_user("login")
+@admission_controlled("login")
 def login():
     try:
         email = request.form.get("email")
@@ -51,8 +155,8 @@ def login():
         if not email or not image_file:
             return jsonify({"error": "Email and image are required"}), 400
 
-        # Check for stored Cloudinary image URL
-        user = users_collection.find_one({"email": email})
+        # Check for stored Cloudinary image URL (the only user lookup of this request)
+        user = find_user(email)
         if user is None:
             return jsonify({"error": "User not found"}), 404
 
@@ -65,106 +169,249 @@ def login():
                 "capture_api": "/capture_upload_image"
             }), 400
 
-        # If image file is uploaded, process it
-        image_path = None
-        if image_file:
-            image_path = os.path.join(app.config["UPLOAD_FOLDER"], f"{email}_login.jpg")
-            image_file.save(image_path)
+        # Decode the upload once, in memory (at reduced size for large phone photos)
+        timings = {}
+        image = decode_upload(image_file.read(), timings=timings)
+        if image is None:
+            return jsonify({"error": "Invalid image file"}), 400
 
-        response = login_user(email, image_path)
+        response = login_user(email, image, timings=timings, user=user)
 
-        status_code = 200 if "message" in response else 401
+        # An explicit code wins: some failures also carry a "message"
+        status_code = response.get("code", 200 if "message" in response else 401)
         return jsonify(response), status_code
 
+    except (CircuitOpenError, DeadlineExceeded) as e:
+        return jsonify({"error": str(e)}), 503
+    except Exception as e:
+        return jsonify({"error": str(e)}), 500
+
+
+# 🔎 1:N identification: find the users whose stored face matches the image
+@bp.route('/identify', methods=['POST'])
+@admission_controlled("identify")
+def identify():
+    try:
+        image_file = request.files.get("image")
+        if not image_file:
+            return jsonify({"error": "Image is required"}), 400
+
+        limit = bounded_int(request.form.get("limit"), default=5, maximum=50)
+        if limit is None:
+            return jsonify({"error": "limit must be a positive whole number"}), 400
+
+        image = decode_upload(image_file.read())
+        if image is None:
+            return jsonify({"error": "Invalid image file"}), 400
+
+        result = encode_image(image)
+        observe_timings(result.timings)
+        encoding = result.encoding
+
+        if encoding is None:
+            record_outcome("identify", "no_face")
+            return jsonify({"error": "No face detected", "Status": "False"}), 400
+
+        # The shared store, when configured and built, spares each worker its own gallery copy
+        if encoding_store is not None and encoding_store.ensure_ready(users_collection):
+            index = encoding_store
+        else:
+            index = ensure_gallery_loaded(users_collection)
+        matches = index.search(encoding, k=limit, threshold=IDENTIFY_THRESHOLD)
+        if not matches:
+            record_outcome("identify", "no_match")
+            return jsonify({"error": "No matching user found", "Status": "False"}), 404
+
+        record_outcome("identify", "success")
+
+        return jsonify({
+            "message": "Identification successful",
+            "Status": "True",
+            "data": [{"email": email, "distance": distance} for email, distance in matches]
+        })
+
+    except (FacePoolError, CircuitOpenError, DeadlineExceeded) as e:
+        return jsonify({"error": str(e)}), 503
     except Exception as e:
         return jsonify({"error": str(e)}), 500
 
 
 # 🚀 New API: Handle webcam capture or manual upload
-@app.route('/capture_upload_image', methods=['POST'])
+@bp.route('/capture_upload_image', methods=['POST'])
+@single_flight_per_user("capture")
+@admission_controlled("capture")
 def capture_upload_image():
     try:
         email = request.form.get("email")
         print(email)
         if not email:
             return jsonify({"error": "Email is required"}), 400
+        # Nothing is uploaded or indexed for an email that is not registered
+        if find_user(email, {"_id": 1}) is None:
+            return jsonify({"error": "User not found"}), 404
 
+        capture_stats = None
         # Check if user uploaded an image (for mobile users)
         if "image" in request.files:
-            file = request.files["image"]
-            filename = os.path.join(app.config["UPLOAD_FOLDER"], f"{email}_upload.jpg")
-            file.save(filename)
-            cloudinary_url = upload_to_cloudinary(filename, folder=CLOUDINARY_FOLDER)
-            os.remove(filename)
+            data = request.files["image"].read()
+            image = decode_upload(data)
+            if image is None:
+                return jsonify({"error": "Invalid image file"}), 400
+            encoding = encode_image(image).encoding
+            # Upload the original bytes as-is, no temp file or re-encode
+            cloudinary_url = upload_to_cloudinary(data, folder=CLOUDINARY_FOLDER)
         else:
-            # **Webcam Capture Logic**
-            cap = cv2.VideoCapture(0)
-            if not cap.isOpened():
-                return {"error": "Webcam not detected. Please upload an image manually."}
-            face_detected_time = None
-
-            while True:
-                ret, frame = cap.read()
-                if not ret:
-                    return {"error": "Failed to capture image"}
-
-                # Convert frame to RGB
-                rgb_frame = cv2.cvtColor(frame, cv2.COLOR_BGR2RGB)
-
-                # Detect Face
-                face_locations = face_recognition.face_locations(rgb_frame)
-
-                if len(face_locations) == 0:
-                    face_detected_time = None  # Reset if face not found
-                    cv2.putText(frame, "No face detected!", (50, 50),
-                                cv2.FONT_HERSHEY_SIMPLEX, 1, (0, 0, 255), 2)
-                else:
-                    for (top, right, bottom, left) in face_locations:
-                        padding = 30
-                        cv2.rectangle(frame,
-                                      (left - padding, top - padding),
-                                      (right + padding, bottom + padding),
-                                      (0, 255, 0), 2)
-                    if face_detected_time is None:
-                        face_detected_time = time.time()
-
-                    # Calculate how long face has been detected
-                    elapsed = time.time() - face_detected_time
-                    remaining = 3 - int(elapsed)
-
-                    if elapsed >= 3:
-                        break  # Capture image
-
-                    # Show countdown on frame
-                    cv2.putText(frame, f"Hold still... {remaining}", (50, 450),
-                                cv2.FONT_HERSHEY_SIMPLEX, 1.5, (255, 255, 0), 3)
-
-                cv2.imshow("Face Capture - Hold still for 3 seconds", frame)
-                if cv2.waitKey(1) & 0xFF == ord('q'):
-                    cap.release()
-                    cv2.destroyAllWindows()
-                    return {"error": "Face Capture cancelled by user"}
-
-            cap.release()
-            cv2.destroyAllWindows()
-
-            # Save & Upload Image to Cloudinary
-            filename = os.path.join(app.config["UPLOAD_FOLDER"], f"{email}_capture.jpg")
-            cv2.imwrite(filename, frame)
-            cloudinary_url = upload_to_cloudinary(filename, folder=CLOUDINARY_FOLDER)
-            os.remove(filename)
+            # **Webcam Capture Logic** (detect every Nth frame, track in between, keep the sharpest frame)
+            capture = capture_face()
+            if capture.error:
+                return {"error": capture.error, "capture_stats": capture.stats}
+            frame, capture_stats = capture.frame, capture.stats
+
+            # Upload the captured frame to Cloudinary straight from memory
+            encoding = encode_image(frame).encoding
+            cloudinary_url = upload_to_cloudinary(frame, folder=CLOUDINARY_FOLDER)
 
         if not cloudinary_url:
+            record_outcome("capture", "upstream_error")
             return jsonify({"error": "Image upload failed"}), 500
 
-        # Update user profile with new image URL
-        users_collection.update_one({"email": email}, {"$set": {"image_url": cloudinary_url}})
+        # Update user profile with new image URL (and its encoding, if a face was found)
+        result = users_collection.update_one({"email": email}, image_update(cloudinary_url, encoding))
+        if not result.matched_count:
+            # The user was deleted while the image was being processed
+            delete_cloudinary_image(cloudinary_url)
+            record_outcome("capture", "user_not_found")
+            return jsonify({"error": "User not found"}), 404
+        record_outcome("capture", "success" if encoding is not None else "no_face")
+        encoding_cache.invalidate(email)
+        if encoding is not None:
+            gallery.add(email, encoding)
+            publish_encoding(email, encoding, cloudinary_url)
+        else:
+            gallery.remove(email)
+            unpublish_encoding(email)
 
-        return jsonify({ "success": True,"message": "Image captured & uploaded successfully", "image_url": cloudinary_url})
+        response = { "success": True,"message": "Image captured & uploaded successfully", "image_url": cloudinary_url}
+        if capture_stats is not None:
+            response["capture_stats"] = capture_stats
+        return jsonify(response)
 
+    except (FacePoolError, CircuitOpenError, DeadlineExceeded) as e:
+        return jsonify({"error": str(e)}), 503
     except Exception as e:
         return jsonify({"error": str(e)}), 500
 
+@bp.route('/cache_stats', methods=['GET'])
+def cache_stats():
+    return jsonify({"encoding_cache": encoding_cache.stats(), "gallery": gallery.stats(),
+                    "shared_store": encoding_store.stats() if encoding_store is not None else None})
+
+@bp.route('/pool_stats', methods=['GET'])
+def connection_pool_stats():
+    return jsonify({"mongo": pool_stats.snapshot(), "http": http_stats(), "breakers": breaker_stats(),
+                    "single_flight": single_flight.stats(), **admission_stats()})
+
+@bp.route('/metrics', methods=['GET'])
+def metrics():
+    body, content_type = metrics_payload()
+    return Response(body, content_type=content_type)
+
+@bp.before_app_request
+def start_request_timer():
+    g.request_started = time.perf_counter()
+    if profiler.should_profile(request.headers, random.random()):
+        g.profile_thread = profiler.sampler.start()
+
+@bp.after_app_request
+def observe_request_latency(response):
+    started = g.pop("request_started", None)
+    if started is not None and request.url_rule is not None and request.url_rule.rule != "/metrics":
+        REQUEST_SECONDS.labels(request.url_rule.rule, str(response.status_code)).observe(
+            time.perf_counter() - started)
+    thread_id = g.pop("profile_thread", None)
+    if thread_id is not None:
+        stacks = profiler.sampler.stop(thread_id)
+        label = f"{request.endpoint.rsplit('.', 1)[-1] if request.endpoint else 'unknown'}-{response.status_code}"
+        name = profiler.write_profile(stacks, label, (time.perf_counter() - started) * 1000)
+        if name:
+            response.headers["X-Profile"] = name
+    return response
+
+@bp.teardown_app_request
+def stop_profiling(error=None):
+    # A request that failed before after_request still has to leave the sampler
+    thread_id = g.pop("profile_thread", None)
+    if thread_id is not None:
+        profiler.sampler.stop(thread_id)
+
+
+def _profile_admin_denied():
+    if not profiler.PROFILE_TOKEN:
+        return jsonify({"error": "Profiling admin is disabled (set PROFILE_TOKEN)"}), 404
+    if not profiler.token_matches(request.headers):
+        return jsonify({"error": "Forbidden"}), 403
+    return None
+
+@bp.route('/admin/profiles', methods=['GET'])
+def list_profiles():
+    denied = _profile_admin_denied()
+    if denied:
+        return denied
+    limit = bounded_int(request.args.get("limit"), default=20, maximum=200)
+    profiles = bounded_int(request.args.get("profiles"), default=50, maximum=200)
+    if limit is None or profiles is None:
+        return jsonify({"error": "limit and profiles must be positive whole numbers"}), 400
+    return jsonify({
+        "profiles": profiler.recent_profiles(limit),
+        "hot_functions": profiler.hot_functions(limit, profiles)
+    })
+
+@bp.route('/admin/profiles/<name>', methods=['GET'])
+def download_profile(name):
+    denied = _profile_admin_denied()
+    if denied:
+        return denied
+    return send_from_directory(os.path.abspath(profiler.PROFILE_DIR), name, mimetype="text/plain")
+
+@bp.route('/health', methods=['GET'])
+def health():
+    return jsonify({"status": "ok", "pid": os.getpid(), "startup": current_app.config["STARTUP_TIMINGS"]})
+
+
+def create_app():
+    """Build the Flask app. Mongo, Cloudinary and the face pool are created lazily, after any fork."""
+    started = time.perf_counter()
+    app = Flask(__name__)
+    if TRUSTED_PROXY_HOPS:
+        # request.remote_addr becomes the client address the trusted proxies recorded
+        app.wsgi_app = ProxyFix(app.wsgi_app, x_for=TRUSTED_PROXY_HOPS)
+    CORS(app)
+    app.register_blueprint(bp)
+
+    startup = {"import_ms": round((started - _import_started) * 1000, 2)}
+    try:
+        with stage_timer(startup, "ensure_indexes"):
+            ensure_indexes()
+    except Exception as e:
+        print(f"Failed to create MongoDB indexes: {e}")
+    if encoding_store is not None:
+        # Built once; with preload_app the master does it and workers just map the files
+        try:
+            with stage_timer(startup, "shared_store"):
+                encoding_store.ensure_built(users_collection)
+        except Exception as e:
+            print(f"Failed to build the shared encoding store: {e}")
+    if FACE_PRELOAD and (FACE_POOL_WORKERS <= 0 or FACE_POOL_START_METHOD == "fork"):
+        with stage_timer(startup, "warm_up"):
+            warm_up_models()
+    startup["create_app_ms"] = round((time.perf_counter() - started) * 1000, 2)
+    app.config["STARTUP_TIMINGS"] = startup
+    print(f"Startup (pid {os.getpid()}): " + ", ".join(f"{stage}={ms}" for stage, ms in startup.items()))
+    return app
+
+
+app = create_app()
+
 if __name__ == '__main__':
     port = int(os.environ.get("PORT", 5000))  # Get PORT from environment
     app.run(host='0.0.0.0', port=port)
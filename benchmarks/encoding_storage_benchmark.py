@@ -0,0 +1,87 @@
+"""Compare the packed encoding formats: document size, decode speed and match accuracy.
+
+For every FACE_ENCODING_STORAGE format (plus the legacy array of doubles) this
+reports the BSON size of the stored field, the time to decode a whole gallery
+back into a matrix, and how far distances drift from the float64 originals,
+including how many login decisions flip at the match threshold:
+
+    python -m benchmarks.encoding_storage_benchmark --users 100000 --threshold 0.4
+
+Pass --encodings with an (N, 128) .npy file of real encodings to measure on
+them instead of synthetic ones.
+"""
+import argparse
+import json
+import time
+import bson
+import numpy as np
+from face_auth.encodings import ENCODING_SIZE, pack_encoding, unpack_encoding
+from benchmarks.gallery_benchmark import synthetic_encodings
+
+FORMATS = ("array", "float32", "float16", "int8")
+
+
+def stored_value(encoding, storage):
+    if storage == "array":
+        return [float(value) for value in encoding]
+    return pack_encoding(encoding, storage)
+
+
+def bench(encodings, storage, threshold, seed=1):
+    stored = [stored_value(encoding, storage) for encoding in encodings]
+    field_bytes = np.mean([len(bson.encode({"face_encoding": value})) for value in stored[:1000]])
+
+    # Round-trip through BSON as a Mongo read would, then time the decode alone
+    documents = [bson.decode(bson.encode({"face_encoding": value})) for value in stored]
+    started = time.perf_counter()
+    matrix = np.vstack([unpack_encoding(document["face_encoding"]) for document in documents])
+    decode_seconds = time.perf_counter() - started
+
+    # Probes at a spread of distances around the threshold, as genuine and impostor logins would be
+    rng = np.random.default_rng(seed)
+    noise = rng.normal(0, 1, size=encodings.shape)
+    noise *= rng.uniform(0.5, 1.5, size=(len(encodings), 1)) * threshold / np.linalg.norm(noise, axis=1, keepdims=True)
+    probes = encodings + noise
+    exact = np.linalg.norm(encodings - probes, axis=1)
+    packed = np.linalg.norm(matrix.astype(np.float64) - probes, axis=1)
+    error = np.abs(packed - exact)
+    return {
+        "format": storage,
+        "field_bytes": round(float(field_bytes), 1),
+        "gallery_mb": round(float(field_bytes) * len(encodings) / 2 ** 20, 2),
+        "decode_s": round(decode_seconds, 3),
+        "mean_distance_error": float(error.mean()),
+        "max_distance_error": float(error.max()),
+        "decision_flips": int(np.count_nonzero((exact <= threshold) != (packed <= threshold)))
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--users", type=int, default=50000)
+    parser.add_argument("--threshold", type=float, default=0.4)
+    parser.add_argument("--encodings", help="(N, 128) .npy file of real encodings")
+    parser.add_argument("--formats", nargs="+", choices=FORMATS, default=list(FORMATS))
+    parser.add_argument("--output", help="Write results as JSON to this file")
+    args = parser.parse_args()
+
+    if args.encodings:
+        encodings = np.load(args.encodings).astype(np.float64).reshape(-1, ENCODING_SIZE)
+    else:
+        encodings = synthetic_encodings(args.users).astype(np.float64)
+
+    results = []
+    for storage in args.formats:
+        result = bench(encodings, storage, args.threshold)
+        results.append(result)
+        print(f"{result['format']:<8} {result['field_bytes']:>7} B/user  {result['gallery_mb']:>8} MB  "
+              f"decode {result['decode_s']:>7}s  distance error mean {result['mean_distance_error']:.2e} "
+              f"max {result['max_distance_error']:.2e}  flips {result['decision_flips']}/{len(encodings)}")
+
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(results, f, indent=2)
+
+
+if __name__ == '__main__':
+    main()
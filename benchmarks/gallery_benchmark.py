@@ -0,0 +1,77 @@
+"""Measure /identify query latency against gallery size.
+
+Uses random unit-scale encodings, so no Mongo or face images are needed:
+
+    python -m benchmarks.gallery_benchmark --sizes 1000 10000 100000 --ann hnsw
+"""
+import argparse
+import json
+import time
+import numpy as np
+from face_auth.gallery import GalleryIndex, ENCODING_SIZE
+
+
+def synthetic_encodings(count, seed=0):
+    # dlib encodings have a norm of roughly 1; spread them so the nearest neighbour is meaningful
+    rng = np.random.default_rng(seed)
+    vectors = rng.normal(0, 1, size=(count, ENCODING_SIZE)).astype(np.float32)
+    return vectors / np.linalg.norm(vectors, axis=1, keepdims=True)
+
+
+def bench(size, queries, ann):
+    index = GalleryIndex(ann=ann, ann_min_size=0)
+    vectors = synthetic_encodings(size)
+
+    started = time.perf_counter()
+    for row, vector in enumerate(vectors):
+        index.add(f"user{row}@example.com", vector)
+    build_seconds = time.perf_counter() - started
+
+    # Probes are noisy copies of enrolled faces, as in a real login
+    rng = np.random.default_rng(1)
+    targets = rng.integers(0, size, size=queries)
+    probes = vectors[targets] + rng.normal(0, 0.02, size=(queries, ENCODING_SIZE)).astype(np.float32)
+
+    latencies = []
+    correct = 0
+    for target, probe in zip(targets, probes):
+        started = time.perf_counter()
+        matches = index.search(probe, k=1, threshold=np.inf)
+        latencies.append(time.perf_counter() - started)
+        correct += bool(matches) and matches[0][0] == f"user{target}@example.com"
+
+    latencies = np.array(latencies) * 1000
+    return {
+        "size": size,
+        "ann": index.stats()["ann"],
+        "build_s": round(build_seconds, 3),
+        "p50_ms": round(float(np.percentile(latencies, 50)), 3),
+        "p95_ms": round(float(np.percentile(latencies, 95)), 3),
+        "p99_ms": round(float(np.percentile(latencies, 99)), 3),
+        "recall_at_1": correct / queries
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--sizes", type=int, nargs="+", default=[1000, 10000, 100000])
+    parser.add_argument("--queries", type=int, default=200)
+    parser.add_argument("--ann", choices=["", "hnsw"], default="")
+    parser.add_argument("--output", help="Write results as JSON to this file")
+    args = parser.parse_args()
+
+    results = []
+    for size in args.sizes:
+        result = bench(size, args.queries, args.ann)
+        results.append(result)
+        print(f"{result['size']:>8} users  ann={result['ann']!s:<5}  build {result['build_s']:>7}s  "
+              f"p50 {result['p50_ms']:>8}ms  p95 {result['p95_ms']:>8}ms  p99 {result['p99_ms']:>8}ms  "
+              f"recall@1 {result['recall_at_1']:.3f}")
+
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(results, f, indent=2)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,270 @@
+"""Offline HTTP load benchmark for /register, /login and /capture_upload_image.
+
+Runs the Flask app in-process against a local Mongo stand-in (mongomock by
+default, or a local mongod via --mongo-uri) and a fake Cloudinary server with
+configurable latency, drives it with concurrent clients and reports
+p50/p95/p99 latency and requests/sec per endpoint:
+
+    python -m benchmarks.load_benchmark --faces-dir ~/lfw-sample --users 50 --concurrency 8 \\
+        --cloudinary-latency-ms 120 --output results/$(git rev-parse --short HEAD).json
+
+Without --faces-dir synthetic images are generated; the detector will usually
+find no face in them, so they exercise the rejection path only.
+
+--cloudinary-error-rate and --cloudinary-stall-rate make the fake server fail
+or hang on a share of calls, to exercise the timeouts, retries and circuit
+breakers around Cloudinary (watch "breakers" in /pool_stats).
+"""
+import argparse
+import glob
+import itertools
+import json
+import os
+import random
+import subprocess
+import threading
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import cv2
+import numpy as np
+import requests
+
+
+class FakeCloudinary(ThreadingHTTPServer):
+    """Just enough of the Cloudinary upload/destroy API and CDN to serve the app."""
+
+    daemon_threads = True
+
+    def __init__(self, latency_ms=0, error_rate=0.0, stall_rate=0.0, stall_seconds=60):
+        super().__init__(("127.0.0.1", 0), FakeCloudinaryHandler)
+        self.latency = latency_ms / 1000
+        self.error_rate = error_rate
+        self.stall_rate = stall_rate
+        self.stall_seconds = stall_seconds
+        self.images = {}
+        self.lock = threading.Lock()
+
+    @property
+    def base_url(self):
+        return f"http://127.0.0.1:{self.server_address[1]}"
+
+    def misbehave(self, handler):
+        """Sleep the configured latency, then maybe stall or fail. Returns True if the call failed."""
+        time.sleep(self.latency)
+        roll = random.random()
+        if roll < self.stall_rate:
+            time.sleep(self.stall_seconds)
+        elif roll < self.stall_rate + self.error_rate:
+            handler._reply(500, {"error": {"message": "injected failure"}})
+            return True
+        return False
+
+
+class FakeCloudinaryHandler(BaseHTTPRequestHandler):
+
+    def log_message(self, *args):
+        pass
+
+    def _reply(self, status, body, content_type="application/json"):
+        if isinstance(body, dict):
+            body = json.dumps(body).encode()
+        self.send_response(status)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_POST(self):
+        if self.server.misbehave(self):
+            return
+        body = self.rfile.read(int(self.headers.get("Content-Length", 0)))
+        if self.path.endswith("/image/upload"):
+            # Pull the JPEG out of the multipart body instead of parsing it properly
+            start, end = body.find(b"\xff\xd8"), body.rfind(b"\xff\xd9")
+            if start < 0 or end < 0:
+                return self._reply(400, {"error": {"message": "no image"}})
+            public_id = f"face_recognition/{uuid.uuid4().hex}"
+            with self.server.lock:
+                self.server.images[public_id] = body[start:end + 2]
+            return self._reply(200, {
+                "public_id": public_id,
+                "secure_url": f"{self.server.base_url}/image/upload/v1/{public_id}.jpg"
+            })
+        if self.path.endswith("/image/destroy"):
+            return self._reply(200, {"result": "ok"})
+        self._reply(404, {"error": {"message": "not found"}})
+
+    def do_GET(self):
+        if self.server.misbehave(self):
+            return
+        public_id = "/".join(self.path.split("/")[-2:]).rsplit(".", 1)[0]
+        with self.server.lock:
+            image = self.server.images.get(public_id)
+        if image is None:
+            return self._reply(404, b"", "text/plain")
+        self._reply(200, image, "image/jpeg")
+
+
+def synthetic_face(seed, size=480):
+    """Draw a crude face; good enough to exercise decode/detect, not to be recognised."""
+    rng = random.Random(seed)
+    image = np.full((size, size, 3), rng.randint(120, 220), dtype=np.uint8)
+    center = (size // 2 + rng.randint(-20, 20), size // 2 + rng.randint(-20, 20))
+    skin = (rng.randint(90, 140), rng.randint(140, 180), rng.randint(180, 230))
+    cv2.ellipse(image, center, (110, 145), 0, 0, 360, skin, -1)
+    for dx in (-45, 45):
+        cv2.circle(image, (center[0] + dx, center[1] - 35), 14, (40, 30, 30), -1)
+    cv2.ellipse(image, (center[0], center[1] + 60), (45, 18), 0, 0, 180, (60, 40, 150), 6)
+    return cv2.imencode(".jpg", image)[1].tobytes()
+
+
+def load_faces(faces_dir, count):
+    if not faces_dir:
+        return [synthetic_face(i) for i in range(count)]
+    paths = sorted(glob.glob(os.path.join(faces_dir, "**", "*.jp*g"), recursive=True))
+    if not paths:
+        raise SystemExit(f"No .jpg files found under {faces_dir}")
+    faces = []
+    for path in itertools.islice(itertools.cycle(paths), count):
+        with open(path, "rb") as f:
+            faces.append(f.read())
+    return faces
+
+
+def use_local_backends(fake, mongo_uri):
+    """Point the app at the fake Cloudinary and a local Mongo before it handles any request."""
+    import cloudinary
+    import face_auth.cloudinary_config  # noqa: F401 - apply the app's settings first so these win
+    from face_auth import db
+    cloudinary.config(cloud_name="bench", api_key="bench", api_secret="bench",
+                      upload_prefix=fake.base_url)
+    if mongo_uri:
+        os.environ["MONGO_URI"] = mongo_uri
+        os.environ["MONGO_DB_NAME"] = f"face_auth_bench_{uuid.uuid4().hex[:8]}"
+    else:
+        import mongomock
+        db._client = mongomock.MongoClient()
+        db._client_pid = os.getpid()
+
+
+def start_app():
+    from werkzeug.serving import make_server
+    from app import app
+    server = make_server("127.0.0.1", 0, app, threaded=True)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server, f"http://127.0.0.1:{server.server_port}"
+
+
+def run_phase(name, calls, concurrency):
+    """Run the (url, form data, image bytes) calls concurrently and summarise their latency."""
+    local = threading.local()
+
+    def send(call):
+        session = getattr(local, "session", None)
+        if session is None:
+            session = local.session = requests.Session()
+        url, data, image = call
+        started = time.perf_counter()
+        try:
+            status = session.post(url, data=data, files={"image": ("face.jpg", image, "image/jpeg")},
+                                  timeout=120).status_code
+        except requests.RequestException:
+            status = "error"
+        return time.perf_counter() - started, status
+
+    started = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        results = list(executor.map(send, calls))
+    wall = time.perf_counter() - started
+
+    latencies = np.array([latency for latency, _ in results]) * 1000
+    statuses = {}
+    for _, status in results:
+        statuses[str(status)] = statuses.get(str(status), 0) + 1
+    summary = {
+        "endpoint": name,
+        "requests": len(results),
+        "concurrency": concurrency,
+        "rps": round(len(results) / wall, 2) if wall else 0.0,
+        "p50_ms": round(float(np.percentile(latencies, 50)), 1),
+        "p95_ms": round(float(np.percentile(latencies, 95)), 1),
+        "p99_ms": round(float(np.percentile(latencies, 99)), 1),
+        "max_ms": round(float(latencies.max()), 1),
+        "status": statuses
+    }
+    print(f"{name:<24} {summary['requests']:>5} req  {summary['rps']:>7} req/s  "
+          f"p50 {summary['p50_ms']:>8}ms  p95 {summary['p95_ms']:>8}ms  p99 {summary['p99_ms']:>8}ms  "
+          f"status {statuses}")
+    return summary
+
+
+def git_commit():
+    try:
+        return subprocess.check_output(["git", "rev-parse", "HEAD"], text=True,
+                                       stderr=subprocess.DEVNULL).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--faces-dir", help="Directory of face .jpg files (searched recursively)")
+    parser.add_argument("--users", type=int, default=20)
+    parser.add_argument("--logins-per-user", type=int, default=5)
+    parser.add_argument("--concurrency", type=int, default=4)
+    parser.add_argument("--cloudinary-latency-ms", type=float, default=50)
+    parser.add_argument("--cloudinary-error-rate", type=float, default=0.0, help="Share of calls answered with 500")
+    parser.add_argument("--cloudinary-stall-rate", type=float, default=0.0, help="Share of calls that hang for a minute")
+    parser.add_argument("--mongo-uri", help="Use this mongod instead of mongomock (a scratch database is created)")
+    parser.add_argument("--output", help="Write results as JSON to this file")
+    args = parser.parse_args()
+
+    # Every simulated client shares one IP and repeats logins; measure the app, not the rate limits
+    os.environ.setdefault("RATE_LIMIT_IP_PER_MIN", "0")
+    os.environ.setdefault("RATE_LIMIT_USER_PER_MIN", "0")
+
+    fake = FakeCloudinary(args.cloudinary_latency_ms, args.cloudinary_error_rate, args.cloudinary_stall_rate)
+    threading.Thread(target=fake.serve_forever, daemon=True).start()
+    use_local_backends(fake, args.mongo_uri)
+    server, base_url = start_app()
+
+    faces = load_faces(args.faces_dir, args.users)
+    emails = [f"bench{i}@example.com" for i in range(args.users)]
+
+    results = [
+        run_phase("/register", [
+            (f"{base_url}/register", {"name": f"Bench {i}", "email": email, "mobile": "0000000000"}, face)
+            for i, (email, face) in enumerate(zip(emails, faces))
+        ], args.concurrency),
+        run_phase("/login", [
+            (f"{base_url}/login", {"email": email}, face)
+            for _ in range(args.logins_per_user) for email, face in zip(emails, faces)
+        ], args.concurrency),
+        run_phase("/capture_upload_image", [
+            (f"{base_url}/capture_upload_image", {"email": email}, face)
+            for email, face in zip(emails, faces)
+        ], args.concurrency),
+    ]
+    breakers = requests.get(f"{base_url}/pool_stats", timeout=10).json().get("breakers")
+    print(f"Circuit breakers: {breakers}")
+    server.shutdown()
+    fake.shutdown()
+
+    report = {
+        "commit": git_commit(),
+        "timestamp": time.strftime("%Y-%m-%dT%H:%M:%S%z"),
+        "config": vars(args),
+        "results": results,
+        "breakers": breakers
+    }
+    if args.output:
+        os.makedirs(os.path.dirname(os.path.abspath(args.output)), exist_ok=True)
+        with open(args.output, "w") as f:
+            json.dump(report, f, indent=2)
+        print(f"Results written to {args.output}")
+
+
+if __name__ == '__main__':
+    main()
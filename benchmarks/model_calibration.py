@@ -0,0 +1,197 @@
+"""Compare face-model configurations and calibrate the login threshold on labelled images.
+
+The dataset is a folder with one sub-folder of photos per person (the LFW
+layout). Every combination of the given settings is run through the app's own
+detect_and_encode in a fresh process, so per-image latency and peak memory are
+measured for that configuration alone:
+
+    python -m benchmarks.model_calibration ~/lfw-sample --detection-models hog cnn \\
+        --upsample 0 1 --jitters 1 5 --max-sides 320 640 --landmarks small large \\
+        --latency-budget-ms 150 --target-far 0.001 --output results/calibration.json
+
+For each configuration it reports encode time per image, peak RSS, the share
+of images without a detected face and FAR/FRR over a grid of thresholds with
+the equal error rate. It then recommends the most accurate configuration
+within the latency budget and the threshold (FACE_MATCH_THRESHOLD) that keeps
+FAR at or below the target.
+"""
+import argparse
+import glob
+import itertools
+import json
+import multiprocessing
+import os
+import resource
+import time
+from concurrent.futures import ProcessPoolExecutor
+import numpy as np
+
+IMAGE_PATTERNS = ("*.jpg", "*.jpeg", "*.png")
+THRESHOLDS = np.round(np.arange(0.20, 0.801, 0.005), 3)
+
+
+def load_dataset(root, max_per_person):
+    """Return (paths, labels) for people with at least two images."""
+    paths, labels = [], []
+    for person in sorted(os.listdir(root)):
+        folder = os.path.join(root, person)
+        if not os.path.isdir(folder):
+            continue
+        images = sorted(path for pattern in IMAGE_PATTERNS for path in glob.glob(os.path.join(folder, pattern)))
+        if len(images) < 2:
+            continue
+        for path in images[:max_per_person]:
+            paths.append(path)
+            labels.append(person)
+    return paths, labels
+
+
+def _encode_all(config, paths):
+    """Runs in a fresh process: apply config through the app's settings, then encode every image."""
+    os.environ.update({
+        "FACE_DETECTION_MODEL": config["detection_model"],
+        "FACE_DETECTION_UPSAMPLE": str(config["upsample"]),
+        "FACE_ENCODING_JITTERS": str(config["jitters"]),
+        "FACE_ENCODING_MODEL": config["landmarks"],
+        "DETECTION_MAX_SIDE": str(config["max_side"]),
+    })
+    from face_auth.workers import warm_up_models
+    from face_auth.preprocess import decode_upload, detect_and_encode
+    warm_up_models()
+
+    encodings, seconds = [], []
+    for path in paths:
+        with open(path, "rb") as f:
+            image = decode_upload(f.read())
+        started = time.perf_counter()
+        result = detect_and_encode(image) if image is not None else None
+        seconds.append(time.perf_counter() - started)
+        encodings.append(None if result is None or result.encoding is None else result.encoding)
+    peak_rss_mb = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024  # KiB on Linux
+    return encodings, seconds, peak_rss_mb
+
+
+def pairwise_distances(matrix):
+    """All pairwise Euclidean distances in one matrix product."""
+    squared = np.einsum("ij,ij->i", matrix, matrix)
+    distances = squared[:, None] + squared[None, :] - 2 * matrix @ matrix.T
+    return np.sqrt(np.maximum(distances, 0))
+
+
+def error_rates(matrix, labels):
+    """FAR and FRR at every THRESHOLDS value (login accepts distance < threshold)."""
+    labels = np.asarray(labels)
+    distances = pairwise_distances(matrix)
+    upper = np.triu_indices(len(labels), k=1)
+    pair_distances = distances[upper]
+    same = labels[upper[0]] == labels[upper[1]]
+    genuine, impostor = np.sort(pair_distances[same]), np.sort(pair_distances[~same])
+    # searchsorted counts pairs below each threshold without a loop over thresholds
+    far = np.searchsorted(impostor, THRESHOLDS, side="left") / max(len(impostor), 1)
+    frr = 1 - np.searchsorted(genuine, THRESHOLDS, side="left") / max(len(genuine), 1)
+    return far, frr, len(genuine), len(impostor)
+
+
+def evaluate(config, paths, labels):
+    context = multiprocessing.get_context("spawn")
+    with ProcessPoolExecutor(max_workers=1, mp_context=context) as executor:
+        encodings, seconds, peak_rss_mb = executor.submit(_encode_all, config, paths).result()
+
+    found = [i for i, encoding in enumerate(encodings) if encoding is not None]
+    matrix = np.vstack([encodings[i] for i in found]).astype(np.float64)
+    far, frr, genuine_pairs, impostor_pairs = error_rates(matrix, [labels[i] for i in found])
+    eer_index = int(np.argmin(np.abs(far - frr)))
+    latencies = np.array(seconds) * 1000
+    return {
+        "config": config,
+        "images": len(paths),
+        "no_face_rate": round(1 - len(found) / len(paths), 4),
+        "encode_ms_mean": round(float(latencies.mean()), 1),
+        "encode_ms_p95": round(float(np.percentile(latencies, 95)), 1),
+        "peak_rss_mb": round(peak_rss_mb, 1),
+        "genuine_pairs": genuine_pairs,
+        "impostor_pairs": impostor_pairs,
+        "eer": round(float((far[eer_index] + frr[eer_index]) / 2), 4),
+        "eer_threshold": float(THRESHOLDS[eer_index]),
+        "curve": {"threshold": THRESHOLDS.tolist(), "far": far.round(6).tolist(), "frr": frr.round(6).tolist()}
+    }
+
+
+def recommend(results, latency_budget_ms, target_far):
+    """Pick the config with the lowest FRR at FAR <= target_far among those within the latency budget."""
+    best = None
+    for result in results:
+        if result["encode_ms_p95"] > latency_budget_ms:
+            continue
+        far, frr = np.array(result["curve"]["far"]), np.array(result["curve"]["frr"])
+        allowed = np.flatnonzero(far <= target_far)
+        if not len(allowed):
+            continue
+        index = allowed[-1]  # Highest threshold that still meets the FAR target
+        # Images without a detected face are rejected logins too
+        effective_frr = 1 - (1 - frr[index]) * (1 - result["no_face_rate"])
+        candidate = {
+            "config": result["config"],
+            "threshold": result["curve"]["threshold"][index],
+            "far": float(far[index]),
+            "frr": round(float(effective_frr), 4),
+            "encode_ms_p95": result["encode_ms_p95"]
+        }
+        if best is None or (candidate["frr"], candidate["encode_ms_p95"]) < (best["frr"], best["encode_ms_p95"]):
+            best = candidate
+    return best
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("dataset", help="Folder with one sub-folder of images per person")
+    parser.add_argument("--max-per-person", type=int, default=10)
+    parser.add_argument("--detection-models", nargs="+", default=["hog"], choices=["hog", "cnn"])
+    parser.add_argument("--upsample", type=int, nargs="+", default=[1])
+    parser.add_argument("--jitters", type=int, nargs="+", default=[1])
+    parser.add_argument("--max-sides", type=int, nargs="+", default=[640], help="Detector input size (longest side)")
+    parser.add_argument("--landmarks", nargs="+", default=["small"], choices=["small", "large"])
+    parser.add_argument("--latency-budget-ms", type=float, default=200, help="p95 detect + encode time per image")
+    parser.add_argument("--target-far", type=float, default=0.001, help="Acceptable false accept rate")
+    parser.add_argument("--output", help="Write results (with full FAR/FRR curves) as JSON to this file")
+    args = parser.parse_args()
+
+    paths, labels = load_dataset(args.dataset, args.max_per_person)
+    if not paths:
+        raise SystemExit(f"No people with two or more images under {args.dataset}")
+    print(f"{len(paths)} images of {len(set(labels))} people")
+
+    results = []
+    for model, upsample, jitters, max_side, landmarks in itertools.product(
+            args.detection_models, args.upsample, args.jitters, args.max_sides, args.landmarks):
+        config = {"detection_model": model, "upsample": upsample, "jitters": jitters,
+                  "max_side": max_side, "landmarks": landmarks}
+        result = evaluate(config, paths, labels)
+        results.append(result)
+        print(f"{model:<4} up={upsample} jit={jitters:<2} side={max_side:<5} {landmarks:<5}  "
+              f"p95 {result['encode_ms_p95']:>7}ms  mean {result['encode_ms_mean']:>7}ms  "
+              f"rss {result['peak_rss_mb']:>7}MB  no-face {result['no_face_rate']:.3f}  "
+              f"EER {result['eer']:.4f} @ {result['eer_threshold']}")
+
+    recommendation = recommend(results, args.latency_budget_ms, args.target_far)
+    if recommendation is None:
+        print(f"No configuration meets p95 <= {args.latency_budget_ms}ms with FAR <= {args.target_far}")
+    else:
+        config = recommendation["config"]
+        print(f"Recommended: FACE_DETECTION_MODEL={config['detection_model']} "
+              f"FACE_DETECTION_UPSAMPLE={config['upsample']} FACE_ENCODING_JITTERS={config['jitters']} "
+              f"DETECTION_MAX_SIDE={config['max_side']} FACE_ENCODING_MODEL={config['landmarks']} "
+              f"FACE_MATCH_THRESHOLD={recommendation['threshold']} "
+              f"(FAR {recommendation['far']:.4f}, FRR {recommendation['frr']:.4f}, "
+              f"p95 {recommendation['encode_ms_p95']}ms)")
+
+    if args.output:
+        os.makedirs(os.path.dirname(os.path.abspath(args.output)), exist_ok=True)
+        with open(args.output, "w") as f:
+            json.dump({"results": results, "recommendation": recommendation,
+                       "latency_budget_ms": args.latency_budget_ms, "target_far": args.target_far}, f, indent=2)
+        print(f"Results written to {args.output}")
+
+
+if __name__ == '__main__':
+    main()
@@ -1,3 +1,18 @@
-from .register import register_user
-from .login import login_user
-from .db import db_connection
+from dotenv import load_dotenv
+
+# Load .env once, before any face_auth module reads its settings
+load_dotenv()
+
+_exports = {
+    "register_user": ".register",
+    "login_user": ".login",
+    "db_connection": ".db",
+}
+
+
+def __getattr__(name):
+    # Resolved on first use, so importing face_auth does not pull in Mongo, Cloudinary or dlib
+    if name in _exports:
+        import importlib
+        return getattr(importlib.import_module(_exports[name], __name__), name)
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
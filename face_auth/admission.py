@@ -0,0 +1,157 @@
+import os
+import math
+import time
+import threading
+from collections import OrderedDict
+from face_auth.workers import FACE_POOL_WORKERS
+
+# Requests allowed to run the face endpoints at once (per gunicorn worker); 0 disables the limit
+ADMISSION_CONCURRENCY = int(os.getenv("ADMISSION_CONCURRENCY", str(max(FACE_POOL_WORKERS, 1) * 2)))
+# Requests allowed to wait for a slot; anything beyond is shed immediately
+ADMISSION_QUEUE_DEPTH = int(os.getenv("ADMISSION_QUEUE_DEPTH", str(ADMISSION_CONCURRENCY * 2)))
+ADMISSION_QUEUE_TIMEOUT = float(os.getenv("ADMISSION_QUEUE_TIMEOUT", "2"))  # seconds waiting for a slot
+ADMISSION_RETRY_AFTER = int(os.getenv("ADMISSION_RETRY_AFTER", "1"))  # seconds, sent with 503s
+# Longest a request may take; clients can ask for less with an X-Request-Timeout header (seconds)
+REQUEST_DEADLINE = float(os.getenv("REQUEST_DEADLINE", "30"))
+# Token buckets: sustained requests per minute and burst size; a rate of 0 disables the bucket
+RATE_LIMIT_USER_PER_MIN = float(os.getenv("RATE_LIMIT_USER_PER_MIN", "20"))
+RATE_LIMIT_USER_BURST = int(os.getenv("RATE_LIMIT_USER_BURST", "5"))
+# Off by default: behind a router (Heroku, a load balancer) every client shares the router's
+# address unless TRUSTED_PROXY_HOPS says how many X-Forwarded-For entries to trust
+RATE_LIMIT_IP_PER_MIN = float(os.getenv("RATE_LIMIT_IP_PER_MIN", "0"))
+RATE_LIMIT_IP_BURST = int(os.getenv("RATE_LIMIT_IP_BURST", "30"))
+# Proxies in front of the app that append to X-Forwarded-For (1 on Heroku); 0 uses the socket address
+TRUSTED_PROXY_HOPS = int(os.getenv("TRUSTED_PROXY_HOPS", "0"))
+
+
+class AdmissionController:
+    """Concurrency limit with a bounded wait queue.
+
+    Up to `limit` requests run at once; up to `queue_depth` more wait for a
+    slot, each for at most its timeout. Everything else is rejected at once, so
+    a burst is answered with fast 503s instead of piling up behind dlib work
+    until clients give up.
+    """
+
+    def __init__(self, limit=ADMISSION_CONCURRENCY, queue_depth=ADMISSION_QUEUE_DEPTH):
+        self.limit = limit
+        self.queue_depth = queue_depth
+        self._active = 0
+        self._waiting = 0
+        self._condition = threading.Condition()
+        self.admitted = 0
+        self.shed = 0
+        self.timed_out = 0
+
+    def acquire(self, timeout=ADMISSION_QUEUE_TIMEOUT):
+        """Take a slot, waiting at most timeout seconds. Returns False if the request is shed."""
+        if self.limit <= 0:
+            return True
+        with self._condition:
+            if self._active >= self.limit:
+                if self._waiting >= self.queue_depth or timeout <= 0:
+                    self.shed += 1
+                    return False
+                self._waiting += 1
+                try:
+                    if not self._condition.wait_for(lambda: self._active < self.limit, timeout):
+                        self.timed_out += 1
+                        return False
+                finally:
+                    self._waiting -= 1
+            self._active += 1
+            self.admitted += 1
+            return True
+
+    def release(self):
+        if self.limit <= 0:
+            return
+        with self._condition:
+            self._active -= 1
+            self._condition.notify()
+
+    def stats(self):
+        with self._condition:
+            return {
+                "limit": self.limit,
+                "queue_depth": self.queue_depth,
+                "active": self._active,
+                "waiting": self._waiting,
+                "admitted": self.admitted,
+                "shed": self.shed,
+                "queue_timeouts": self.timed_out
+            }
+
+
+class TokenBucketLimiter:
+    """Per-key token buckets (e.g. per user or per client IP).
+
+    Each key earns rate_per_min / 60 tokens a second up to `burst`; a request
+    spends one. Buckets are kept in a bounded LRU, so an idle key simply starts
+    again with a full bucket. Limits are per process: with N gunicorn workers a
+    key can get up to N times the configured rate.
+    """
+
+    def __init__(self, rate_per_min, burst, max_keys=10000):
+        self.rate = rate_per_min / 60
+        self.burst = max(burst, 1)
+        self.max_keys = max_keys
+        self._buckets = OrderedDict()  # key -> (tokens, updated_at)
+        self._lock = threading.Lock()
+        self.rejected = 0
+
+    def allow(self, key):
+        """Spend a token for key. Returns (allowed, retry_after_seconds)."""
+        if self.rate <= 0 or not key:
+            return True, 0
+        now = time.monotonic()
+        with self._lock:
+            tokens, updated_at = self._buckets.pop(key, (self.burst, now))
+            tokens = min(self.burst, tokens + (now - updated_at) * self.rate)
+            allowed = tokens >= 1
+            if allowed:
+                tokens -= 1
+            else:
+                self.rejected += 1
+            self._buckets[key] = (tokens, now)
+            while len(self._buckets) > self.max_keys:
+                self._buckets.popitem(last=False)
+        return allowed, 0 if allowed else math.ceil((1 - tokens) / self.rate)
+
+    def stats(self):
+        with self._lock:
+            return {"keys": len(self._buckets), "rejected": self.rejected}
+
+
+def request_deadline_from(headers, now=None, default=REQUEST_DEADLINE):
+    """Wall-clock deadline for a request from its X-Request-Timeout / X-Request-Start headers.
+
+    X-Request-Start ("t=<epoch seconds>" as set by nginx, or epoch milliseconds)
+    moves the start back to when the proxy received the request, so time queued
+    in front of the worker counts against the deadline.
+    """
+    now = time.time() if now is None else now
+    started = now
+    start_header = headers.get("X-Request-Start", "")
+    try:
+        if start_header:
+            started = float(start_header.replace("t=", ""))
+            started = min(started / 1000 if started > 1e11 else started, now)
+    except ValueError:
+        pass
+    budget = default
+    try:
+        budget = min(float(headers.get("X-Request-Timeout", default)), default)
+    except ValueError:
+        pass
+    return started + budget
+
+
+# One of each per worker process, shared by all face endpoints
+admission = AdmissionController()
+user_limiter = TokenBucketLimiter(RATE_LIMIT_USER_PER_MIN, RATE_LIMIT_USER_BURST)
+ip_limiter = TokenBucketLimiter(RATE_LIMIT_IP_PER_MIN, RATE_LIMIT_IP_BURST)
+
+
+def admission_stats():
+    return {"admission": admission.stats(), "user_limiter": user_limiter.stats(), "ip_limiter": ip_limiter.stats()}
@@ -0,0 +1,268 @@
+import argparse
+import itertools
+import json
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor, as_completed
+from bson import ObjectId
+from pymongo import UpdateOne
+from face_auth.utils import get_cloudinary_image, fetch_cloudinary_response, users_collection
+from face_auth.encodings import encoding_fields, encoding_signature, pack_encoding
+from face_auth.gallery import gallery
+from face_auth.shared_store import encoding_store, publish_encoding
+from face_auth.workers import encode_image, warm_up_models
+from face_auth.resilience import cloudinary_cdn_breaker, CLOSED, OPEN
+
+
+def backfill_user_encoding(user):
+    """Compute and store the encoding for a user that only has an image_url.
+
+    Returns (encoding, error) where error is a login-style error response;
+    exactly one of them is None.
+    """
+    cloudinary_url = user.get("image_url")
+    cloudinary_image = get_cloudinary_image(cloudinary_url) if cloudinary_url else None
+    if cloudinary_image is None:
+        return None, {
+            "error": "User image not found. Please capture/upload an image.",
+            "capture_api": "/api/capture_upload_image",  # API for capturing & uploading
+            "Status": "False"
+        }
+
+    encoding = encode_image(cloudinary_image).encoding
+    if encoding is None:
+        return None, {"error": "No face detected in Cloudinary image", "Status": "False"}
+
+    # Only write if image_url is unchanged, so a concurrent re-capture is not overwritten
+    result = users_collection.update_one(
+        {"_id": user["_id"], "image_url": cloudinary_url},
+        {"$set": encoding_fields(encoding, cloudinary_url)}
+    )
+    if result.modified_count:
+        gallery.add(user["email"], encoding)
+        publish_encoding(user["email"], encoding, cloudinary_url)
+    return encoding, None
+
+
+class RateLimiter:
+    """Spaces calls at least 1/rate seconds apart across threads (rate <= 0 disables it)."""
+
+    def __init__(self, rate):
+        self.interval = 1.0 / rate if rate > 0 else 0.0
+        self._next = time.monotonic()
+        self._lock = threading.Lock()
+
+    def wait(self):
+        if not self.interval:
+            return
+        with self._lock:
+            now = time.monotonic()
+            delay = self._next - now
+            self._next = max(self._next, now) + self.interval
+        if delay > 0:
+            time.sleep(delay)
+
+
+def _encode_bytes(data):
+    """Decode and encode a downloaded image (runs in the process pool)."""
+    from face_auth.utils import decode_image
+    from face_auth.preprocess import detect_and_encode
+    image = decode_image(data)
+    if image is None:
+        return None
+    return detect_and_encode(image).encoding
+
+
+def _load_checkpoint(path):
+    """Return (last_id, retry_ids) from the checkpoint file, or (None, [])."""
+    if path and os.path.exists(path):
+        with open(path) as f:
+            checkpoint = json.load(f)
+        return checkpoint.get("last_id"), checkpoint.get("retry_ids", [])
+    return None, []
+
+
+def _save_checkpoint(path, last_id, counts, retry_ids=()):
+    if not path:
+        return
+    tmp_path = f"{path}.tmp"
+    with open(tmp_path, "w") as f:
+        json.dump({"last_id": str(last_id), "retry_ids": [str(user_id) for user_id in retry_ids], **counts}, f)
+    os.replace(tmp_path, path)  # Atomic, so a crash never leaves a torn checkpoint
+
+
+def _wait_while_open(breaker, poll=1.0):
+    """Block while breaker is open, so fetches are not written off while the CDN recovers."""
+    paused = False
+    while breaker.state == OPEN:
+        if not paused:
+            print(f"Backfill paused: circuit {breaker.name} is open")
+            paused = True
+        time.sleep(poll)
+    if paused:
+        print("Backfill resumed")
+
+
+def _publish_backfilled(written):
+    """Publish (user, encoding) pairs to the shared store whose image is still the user's current one."""
+    if encoding_store is None or not written:
+        return
+    current = {user["_id"]: user.get("image_url") for user in users_collection.find(
+        {"_id": {"$in": [user["_id"] for user, _ in written]}}, {"image_url": 1})}
+    for user, encoding in written:
+        # A guarded write that lost to a re-capture must not shadow the newer encoding
+        if current.get(user["_id"]) == user["image_url"]:
+            publish_encoding(user["email"], encoding, user["image_url"])
+
+
+def backfill_encodings(limit=None, batch_size=500, fetch_threads=16, processes=None,
+                       rate=0.0, checkpoint_path="backfill_checkpoint.json"):
+    """Compute encodings for every user whose stored encoding is missing or stale.
+
+    Users are streamed in _id order with a cursor; images are fetched by a
+    bounded thread pool (at most `rate` fetches per second when set), encoded
+    in a process pool and written back with one bulk_write per batch. The last
+    written _id is checkpointed, so an interrupted run resumes where it stopped.
+
+    While the Cloudinary CDN breaker is open, fetches pause instead of failing.
+    Written encodings are published to the shared store, when configured.
+    Users whose image still could not be fetched (timeout, 5xx) are kept in the
+    checkpoint's retry_ids and tried again by the next run. A 4xx answer means
+    the image is gone, so those users are counted as missing and not retried.
+    """
+    query = {
+        "image_url": {"$nin": [None, ""]},
+        "$or": [
+            {"face_encoding": {"$exists": False}},
+            {"encoding_version": {"$ne": encoding_signature()}},
+            {"$expr": {"$ne": ["$encoding_image_url", "$image_url"]}}
+        ]
+    }
+    last_id, previous_retry_ids = _load_checkpoint(checkpoint_path)
+    if last_id:
+        # Users whose fetch failed last time sort before last_id, so they come first
+        query["$and"] = [{"$or": [{"_id": {"$gt": ObjectId(last_id)}},
+                                  {"_id": {"$in": [ObjectId(user_id) for user_id in previous_retry_ids]}}]}]
+        print(f"Resuming after _id {last_id} ({len(previous_retry_ids)} users to retry)")
+
+    cursor = users_collection.find(query, {"email": 1, "image_url": 1}).sort("_id", 1).batch_size(batch_size)
+    if limit:
+        cursor = cursor.limit(limit)
+
+    counts = {"updated": 0, "failed": 0, "missing": 0}
+    limiter = RateLimiter(rate)
+    started = time.perf_counter()
+
+    resume_after = ObjectId(last_id) if last_id else None
+    retry_ids = []  # Users whose image could not be fetched in this run
+
+    def fetch(user):
+        while True:
+            _wait_while_open(cloudinary_cdn_breaker)
+            limiter.wait()
+            data, status = fetch_cloudinary_response(user["image_url"])
+            if data is not None or cloudinary_cdn_breaker.state == CLOSED:
+                return data, status
+            # Failed because the breaker opened (or its trial call is running); try again once it resets
+            time.sleep(1.0)
+
+    with ThreadPoolExecutor(max_workers=fetch_threads) as fetchers, \
+            ProcessPoolExecutor(max_workers=processes, initializer=warm_up_models) as encoders:
+        batch = list(itertools.islice(cursor, batch_size))
+        while batch:
+            # Each download is handed to the encoders as soon as it arrives
+            downloads = {fetchers.submit(fetch, user): user for user in batch}
+            encodings = {}
+            for future in as_completed(downloads):
+                user, (data, status) = downloads[future], future.result()
+                if data is None and status is not None and 400 <= status < 500:
+                    # Deleted or never-existing image: retrying cannot help
+                    print(f"Backfill skipped {user.get('email')}: image answered HTTP {status}")
+                    counts["missing"] += 1
+                    continue
+                if data is None:
+                    print(f"Backfill failed for {user.get('email')}: image could not be fetched (will retry)")
+                    counts["failed"] += 1
+                    retry_ids.append(user["_id"])
+                    continue
+                encodings[encoders.submit(_encode_bytes, data)] = user
+
+            operations, written = [], []
+            for future in as_completed(encodings):
+                user, encoding = encodings[future], future.result()
+                if encoding is None:
+                    print(f"Backfill failed for {user.get('email')}: no face detected")
+                    counts["failed"] += 1
+                    continue
+                # Only write if image_url is unchanged, so a concurrent re-capture is not overwritten
+                operations.append(UpdateOne(
+                    {"_id": user["_id"], "image_url": user["image_url"]},
+                    {"$set": encoding_fields(encoding, user["image_url"])}
+                ))
+                written.append((user, encoding))
+            if operations:
+                counts["updated"] += users_collection.bulk_write(operations, ordered=False).modified_count
+                _publish_backfilled(written)
+
+            # A batch of retried users alone must not move the checkpoint back
+            resume_after = max(batch[-1]["_id"], resume_after) if resume_after else batch[-1]["_id"]
+            _save_checkpoint(checkpoint_path, resume_after, counts, retry_ids)
+            elapsed = time.perf_counter() - started
+            done = counts["updated"] + counts["failed"] + counts["missing"]
+            print(f"Backfill: {counts['updated']} updated, {counts['failed']} failed, "
+                  f"{counts['missing']} missing, {done / elapsed:.1f} users/s")
+            batch = list(itertools.islice(cursor, batch_size))
+
+    print(f"Backfill finished: {counts['updated']} updated, {counts['failed']} failed, "
+          f"{counts['missing']} missing in {time.perf_counter() - started:.0f}s")
+    return counts
+
+
+def repack_encodings(batch_size=1000):
+    """Rewrite encodings stored as BSON arrays of doubles as packed binary (no re-encoding)."""
+    query = {"$or": [{"face_encoding": {"$type": "array"}}, {"face_templates.0": {"$type": "array"}}]}
+    cursor = users_collection.find(query, {"face_encoding": 1, "face_templates": 1}).batch_size(batch_size)
+    updated = 0
+    while True:
+        batch = list(itertools.islice(cursor, batch_size))
+        if not batch:
+            break
+        operations = []
+        for user in batch:
+            fields = {}
+            if isinstance(user.get("face_encoding"), list):
+                fields["face_encoding"] = pack_encoding(user["face_encoding"])
+            templates = user.get("face_templates") or []
+            if any(isinstance(template, list) for template in templates):
+                fields["face_templates"] = [pack_encoding(template) for template in templates]
+            if fields:
+                # Guarded on the old value so a concurrent login or re-capture wins
+                guard = {"_id": user["_id"], **{name: user[name] for name in fields}}
+                operations.append(UpdateOne(guard, {"$set": fields}))
+        if operations:
+            updated += users_collection.bulk_write(operations, ordered=False).modified_count
+        print(f"Repack: {updated} users rewritten")
+    return updated
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Compute stored face encodings for existing users.")
+    parser.add_argument("--limit", type=int, default=None)
+    parser.add_argument("--batch-size", type=int, default=500)
+    parser.add_argument("--fetch-threads", type=int, default=16, help="Concurrent Cloudinary downloads")
+    parser.add_argument("--processes", type=int, default=None, help="Encoding processes (default: all cores)")
+    parser.add_argument("--rate", type=float, default=0.0, help="Max Cloudinary fetches per second (0: unlimited)")
+    parser.add_argument("--checkpoint", default="backfill_checkpoint.json",
+                        help="Progress file used to resume; delete it to start over")
+    parser.add_argument("--repack", action="store_true",
+                        help="Only convert encodings stored as arrays to the packed binary format")
+    args = parser.parse_args()
+    if args.repack:
+        repack_encodings(args.batch_size)
+        return
+    backfill_encodings(args.limit, args.batch_size, args.fetch_threads, args.processes, args.rate, args.checkpoint)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,75 @@
+import os
+import time
+import threading
+from collections import OrderedDict
+
+ENCODING_CACHE_SIZE = int(os.getenv("ENCODING_CACHE_SIZE", "1024"))
+ENCODING_CACHE_TTL = float(os.getenv("ENCODING_CACHE_TTL", "900"))  # seconds
+
+
+class EncodingCache:
+    """Bounded LRU cache of reference encodings with a per-entry TTL.
+
+    Entries are keyed by email and remember the image_url they were computed
+    from; a lookup with a different image_url is a miss, so a face replaced by
+    another worker is never matched against a stale encoding.
+    """
+
+    def __init__(self, max_size=ENCODING_CACHE_SIZE, ttl=ENCODING_CACHE_TTL):
+        self.max_size = max_size
+        self.ttl = ttl
+        self._entries = OrderedDict()  # email -> (image_url, encoding, expires_at)
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get(self, email, image_url):
+        with self._lock:
+            entry = self._entries.get(email)
+            if entry is None:
+                self.misses += 1
+                return None
+            cached_url, encoding, expires_at = entry
+            if cached_url != image_url or expires_at < time.monotonic():
+                del self._entries[email]
+                self.misses += 1
+                return None
+            self._entries.move_to_end(email)
+            self.hits += 1
+            return encoding
+
+    def put(self, email, image_url, encoding):
+        if self.max_size <= 0:
+            return
+        with self._lock:
+            self._entries[email] = (image_url, encoding, time.monotonic() + self.ttl)
+            self._entries.move_to_end(email)
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+                self.evictions += 1
+
+    def invalidate(self, email):
+        with self._lock:
+            self._entries.pop(email, None)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def stats(self):
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                "size": len(self._entries),
+                "max_size": self.max_size,
+                "ttl": self.ttl,
+                "hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+                "hit_rate": self.hits / lookups if lookups else 0.0
+            }
+
+
+# One cache per worker process
+encoding_cache = EncodingCache()
@@ -0,0 +1,162 @@
+"""Webcam capture for /capture_upload_image.
+
+Detection runs on a downscaled frame every CAPTURE_DETECT_EVERY frames; in
+between, an OpenCV tracker follows the face box. Once a face has been held for
+CAPTURE_HOLD_SECONDS the sharpest frame of that window is returned. Any
+cv2.VideoCapture source works, so a recorded video can stand in for the camera:
+
+    python -m face_auth.capture hold_still.mp4 --no-window
+"""
+import argparse
+import os
+import time
+from collections import namedtuple
+import cv2
+from face_auth.preprocess import detect_faces
+
+# Camera index or a file/stream URL
+CAPTURE_SOURCE = os.getenv("CAPTURE_SOURCE", "0")
+CAPTURE_DETECT_EVERY = int(os.getenv("CAPTURE_DETECT_EVERY", "5"))  # frames between detections
+CAPTURE_DETECT_MAX_SIDE = int(os.getenv("CAPTURE_DETECT_MAX_SIDE", "320"))
+CAPTURE_HOLD_SECONDS = float(os.getenv("CAPTURE_HOLD_SECONDS", "3"))
+CAPTURE_MAX_SECONDS = float(os.getenv("CAPTURE_MAX_SECONDS", "30"))  # give up without a steady face
+CAPTURE_SHOW_WINDOW = os.getenv("CAPTURE_SHOW_WINDOW", "true").lower() in ("1", "true", "yes")
+
+CaptureResult = namedtuple("CaptureResult", ["frame", "error", "stats"])
+
+
+def _parse_source(source):
+    return int(source) if str(source).isdigit() else source
+
+
+def _create_tracker():
+    """Return the best tracker this OpenCV build offers, or None (detect-only)."""
+    legacy = getattr(cv2, "legacy", None)
+    for module, name in ((cv2, "TrackerKCF_create"), (legacy, "TrackerKCF_create"),
+                         (cv2, "TrackerCSRT_create"), (legacy, "TrackerCSRT_create"),
+                         (cv2, "TrackerMIL_create")):
+        factory = getattr(module, name, None) if module is not None else None
+        if factory is not None:
+            return factory()
+    return None
+
+
+def sharpness(gray, box):
+    """Variance of the Laplacian inside box (x, y, w, h); higher is sharper."""
+    x, y, w, h = box
+    crop = gray[max(y, 0):y + h, max(x, 0):x + w]
+    return float(cv2.Laplacian(crop, cv2.CV_64F).var()) if crop.size else 0.0
+
+
+def _largest_face(frame):
+    """Detect on a downscaled copy; returns the largest face as (x, y, w, h), or None."""
+    rgb_frame = cv2.cvtColor(frame, cv2.COLOR_BGR2RGB)
+    locations = detect_faces(rgb_frame, max_side=CAPTURE_DETECT_MAX_SIDE)
+    if not locations:
+        return None
+    top, right, bottom, left = max(locations, key=lambda box: (box[2] - box[0]) * (box[1] - box[3]))
+    return left, top, right - left, bottom - top
+
+
+def capture_face(source=CAPTURE_SOURCE, detect_every=CAPTURE_DETECT_EVERY, hold_seconds=CAPTURE_HOLD_SECONDS,
+                 max_seconds=CAPTURE_MAX_SECONDS, show_window=CAPTURE_SHOW_WINDOW):
+    """Capture the sharpest frame of a steady face from a cv2.VideoCapture source.
+
+    Returns a CaptureResult; stats holds frames, fps, detections and the
+    sharpness of the chosen frame.
+    """
+    cap = cv2.VideoCapture(_parse_source(source))
+    if not cap.isOpened():
+        return CaptureResult(None, "Webcam not detected. Please upload an image manually.", {})
+
+    # Recorded video is paced by its own timestamps, not by how fast it can be decoded
+    is_file = not isinstance(_parse_source(source), int)
+    file_fps = cap.get(cv2.CAP_PROP_FPS) or 30.0
+    stats = {"frames": 0, "detections": 0, "fps": 0.0, "sharpness": 0.0}
+    started = time.perf_counter()
+    tracker, box = None, None
+    hold_started, best, best_score = None, None, -1.0
+    error = None
+
+    try:
+        while True:
+            ret, frame = cap.read()
+            if not ret:
+                error = "Failed to capture image"
+                break
+            now = stats["frames"] / file_fps if is_file else time.perf_counter() - started
+            stats["frames"] += 1
+
+            if box is None or tracker is None or stats["frames"] % max(detect_every, 1) == 0:
+                box = _largest_face(frame)
+                stats["detections"] += 1
+                tracker = _create_tracker() if box is not None else None
+                if tracker is not None:
+                    tracker.init(frame, box)
+            else:
+                ok, tracked = tracker.update(frame)
+                box = tuple(int(value) for value in tracked) if ok else None
+
+            if box is None:
+                hold_started, best, best_score = None, None, -1.0  # Reset if face not found
+            else:
+                if hold_started is None:
+                    hold_started = now
+                score = sharpness(cv2.cvtColor(frame, cv2.COLOR_BGR2GRAY), box)
+                if score > best_score:
+                    best, best_score = frame.copy(), score
+                if now - hold_started >= hold_seconds:
+                    break
+
+            if now >= max_seconds:
+                error = "No steady face detected. Please try again or upload an image."
+                break
+
+            if show_window:
+                _draw(frame, box, hold_started, now, hold_seconds)
+                cv2.imshow(f"Face Capture - Hold still for {hold_seconds:g} seconds", frame)
+                if cv2.waitKey(1) & 0xFF == ord('q'):
+                    error = "Face Capture cancelled by user"
+                    break
+    finally:
+        cap.release()
+        if show_window:
+            cv2.destroyAllWindows()
+
+    elapsed = time.perf_counter() - started
+    stats["fps"] = round(stats["frames"] / elapsed, 1) if elapsed else 0.0
+    stats["sharpness"] = round(best_score, 1) if best is not None else 0.0
+    print(f"Capture: {stats['frames']} frames at {stats['fps']} fps, {stats['detections']} detections")
+    return CaptureResult(None if error else best, error, stats)
+
+
+def _draw(frame, box, hold_started, now, hold_seconds):
+    if box is None:
+        cv2.putText(frame, "No face detected!", (50, 50),
+                    cv2.FONT_HERSHEY_SIMPLEX, 1, (0, 0, 255), 2)
+        return
+    x, y, w, h = box
+    padding = 30
+    cv2.rectangle(frame, (x - padding, y - padding), (x + w + padding, y + h + padding), (0, 255, 0), 2)
+    remaining = int(hold_seconds - (now - hold_started)) + 1
+    cv2.putText(frame, f"Hold still... {remaining}", (50, 450),
+                cv2.FONT_HERSHEY_SIMPLEX, 1.5, (255, 255, 0), 3)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("source", nargs="?", default=CAPTURE_SOURCE, help="Camera index or video file")
+    parser.add_argument("--detect-every", type=int, default=CAPTURE_DETECT_EVERY)
+    parser.add_argument("--hold-seconds", type=float, default=CAPTURE_HOLD_SECONDS)
+    parser.add_argument("--no-window", action="store_true", help="Do not open a preview window")
+    parser.add_argument("--output", help="Write the captured frame to this file")
+    args = parser.parse_args()
+
+    result = capture_face(args.source, args.detect_every, args.hold_seconds, show_window=not args.no_window)
+    print(result.stats if result.error is None else f"{result.error} {result.stats}")
+    if args.output and result.frame is not None:
+        cv2.imwrite(args.output, result.frame)
+
+
+if __name__ == '__main__':
+    main()
@@ -1,21 +1,205 @@
-from pymongo import MongoClient
+import pymongo
+from pymongo import MongoClient, monitoring
+from pymongo.errors import ConnectionFailure
 import os
-from dotenv import load_dotenv  # Import load_dotenv from dotenv
+import time
+import types
+import threading
+from face_auth.metrics import MongoCommandTimer, record_outcome
+from face_auth.resilience import mongo_breaker, CircuitOpenError, DeadlineExceeded, DEADLINE_SLACK
+from face_auth.workers import request_deadline
 
-# Load environment variables from .env file
-load_dotenv()  # This will load the variables from .env into the environment
+MONGO_MAX_POOL_SIZE = int(os.getenv("MONGO_MAX_POOL_SIZE", "50"))
+MONGO_MIN_POOL_SIZE = int(os.getenv("MONGO_MIN_POOL_SIZE", "0"))
+MONGO_MAX_IDLE_TIME_MS = int(os.getenv("MONGO_MAX_IDLE_TIME_MS", "300000"))
+MONGO_CONNECT_TIMEOUT_MS = int(os.getenv("MONGO_CONNECT_TIMEOUT_MS", "5000"))
+MONGO_SERVER_SELECTION_TIMEOUT_MS = int(os.getenv("MONGO_SERVER_SELECTION_TIMEOUT_MS", "5000"))
+MONGO_SOCKET_TIMEOUT_MS = int(os.getenv("MONGO_SOCKET_TIMEOUT_MS", "10000"))
+# Client-side budget per operation, the driver's own retry included (0: no limit)
+MONGO_TIMEOUT_MS = int(os.getenv("MONGO_TIMEOUT_MS", "5000"))
 
-def db_connection(db_name=None):
-    """Connect to MongoDB database."""
-    # Fetch the MongoDB URI from environment variables or use a default
-    mongo_uri = os.getenv("MONGO_URI", "mongodb://localhost:27017/")  # Default to local if not set
-    db_name = db_name or os.getenv("MONGO_DB_NAME", "face_auth_data")  # Fetch from env or use default
 
-    client = MongoClient(mongo_uri)
+class PoolStats(monitoring.ConnectionPoolListener):
+    """Counts connection pool events for the process-wide client."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        self.created = 0
+        self.closed = 0
+        self.checked_out = 0
+        self.checked_in = 0
+        self.checkout_failed = 0
+        self.cleared = 0
+
+    def _count(self, name):
+        with self._lock:
+            setattr(self, name, getattr(self, name) + 1)
+
+    def pool_created(self, event):
+        pass
+
+    def pool_ready(self, event):
+        pass
+
+    def pool_cleared(self, event):
+        self._count("cleared")
+
+    def pool_closed(self, event):
+        pass
+
+    def connection_created(self, event):
+        self._count("created")
+
+    def connection_ready(self, event):
+        pass
+
+    def connection_closed(self, event):
+        self._count("closed")
+
+    def connection_check_out_started(self, event):
+        pass
+
+    def connection_check_out_failed(self, event):
+        self._count("checkout_failed")
+
+    def connection_checked_out(self, event):
+        self._count("checked_out")
+
+    def connection_checked_in(self, event):
+        self._count("checked_in")
+
+    def snapshot(self):
+        with self._lock:
+            return {
+                "max_pool_size": MONGO_MAX_POOL_SIZE,
+                "open": self.created - self.closed,
+                "in_use": self.checked_out - self.checked_in,
+                "created": self.created,
+                "closed": self.closed,
+                "checkouts": self.checked_out,
+                "checkout_failures": self.checkout_failed,
+                "pool_clears": self.cleared
+            }
+
+
+pool_stats = PoolStats()
+
+_client = None
+_client_pid = None
+_client_lock = threading.Lock()
+
 
-    # Print the MongoDB URI
-    print(f"MONGO_URI: {mongo_uri}")
-    print(db_name)
-    # Use the provided db_name or default to 'face_auth_data'
-    db = client[db_name]
-    return db
+def get_client():
+    """Return this process's shared MongoClient, creating it on first use.
+
+    A client inherited through fork (e.g. gunicorn --preload) is never reused
+    by the child; it gets its own client and connection pool.
+    """
+    global _client, _client_pid
+    if _client is not None and _client_pid == os.getpid():
+        return _client
+    with _client_lock:
+        if _client is None or _client_pid != os.getpid():
+            mongo_uri = os.getenv("MONGO_URI", "mongodb://localhost:27017/")  # Default to local if not set
+            pool_stats.reset()
+            _client = MongoClient(
+                mongo_uri,
+                connect=False,  # Connect on first operation, after any fork
+                maxPoolSize=MONGO_MAX_POOL_SIZE,
+                minPoolSize=MONGO_MIN_POOL_SIZE,
+                maxIdleTimeMS=MONGO_MAX_IDLE_TIME_MS,
+                connectTimeoutMS=MONGO_CONNECT_TIMEOUT_MS,
+                serverSelectionTimeoutMS=MONGO_SERVER_SELECTION_TIMEOUT_MS,
+                socketTimeoutMS=MONGO_SOCKET_TIMEOUT_MS,
+                timeoutMS=MONGO_TIMEOUT_MS or None,
+                event_listeners=[pool_stats, MongoCommandTimer()]
+            )
+            _client_pid = os.getpid()
+        return _client
+
+
+def guarded(method):
+    """Wrap a collection method with the Mongo circuit breaker and the request deadline.
+
+    Only connection-level failures (server selection, network errors and
+    timeouts) count against the breaker; the driver already retries reads and
+    writes once, so there is no retry here. A timeout caused by the request's
+    deadline rather than MONGO_TIMEOUT_MS raises DeadlineExceeded and is not
+    counted. Cursors returned by find() are covered for the call itself, not
+    for later iteration.
+    """
+    own_timeout = MONGO_TIMEOUT_MS / 1000 if MONGO_TIMEOUT_MS else None
+
+    def call(*args, **kwargs):
+        deadline = request_deadline.get()
+        remaining = None if deadline is None else deadline - time.time()
+        if remaining is not None and remaining <= 0:
+            raise DeadlineExceeded("mongo: request deadline exceeded")
+        cut_by_request = remaining is not None and (own_timeout is None or remaining < own_timeout)
+        if not mongo_breaker.allow():
+            record_outcome("mongo", "circuit_open")
+            raise CircuitOpenError("MongoDB is unavailable (circuit open)")
+        try:
+            if not cut_by_request:
+                result = method(*args, **kwargs)
+            else:
+                with pymongo.timeout(remaining):
+                    result = method(*args, **kwargs)
+        except ConnectionFailure as e:
+            if cut_by_request and time.time() >= deadline - DEADLINE_SLACK:
+                mongo_breaker.record_abandoned()
+                raise DeadlineExceeded("mongo: request deadline exceeded") from e
+            mongo_breaker.record_failure()
+            raise
+        except Exception:
+            mongo_breaker.record_success()  # The server answered
+            raise
+        mongo_breaker.record_success()
+        return result
+    return call
+
+
+class LazyCollection:
+    """Collection proxy that always resolves against the current process's client.
+
+    Method calls go through guarded(), so they fail fast while MongoDB is down.
+    """
+
+    def __init__(self, db_name, name):
+        self.db_name = db_name
+        self.name = name
+        self._client = None
+        self._collection = None
+
+    def _resolve(self):
+        client = get_client()
+        if self._client is not client:
+            self._collection = client[self.db_name][self.name]
+            self._client = client
+        return self._collection
+
+    def __getattr__(self, attr):
+        value = getattr(self._resolve(), attr)
+        return guarded(value) if isinstance(value, types.MethodType) else value
+
+
+class LazyDatabase:
+    """Database proxy handing out LazyCollection objects."""
+
+    def __init__(self, name):
+        self.name = name
+
+    def __getitem__(self, collection_name):
+        return LazyCollection(self.name, collection_name)
+
+    def __getattr__(self, attr):
+        return getattr(get_client()[self.name], attr)
+
+
+def db_connection(db_name=None):
+    """Return the MongoDB database, backed by the shared per-process client."""
+    db_name = db_name or os.getenv("MONGO_DB_NAME", "face_auth_data")  # Fetch from env or use default
+    return LazyDatabase(db_name)
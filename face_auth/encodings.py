@@ -0,0 +1,131 @@
+import os
+import cv2
+import numpy as np
+from bson.binary import Binary
+
+# Bump FACE_ENCODING_VERSION (or change the model settings) to invalidate every stored encoding
+ENCODING_VERSION = int(os.getenv("FACE_ENCODING_VERSION", "1"))
+ENCODING_MODEL = os.getenv("FACE_ENCODING_MODEL", "small")  # dlib landmark model: "small" or "large"
+ENCODING_JITTERS = int(os.getenv("FACE_ENCODING_JITTERS", "1"))
+# Number of recent login encodings kept per user as extra references
+TEMPLATE_COUNT = int(os.getenv("FACE_TEMPLATE_COUNT", "5"))
+# How new encodings are packed: "float32" (512 bytes), "float16" (256) or "int8" (132, quantised)
+ENCODING_STORAGE = os.getenv("FACE_ENCODING_STORAGE", "float32")
+
+ENCODING_SIZE = 128
+# Packed encodings are self-describing by length, so formats can be mixed in one collection
+_FLOAT32_BYTES = ENCODING_SIZE * 4
+_FLOAT16_BYTES = ENCODING_SIZE * 2
+_INT8_BYTES = 4 + ENCODING_SIZE  # float32 scale + one signed byte per dimension
+
+
+def encoding_signature():
+    """Identify the settings an encoding was computed with, e.g. 'v1:small:j1'."""
+    return f"v{ENCODING_VERSION}:{ENCODING_MODEL}:j{ENCODING_JITTERS}"
+
+
+def compute_face_encoding(rgb_image, face_locations=None):
+    """Return the 128-d encoding of the first face in an RGB image, or None."""
+    import face_recognition  # Loads the dlib models; deferred until an encoding is needed
+    if face_locations is not None:
+        face_locations = face_locations[:1]
+    encodings = face_recognition.face_encodings(
+        rgb_image,
+        known_face_locations=face_locations,
+        num_jitters=ENCODING_JITTERS,
+        model=ENCODING_MODEL
+    )
+    return encodings[0] if encodings else None
+
+
+def compute_bgr_face_encoding(bgr_image):
+    """Same as compute_face_encoding for OpenCV (BGR) images such as Cloudinary downloads."""
+    rgb_image = cv2.cvtColor(bgr_image, cv2.COLOR_BGR2RGB)
+    return compute_face_encoding(rgb_image)
+
+
+def pack_encoding(encoding, storage=None):
+    """Pack an encoding into little-endian bytes for a BSON binary field."""
+    storage = storage or ENCODING_STORAGE
+    vector = np.asarray(encoding, dtype=np.float32)
+    if storage == "float16":
+        return Binary(vector.astype("<f2").tobytes())
+    if storage == "int8":
+        # Symmetric per-vector quantisation: the scale maps the largest component to +/-127
+        scale = np.float32(max(float(np.abs(vector).max()), 1e-12) / 127)
+        quantised = np.clip(np.rint(vector / scale), -127, 127).astype(np.int8)
+        return Binary(np.array([scale], dtype="<f4").tobytes() + quantised.tobytes())
+    return Binary(vector.astype("<f4").tobytes())
+
+
+def unpack_encoding(stored):
+    """Return a stored encoding (packed bytes, or a legacy list of doubles) as a float32 vector.
+
+    float32 data is returned as a zero-copy, read-only view of the stored bytes.
+    """
+    if isinstance(stored, (list, tuple)):
+        return np.asarray(stored, dtype=np.float32)
+    size = len(stored)
+    if size == _FLOAT32_BYTES:
+        return np.frombuffer(stored, dtype="<f4")
+    if size == _FLOAT16_BYTES:
+        return np.frombuffer(stored, dtype="<f2").astype(np.float32)
+    if size == _INT8_BYTES:
+        scale = np.frombuffer(stored, dtype="<f4", count=1)[0]
+        return np.frombuffer(stored, dtype=np.int8, offset=4).astype(np.float32) * scale
+    raise ValueError(f"Unrecognised packed encoding of {size} bytes")
+
+
+def encoding_fields(encoding, image_url):
+    """Mongo fields to $set so the encoding is stored alongside the image it came from."""
+    return {
+        "face_encoding": pack_encoding(encoding),
+        "encoding_version": encoding_signature(),
+        "encoding_image_url": image_url
+    }
+
+
+def image_update(image_url, encoding=None):
+    """Mongo update that points the user at a new image, with its encoding if a face was found.
+
+    Login templates were matched against the previous image, so they are dropped.
+    """
+    update = {"$set": {"image_url": image_url}, "$unset": {"face_templates": "", "templates_version": ""}}
+    if encoding is not None:
+        update["$set"].update(encoding_fields(encoding, image_url))
+    else:
+        update["$unset"]["face_encoding"] = ""
+    return update
+
+
+def get_stored_encoding(user):
+    """Return the user's stored encoding as a float32 vector, or None if missing or stale.
+
+    An encoding is stale when it was computed with other settings or from an image
+    other than the user's current image_url.
+    """
+    stored = user.get("face_encoding")
+    if stored is None or len(stored) == 0:
+        return None
+    if user.get("encoding_version") != encoding_signature():
+        return None
+    if user.get("encoding_image_url") != user.get("image_url"):
+        return None
+    return unpack_encoding(stored)
+
+
+def get_stored_templates(user):
+    """Return the user's recent login encodings as a list of float32 vectors (may be empty)."""
+    templates = user.get("face_templates") or []
+    if user.get("templates_version") != encoding_signature():
+        return []
+    return [unpack_encoding(template) for template in templates]
+
+
+def template_update(user, encoding):
+    """Mongo update that appends encoding to the user's rolling template set."""
+    values = pack_encoding(encoding)
+    if user.get("templates_version") != encoding_signature():
+        # Templates from other settings can't be compared; start a fresh set
+        return {"$set": {"face_templates": [values], "templates_version": encoding_signature()}}
+    return {"$push": {"face_templates": {"$each": [values], "$slice": -TEMPLATE_COUNT}}}
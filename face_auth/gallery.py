@@ -0,0 +1,238 @@
+import argparse
+import os
+import threading
+import time
+import numpy as np
+from face_auth.encodings import ENCODING_SIZE, encoding_signature, get_stored_encoding
+
+IDENTIFY_THRESHOLD = float(os.getenv("IDENTIFY_THRESHOLD", "0.4"))
+# "hnsw" enables the approximate index once the gallery reaches GALLERY_ANN_MIN_SIZE users
+GALLERY_ANN = os.getenv("GALLERY_ANN", "").lower()
+GALLERY_ANN_MIN_SIZE = int(os.getenv("GALLERY_ANN_MIN_SIZE", "50000"))
+# Optional .npz snapshot: loaded instead of scanning Mongo when present, written after a scan
+GALLERY_SNAPSHOT = os.getenv("GALLERY_SNAPSHOT", "")
+
+try:
+    import hnswlib
+except ImportError:  # Optional: only needed for the approximate index
+    hnswlib = None
+
+
+class GalleryIndex:
+    """In-memory matrix of every stored encoding for 1:N identification.
+
+    Rows live in a preallocated float32 matrix that doubles as it fills up;
+    removed rows are masked out and reused by later additions. Search is a
+    single vectorised distance computation over the matrix, or an HNSW query
+    when the approximate index is enabled.
+    """
+
+    def __init__(self, capacity=1024, ann=GALLERY_ANN, ann_min_size=GALLERY_ANN_MIN_SIZE):
+        self._matrix = np.zeros((capacity, ENCODING_SIZE), dtype=np.float32)
+        self._valid = np.zeros(capacity, dtype=bool)
+        self._emails = [None] * capacity
+        self._rows = {}  # email -> row
+        self._free = []
+        self._size = 0  # rows in use, including freed ones
+        self._lock = threading.RLock()
+        self._ann_enabled = ann == "hnsw"
+        self._ann_min_size = ann_min_size
+        self._ann = None
+        if self._ann_enabled and hnswlib is None:
+            print("GALLERY_ANN=hnsw but hnswlib is not installed; using exact search")
+            self._ann_enabled = False
+
+    def __len__(self):
+        return len(self._rows)
+
+    def _grow(self):
+        capacity = self._matrix.shape[0] * 2
+        matrix = np.zeros((capacity, ENCODING_SIZE), dtype=np.float32)
+        matrix[:self._size] = self._matrix[:self._size]
+        valid = np.zeros(capacity, dtype=bool)
+        valid[:self._size] = self._valid[:self._size]
+        self._matrix, self._valid = matrix, valid
+        self._emails.extend([None] * (capacity - len(self._emails)))
+        if self._ann is not None:
+            self._ann.resize_index(capacity)
+
+    def _build_ann(self):
+        capacity = self._matrix.shape[0]
+        index = hnswlib.Index(space="l2", dim=ENCODING_SIZE)
+        index.init_index(max_elements=capacity, ef_construction=200, M=16)
+        index.set_ef(64)
+        rows = np.flatnonzero(self._valid[:self._size])
+        if len(rows):
+            index.add_items(self._matrix[rows], rows)
+        self._ann = index
+
+    def add(self, email, encoding):
+        """Insert or replace the encoding for email."""
+        vector = np.asarray(encoding, dtype=np.float32)
+        with self._lock:
+            row = self._rows.get(email)
+            if row is None:
+                if self._free:
+                    row = self._free.pop()
+                else:
+                    if self._size == self._matrix.shape[0]:
+                        self._grow()
+                    row = self._size
+                    self._size += 1
+                self._rows[email] = row
+                self._emails[row] = email
+            self._matrix[row] = vector
+            self._valid[row] = True
+            if self._ann is not None:
+                self._ann.add_items(vector[np.newaxis, :], [row])
+            elif self._ann_enabled and len(self._rows) >= self._ann_min_size:
+                self._build_ann()
+
+    def add_many(self, emails, matrix):
+        """Bulk insert (or replace) rows; much faster than add() for loading a whole gallery."""
+        matrix = np.asarray(matrix, dtype=np.float32).reshape(-1, ENCODING_SIZE)
+        with self._lock:
+            if self._ann is not None or any(email in self._rows for email in emails):
+                for email, vector in zip(emails, matrix):
+                    self.add(email, vector)
+                return
+            while self._size + len(emails) > self._matrix.shape[0]:
+                self._grow()
+            start, end = self._size, self._size + len(emails)
+            self._matrix[start:end] = matrix
+            self._valid[start:end] = True
+            self._emails[start:end] = emails
+            self._rows.update(zip(emails, range(start, end)))
+            self._size = end
+            if self._ann_enabled and len(self._rows) >= self._ann_min_size:
+                self._build_ann()
+
+    def remove(self, email):
+        with self._lock:
+            row = self._rows.pop(email, None)
+            if row is None:
+                return
+            self._valid[row] = False
+            self._emails[row] = None
+            self._free.append(row)
+            if self._ann is not None:
+                self._ann.mark_deleted(row)
+
+    def search(self, encoding, k=5, threshold=IDENTIFY_THRESHOLD):
+        """Return up to k (email, distance) pairs closest to encoding, nearest first."""
+        probe = np.asarray(encoding, dtype=np.float32)
+        with self._lock:
+            if not self._rows:
+                return []
+            k = min(k, len(self._rows))
+            if self._ann is not None:
+                labels, squared = self._ann.knn_query(probe, k=k)
+                rows, distances = labels[0], np.sqrt(squared[0])
+            else:
+                distances = np.linalg.norm(self._matrix[:self._size] - probe, axis=1)
+                distances[~self._valid[:self._size]] = np.inf
+                rows = np.argpartition(distances, k - 1)[:k]
+                rows = rows[np.argsort(distances[rows])]
+                distances = distances[rows]
+            return [
+                (self._emails[row], float(distance))
+                for row, distance in zip(rows, distances)
+                if distance <= threshold and self._emails[row] is not None
+            ]
+
+    def stats(self):
+        with self._lock:
+            return {
+                "size": len(self._rows),
+                "capacity": self._matrix.shape[0],
+                "ann": self._ann is not None
+            }
+
+    def save_snapshot(self, path):
+        """Write the live rows to an .npz file (written to a temp file, then renamed)."""
+        with self._lock:
+            rows = np.flatnonzero(self._valid[:self._size])
+            matrix = self._matrix[rows]
+            emails = np.array([self._emails[row] for row in rows], dtype=str)
+        tmp_path = f"{path}.tmp.npz"
+        np.savez(tmp_path, matrix=matrix, emails=emails, signature=encoding_signature())
+        os.replace(tmp_path, path)
+
+    def load_snapshot(self, path):
+        """Add the rows of a snapshot written by save_snapshot. Returns False if it is unusable."""
+        with np.load(path) as snapshot:
+            if str(snapshot["signature"]) != encoding_signature():
+                print(f"Ignoring gallery snapshot {path}: made with another encoding model")
+                return False
+            self.add_many(snapshot["emails"].tolist(), snapshot["matrix"])
+        return True
+
+
+def build_gallery(collection, index=None, batch_size=5000):
+    """Load every user with a current stored encoding into the index.
+
+    Rows are collected into batches and added with add_many; packed encodings
+    are read with np.frombuffer, so no per-element Python conversion is done.
+    """
+    index = gallery if index is None else index
+    started = time.perf_counter()
+    cursor = collection.find(
+        {"face_encoding": {"$exists": True}},
+        {"email": 1, "image_url": 1, "face_encoding": 1, "encoding_version": 1, "encoding_image_url": 1}
+    ).batch_size(batch_size)
+    emails, vectors = [], []
+    for user in cursor:
+        encoding = get_stored_encoding(user)
+        if encoding is not None:
+            emails.append(user["email"])
+            vectors.append(encoding)
+        if len(emails) == batch_size:
+            index.add_many(emails, np.vstack(vectors))
+            emails, vectors = [], []
+    if emails:
+        index.add_many(emails, np.vstack(vectors))
+    print(f"Gallery loaded with {len(index)} encodings in {time.perf_counter() - started:.1f}s")
+    return index
+
+
+# One gallery per worker process; updated in place on register, login and re-capture
+gallery = GalleryIndex()
+_gallery_loaded = False
+_gallery_load_lock = threading.Lock()
+
+
+def ensure_gallery_loaded(collection):
+    """Build the gallery the first time it is needed in this process.
+
+    With GALLERY_SNAPSHOT set, an existing snapshot file is loaded instead of
+    scanning Mongo. It is a point-in-time copy: users enrolled by other workers
+    after it was written are only seen once the snapshot is deleted or rewritten.
+    """
+    global _gallery_loaded
+    if _gallery_loaded:
+        return gallery
+    with _gallery_load_lock:
+        if not _gallery_loaded:
+            if not (GALLERY_SNAPSHOT and os.path.exists(GALLERY_SNAPSHOT)
+                    and gallery.load_snapshot(GALLERY_SNAPSHOT)):
+                build_gallery(collection)
+                if GALLERY_SNAPSHOT:
+                    gallery.save_snapshot(GALLERY_SNAPSHOT)
+            else:
+                print(f"Gallery loaded with {len(gallery)} encodings from {GALLERY_SNAPSHOT}")
+            _gallery_loaded = True
+    return gallery
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Write a gallery snapshot from the users collection.")
+    parser.add_argument("path", nargs="?", default=GALLERY_SNAPSHOT or "gallery_snapshot.npz")
+    args = parser.parse_args()
+    from face_auth.utils import users_collection
+    index = build_gallery(users_collection, GalleryIndex(ann=""))
+    index.save_snapshot(args.path)
+    print(f"Snapshot of {len(index)} encodings written to {args.path}")
+
+
+if __name__ == '__main__':
+    main()
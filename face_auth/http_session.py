@@ -0,0 +1,71 @@
+import os
+import threading
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+HTTP_POOL_SIZE = int(os.getenv("HTTP_POOL_SIZE", "20"))
+HTTP_RETRIES = int(os.getenv("HTTP_RETRIES", "3"))
+HTTP_BACKOFF = float(os.getenv("HTTP_BACKOFF", "0.3"))  # seconds, doubled per retry
+HTTP_TIMEOUT = float(os.getenv("HTTP_TIMEOUT", "10"))  # seconds
+
+_session = None
+_session_pid = None
+_session_lock = threading.Lock()
+_stats_lock = threading.Lock()
+_stats = {"requests": 0, "errors": 0}
+
+
+def get_http_session():
+    """Return this process's keep-alive session with pooled connections and retry/backoff."""
+    global _session, _session_pid
+    if _session is not None and _session_pid == os.getpid():
+        return _session
+    with _session_lock:
+        if _session is None or _session_pid != os.getpid():
+            retry = Retry(
+                total=HTTP_RETRIES,
+                backoff_factor=HTTP_BACKOFF,
+                status_forcelist=(429, 500, 502, 503, 504),
+                allowed_methods=frozenset(["GET", "HEAD"])
+            )
+            adapter = HTTPAdapter(pool_connections=HTTP_POOL_SIZE, pool_maxsize=HTTP_POOL_SIZE,
+                                  max_retries=retry)
+            session = requests.Session()
+            session.mount("https://", adapter)
+            session.mount("http://", adapter)
+            _session = session
+            _session_pid = os.getpid()
+        return _session
+
+
+def http_get(url, timeout=HTTP_TIMEOUT, **kwargs):
+    """GET through the shared session, counting requests and errors for http_stats()."""
+    with _stats_lock:
+        _stats["requests"] += 1
+    try:
+        return get_http_session().get(url, timeout=timeout, **kwargs)
+    except requests.RequestException:
+        with _stats_lock:
+            _stats["errors"] += 1
+        raise
+
+
+def http_stats():
+    session = _session if _session_pid == os.getpid() else None
+    pools = []
+    if session is not None:
+        # Both schemes share one adapter
+        adapters = {id(adapter): adapter for adapter in session.adapters.values()}
+        for adapter in adapters.values():
+            container = adapter.poolmanager.pools
+            for key in container.keys():
+                pool = container.get(key)
+                if pool is not None:
+                    pools.append({
+                        "host": pool.host,
+                        "connections_created": pool.num_connections,
+                        "requests": pool.num_requests
+                    })
+    with _stats_lock:
+        return {"pool_size": HTTP_POOL_SIZE, **_stats, "pools": pools}
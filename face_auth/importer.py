@@ -0,0 +1,231 @@
+"""Bulk enrollment: stream a folder, zip archive or CSV manifest of faces into the user store.
+
+    python -m face_auth.importer photos/                    # files named <email>.jpg
+    python -m face_auth.importer staff.zip --manifest staff.csv
+    python -m face_auth.importer staff.csv --report import_report.csv
+
+A manifest is a CSV with columns email, name, mobile and image (a path
+relative to the source folder, to the manifest's own folder when the manifest
+is the source, or to the archive root). Without one, every image
+is enrolled under its file name (``alice@example.com.jpg``).
+
+Records are processed in chunks: users that already exist are skipped (so an
+interrupted import can simply be re-run), faces are detected and encoded in
+a process pool across all cores, images are uploaded to Cloudinary
+concurrently and each chunk is written with one unordered bulk_write.
+Imported encodings are published to the shared store (when SHARED_STORE_DIR
+is set), so running workers can identify the new users at once.
+Every record gets a line in the report CSV.
+"""
+import argparse
+import csv
+import os
+import time
+import zipfile
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from pymongo import UpdateOne
+from pymongo.errors import BulkWriteError
+from face_auth.encodings import encoding_fields
+from face_auth.shared_store import publish_encoding
+from face_auth.utils import get_device_mac, upload_to_cloudinary, users_collection
+from face_auth.workers import warm_up_models
+from face_auth.resilience import CircuitOpenError, DeadlineExceeded
+
+CLOUDINARY_FOLDER = os.getenv("CLOUDINARY_FOLDER", "face_recognition")
+IMAGE_EXTENSIONS = (".jpg", ".jpeg", ".png")
+
+
+# ---- Record sources ----
+
+def _record(email, name, mobile, image, read):
+    return {"email": email.strip(), "name": name or email.split("@")[0],
+            "mobile": mobile or "", "image": image, "read": read}
+
+
+def _read_file(path):
+    def read():
+        with open(path, "rb") as f:
+            return f.read()
+    return read
+
+
+def _read_member(archive, member):
+    return lambda: archive.read(member)
+
+
+def iter_records(source, manifest=None):
+    """Yield records (email, name, mobile, image, read()) from a folder, zip or CSV manifest."""
+    if manifest is None and source.lower().endswith(".csv"):
+        manifest, source = source, os.path.dirname(os.path.abspath(source))
+    archive = zipfile.ZipFile(source) if os.path.isfile(source) and zipfile.is_zipfile(source) else None
+
+    if manifest is not None:
+        with open(manifest, newline="") as f:
+            for row in csv.DictReader(f):
+                image = row.get("image", "")
+                read = (_read_member(archive, image) if archive is not None
+                        else _read_file(os.path.join(source, image)))
+                yield _record(row.get("email", ""), row.get("name"), row.get("mobile"), image, read)
+        return
+
+    if archive is not None:
+        for member in archive.namelist():
+            if member.lower().endswith(IMAGE_EXTENSIONS):
+                email = os.path.splitext(os.path.basename(member))[0]
+                yield _record(email, None, None, member, _read_member(archive, member))
+        return
+
+    for root, _, files in os.walk(source):
+        for filename in sorted(files):
+            if filename.lower().endswith(IMAGE_EXTENSIONS):
+                path = os.path.join(root, filename)
+                yield _record(os.path.splitext(filename)[0], None, None, path, _read_file(path))
+
+
+def _chunks(records, size):
+    chunk = []
+    for record in records:
+        chunk.append(record)
+        if len(chunk) == size:
+            yield chunk
+            chunk = []
+    if chunk:
+        yield chunk
+
+
+# ---- Pool task ----
+
+def _prepare(data):
+    """Decode, resize and encode one image (runs in the process pool).
+
+    Returns (jpeg_bytes, encoding, error).
+    """
+    from face_auth.preprocess import decode_upload, detect_and_encode
+    from face_auth.utils import resize_image, encode_jpeg
+    image = resize_image(decode_upload(data))
+    if image is None:
+        return None, None, "invalid_image"
+    result = detect_and_encode(image)
+    if result.encoding is None:
+        return None, None, "no_face"
+    return encode_jpeg(image), result.encoding, None
+
+
+# ---- Import ----
+
+def import_users(records, report_path, chunk_size=200, processes=None, upload_concurrency=16):
+    counts = {"imported": 0, "skipped": 0, "failed": 0}
+    started = time.perf_counter()
+    mac_address = get_device_mac()
+
+    with open(report_path, "a", newline="") as report_file, \
+            ProcessPoolExecutor(max_workers=processes, initializer=warm_up_models) as encoders, \
+            ThreadPoolExecutor(max_workers=upload_concurrency) as uploaders:
+        report = csv.writer(report_file)
+        if report_file.tell() == 0:
+            report.writerow(["email", "image", "status", "error"])
+
+        for chunk in _chunks(records, chunk_size):
+            # Resume: users already in the store were imported by an earlier run
+            emails = [record["email"] for record in chunk]
+            existing = {user["email"] for user in users_collection.find({"email": {"$in": emails}}, {"email": 1})}
+            todo, seen = [], set()
+            for record in chunk:
+                if not record["email"] or "@" not in record["email"]:
+                    report.writerow([record["email"], record["image"], "failed", "invalid_email"])
+                    counts["failed"] += 1
+                elif record["email"] in existing or record["email"] in seen:
+                    report.writerow([record["email"], record["image"], "skipped", "already_registered"])
+                    counts["skipped"] += 1
+                else:
+                    seen.add(record["email"])
+                    todo.append(record)
+
+            def read(record):
+                try:
+                    return record["read"]()
+                except (OSError, KeyError) as e:
+                    record["error"] = f"unreadable: {e}"
+                    return b""
+
+            prepared = list(encoders.map(_prepare, [read(record) for record in todo], chunksize=4))
+            uploads = {}
+            for record, (jpeg, encoding, error) in zip(todo, prepared):
+                if error:
+                    record["error"] = record.get("error") or error
+                else:
+                    record["encoding"] = encoding
+                    uploads[record["email"]] = uploaders.submit(upload_to_cloudinary, jpeg, CLOUDINARY_FOLDER)
+
+            operations, written = [], []
+            for record in todo:
+                future = uploads.get(record["email"])
+                try:
+                    url = future.result() if future is not None else None
+                except (CircuitOpenError, DeadlineExceeded) as e:
+                    url, record["error"] = None, f"upload_failed: {e}"
+                if future is not None and not url:
+                    record["error"] = record.get("error") or "upload_failed"
+                if record.get("error"):
+                    report.writerow([record["email"], record["image"], "failed", record["error"]])
+                    counts["failed"] += 1
+                    continue
+                record["url"] = url
+                operations.append(UpdateOne(
+                    {"email": record["email"]},
+                    {"$setOnInsert": {
+                        "name": record["name"],
+                        "email": record["email"],
+                        "mobile": record["mobile"],
+                        "mac_address": mac_address,
+                        "image_url": url,
+                        **encoding_fields(record["encoding"], url)
+                    }},
+                    upsert=True
+                ))
+                written.append(record)
+
+            # Upserts only insert; a user registered meanwhile via /register is left untouched
+            upserted, errors = set(), {}
+            if operations:
+                try:
+                    upserted = set(users_collection.bulk_write(operations, ordered=False).upserted_ids)
+                except BulkWriteError as e:
+                    upserted = {item["index"] for item in e.details.get("upserted", [])}
+                    errors = {item["index"]: item.get("errmsg", "write_error") for item in e.details["writeErrors"]}
+            for index, record in enumerate(written):
+                if index in upserted:
+                    publish_encoding(record["email"], record["encoding"], record["url"])
+                    report.writerow([record["email"], record["image"], "imported", ""])
+                    counts["imported"] += 1
+                elif index in errors:
+                    report.writerow([record["email"], record["image"], "failed", errors[index]])
+                    counts["failed"] += 1
+                else:
+                    report.writerow([record["email"], record["image"], "skipped", "already_registered"])
+                    counts["skipped"] += 1
+            report_file.flush()
+
+            elapsed = time.perf_counter() - started
+            done = sum(counts.values())
+            print(f"{done} records ({counts['imported']} imported, {counts['skipped']} skipped, "
+                  f"{counts['failed']} failed) in {elapsed:.0f}s, {done / elapsed:.1f} records/s")
+    return counts
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("source", help="Folder, .zip archive or CSV manifest")
+    parser.add_argument("--manifest", help="CSV manifest (email,name,mobile,image) for a folder or archive")
+    parser.add_argument("--report", default="import_report.csv", help="Per-record result CSV (appended to)")
+    parser.add_argument("--chunk-size", type=int, default=200)
+    parser.add_argument("--processes", type=int, default=None, help="Encoding processes (default: all cores)")
+    parser.add_argument("--upload-concurrency", type=int, default=16)
+    args = parser.parse_args()
+
+    import_users(iter_records(args.source, args.manifest), args.report, args.chunk_size,
+                 args.processes, args.upload_concurrency)
+
+
+if __name__ == '__main__':
+    main()
@@ -1,119 +1,263 @@
-import cv2
 import os
-import face_recognition
-from face_auth.utils import get_device_mac, get_cloudinary_image, users_collection,upload_to_cloudinary, delete_cloudinary_image
-from dotenv import load_dotenv
+import time
+import threading
+import contextvars
+import numpy as np
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED, TimeoutError as FutureTimeoutError
+from face_auth.utils import get_device_mac, users_collection,upload_to_cloudinary, delete_cloudinary_image
+from face_auth.encodings import image_update, get_stored_encoding, get_stored_templates, template_update, TEMPLATE_COUNT
+from face_auth.workers import submit_encode_image, face_task_result, FacePoolError, FACE_POOL_TIMEOUT
+from face_auth.preprocess import log_timings
+from face_auth.metrics import observe_timings, record_outcome, MATCH_DISTANCE
+from face_auth.backfill import backfill_user_encoding
+from face_auth.cache import encoding_cache
+from face_auth.gallery import gallery
+from face_auth.users import find_user
+from face_auth.outbox import enqueue_archive
+from face_auth.quality import check_quality
+from face_auth.resilience import CircuitOpenError, DeadlineExceeded, remaining_time
+from face_auth.shared_store import lookup_encoding, publish_encoding
 
-load_dotenv()
 CLOUDINARY_FOLDER = os.getenv("CLOUDINARY_FOLDER", "face_recognition")
+# "template": add the login encoding to the user's rolling templates (no Cloudinary calls)
+# "image": legacy mode, replace the stored Cloudinary image on every login
+LOGIN_REFRESH_MODE = os.getenv("LOGIN_REFRESH_MODE", "template")
+ARCHIVE_LOGIN_IMAGES = os.getenv("ARCHIVE_LOGIN_IMAGES", "false").lower() in ("1", "true", "yes")
+# Largest face distance accepted as the same person; calibrate with benchmarks/model_calibration.py
+MATCH_THRESHOLD = float(os.getenv("FACE_MATCH_THRESHOLD", "0.4"))
+# Threads downloading and encoding reference images while the probe is being encoded
+LOGIN_FETCH_THREADS = int(os.getenv("LOGIN_FETCH_THREADS", "8"))
 
-def login_user(email, image_path=None):
+_fetch_executor = None
+_fetch_executor_pid = None
+_fetch_executor_lock = threading.Lock()
+
+
+def _get_fetch_executor():
+    """Return this process's reference-fetch thread pool (threads do not survive a fork)."""
+    global _fetch_executor, _fetch_executor_pid
+    with _fetch_executor_lock:
+        if _fetch_executor is None or _fetch_executor_pid != os.getpid():
+            _fetch_executor = ThreadPoolExecutor(max_workers=LOGIN_FETCH_THREADS,
+                                                 thread_name_prefix="login-fetch")
+            _fetch_executor_pid = os.getpid()
+        return _fetch_executor
+
+
+def load_references(user, email, cloudinary_url):
+    """Return (references, error): the user's reference encodings stacked into a matrix.
+
+    The image encoding comes from the shared store, else the user document; it
+    is computed and stored once for users that lack it, which downloads the
+    Cloudinary image. The result is cached.
+    """
+    cloudinary_encoding = lookup_encoding(email, cloudinary_url)
+    if cloudinary_encoding is None:
+        cloudinary_encoding = get_stored_encoding(user)
+    if cloudinary_encoding is None:
+        cloudinary_encoding, error = backfill_user_encoding(user)
+        if cloudinary_encoding is None:
+            return None, error
+    references = np.vstack([cloudinary_encoding] + get_stored_templates(user))
+    encoding_cache.put(email, cloudinary_url, references)
+    return references, None
+
+
+def login_response(user, email, mac_address, image_url):
+    return {
+        "message": "Login successful",
+        "Status": "True",
+        "data": [
+            {
+                "_id": str(user.get("_id", "")),
+                "firstName": user.get("firstName", ""),
+                "lastName": user.get("lastName", ""),
+                "companyId": user.get("companyId", ""),
+                "companyName": user.get("companyName", ""),
+                "designation": user.get("designation", ""),
+                "email": email,
+                "phone": user.get("phone", ""),
+                "status": user.get("status", ""),
+                "role": user.get("role", ""),
+                "isNewUser": user.get("isNewUser", ""),
+                "token": user.get("token", ""),
+                "dailyTotalWorkingHour": user.get("dailyTotalWorkingHour", ""),
+                "weeklyTotalWorkingHour": user.get("weeklyTotalWorkingHour", ""),
+                "requiresPasswordReset": user.get("requiresPasswordReset", ""),
+                "empCode": user.get("empCode", ""),
+                "name": user.get("name", ""),
+                "mobile": user.get("mobile", ""),
+                "device_mac": mac_address,
+                "image_url": image_url,
+            }
+        ]
+    }
+
+
+def login_user(email, image=None, timings=None, user=None):
+    """Verify an already decoded OpenCV (BGR) probe image against the user's stored face.
+
+    Pass the user document if the caller already fetched it (with LOGIN_PROJECTION)
+    to avoid a second lookup. Per-stage timings are added to the timings dict (if
+    given) and logged.
+    """
+    timings = {} if timings is None else timings
     try:
         # Get Device MAC and IP Address
         mac_address = get_device_mac()
 
-        # **Fetch stored user details from MongoDB**
-        user = users_collection.find_one({"email": email})
+        # **Fetch stored user details from MongoDB, unless the caller already did**
+        if user is None:
+            user = find_user(email)
 
         if user is None:
+            record_outcome("login", "user_not_found")
             return {"error": "User not found", "Status": "False"}
 
-        stored_mac = user["mac_address"]
+        stored_mac = user.get("mac_address")
         cloudinary_url = user.get("image_url")  # Get image URL from Cloudinary
 
-        # **Fetch the Cloudinary image**
-        cloudinary_image = get_cloudinary_image(cloudinary_url) if cloudinary_url else None
-
         # **Check if User Has an Image in Database**
-
-        if not cloudinary_url or cloudinary_image is None:
+        if not cloudinary_url:
+            record_outcome("login", "no_image")
             return {
                 "error": "User image not found. Please capture/upload an image.",
                 "capture_api": "/api/capture_upload_image",  # API for capturing & uploading
                 "Status": "False"
             }
-        # Convert Cloudinary image to face encoding
 
-        cloudinary_rgb = cv2.cvtColor(cloudinary_image, cv2.COLOR_BGR2RGB)
-        cloudinary_encoding = face_recognition.face_encodings(cloudinary_rgb)
+        # **Reject blurry, dark, tiny or multi-face probes before any dlib work**
+        rejection = check_quality("login", image, timings)
+        if rejection is not None:
+            record_outcome("login", rejection["error_code"])
+            return rejection
+
+        # **Use the cached or stored reference encodings**
+        references = encoding_cache.get(email, cloudinary_url)
+        if references is None and (lookup_encoding(email, cloudinary_url) is not None
+                                   or get_stored_encoding(user) is not None):
+            references, _ = load_references(user, email, cloudinary_url)
 
-        if len(cloudinary_encoding) == 0:
-            return {"error": "No face detected in Cloudinary image","Status": "False"}
+        # **Without one, download and encode the Cloudinary image while the probe is encoded**
+        reference_future = None
+        if references is None:
+            # The copied context carries the request deadline into the fetch thread
+            reference_future = _get_fetch_executor().submit(
+                contextvars.copy_context().run, load_references, user, email, cloudinary_url)
+        started = time.monotonic()
+        try:
+            probe_future = submit_encode_image(image)
+        except FacePoolError:
+            if reference_future is not None:
+                reference_future.cancel()
+            raise
 
-        cloudinary_encoding = cloudinary_encoding[0]  # Get first face encoding
+        if reference_future is not None:
+            # A missing reference fails the login whatever the probe holds, so stop waiting for it
+            wait([reference_future, probe_future], timeout=FACE_POOL_TIMEOUT, return_when=FIRST_COMPLETED)
+            if reference_future.done():
+                references, error = reference_future.result()
+                if references is None:
+                    probe_future.cancel()
+                    record_outcome("login", "no_reference")
+                    return error
 
-        image = face_recognition.load_image_file(image_path)
-        encoding = face_recognition.face_encodings(image)
+        try:
+            result = face_task_result(probe_future, max(FACE_POOL_TIMEOUT - (time.monotonic() - started), 0))
+        except FacePoolError:
+            if reference_future is not None:
+                reference_future.cancel()
+            raise
+        timings.update(result.timings)
+        log_timings("Login", timings)
+        observe_timings(timings)
+        encoding = result.encoding
 
         #     # **MAC and IP check only for PC login**
         # if mac_address != stored_mac:
         #     return {"error": "Unauthorized device! MAC/IP mismatch. Request admin verification.","Status": "False"}
-        if not encoding:
+        if encoding is None:
+            # Any reference download still queued is no longer needed
+            if reference_future is not None:
+                reference_future.cancel()
+            record_outcome("login", "no_face")
             return {"error": "No face detected for login","Status": "False"}
 
-        # **Compare the face encoding with Cloudinary image using distance**
-        distance = face_recognition.face_distance([cloudinary_encoding], encoding[0])[0]  # Get similarity score
+        if references is None:
+            # Wait no longer than the pool timeout and the request deadline allow
+            timeout = remaining_time(FACE_POOL_TIMEOUT - (time.monotonic() - started))
+            try:
+                references, error = reference_future.result(timeout=max(timeout, 0))
+            except FutureTimeoutError:
+                reference_future.cancel()
+                raise DeadlineExceeded("login: timed out loading the reference image") from None
+            if references is None:
+                record_outcome("login", "no_reference")
+                return error
+
+        # **Compare the face encoding with the Cloudinary image and recent login templates in one pass**
+        distance = np.linalg.norm(references - encoding, axis=1).min()  # Same metric as face_recognition.face_distance
         print(distance)
-        threshold = 0.4  # Stricter threshold for better accuracy
+        MATCH_DISTANCE.observe(distance)
+        threshold = MATCH_THRESHOLD
+
+        if distance < threshold and LOGIN_REFRESH_MODE == "template":
+            # Refresh the rolling templates in Mongo; Cloudinary stays off the critical path.
+            # Only a probe that matches the registered face itself is kept, so a probe that
+            # matched an earlier template cannot walk the set away from the enrolled face
+            if np.linalg.norm(references[0] - encoding) < threshold:
+                users_collection.update_one({"email": email}, template_update(user, encoding))
+                templates = np.vstack([references[1:], encoding])[-TEMPLATE_COUNT:]
+                encoding_cache.put(email, cloudinary_url, np.vstack([references[:1], templates]))
+            if ARCHIVE_LOGIN_IMAGES:
+                enqueue_archive(email, image)
+            record_outcome("login", "success")
+            return login_response(user, email, mac_address, cloudinary_url)
 
         if distance < threshold:
-            # Delete old Cloudinary image if exists
-            if cloudinary_url:
-                delete_success = delete_cloudinary_image(cloudinary_url)
-                if not delete_success:
-                    return {"error": "Failed to delete old image. Try again.","Status": "False"}
-            print(f"Uploading new image: {image_path}")  # Debugging
-            new_cloudinary_url = upload_to_cloudinary(image_path, folder=CLOUDINARY_FOLDER)
+            # Upload the new image first and swap it in only if the stored one is unchanged,
+            # so a concurrent login or re-capture can never leave image_url pointing at a deleted image
+            new_cloudinary_url = upload_to_cloudinary(image, folder=CLOUDINARY_FOLDER)
 
             if not new_cloudinary_url:
+                record_outcome("login", "upstream_error")
                 return {"error": "Failed to upload new login image.","Status": "False"}
 
-            # Update MongoDB with new image URL
-            users_collection.update_one(
-                {"email": email},
-                {"$set": {"image_url": new_cloudinary_url}}
+            # Update MongoDB with new image URL and its encoding
+            result = users_collection.update_one(
+                {"email": email, "image_url": cloudinary_url},
+                image_update(new_cloudinary_url, encoding)
             )
+            encoding_cache.invalidate(email)
+            if not result.modified_count:
+                # Another request replaced the image first; keep its image and drop ours
+                delete_cloudinary_image(new_cloudinary_url)
+                current = find_user(email, {"image_url": 1}) or {}
+                record_outcome("login", "success")
+                return login_response(user, email, mac_address, current.get("image_url", cloudinary_url))
 
-            return {
-                "message": "Login successful",
-                "Status": "True",
-                "data": [
-                    {
-                        "_id": str(user.get("_id", "")),
-                        "firstName": user.get("firstName", ""),
-                        "lastName": user.get("lastName", ""),
-                        "companyId": user.get("companyId", ""),
-                        "companyName": user.get("companyName", ""),
-                        "designation": user.get("designation", ""),
-                        "email": email,
-                        "phone": user.get("phone", ""),
-                        "status": user.get("status", ""),
-                        "role": user.get("role", ""),
-                        "isNewUser": user.get("isNewUser", ""),
-                        "token": user.get("token", ""),
-                        "dailyTotalWorkingHour": user.get("dailyTotalWorkingHour", ""),
-                        "weeklyTotalWorkingHour": user.get("weeklyTotalWorkingHour", ""),
-                        "requiresPasswordReset": user.get("requiresPasswordReset", ""),
-                        "empCode": user.get("empCode", ""),
-                        "name": user.get("name", ""),
-                        "mobile": user.get("mobile", ""),
-                        "device_mac": mac_address,
-                        "image_url": new_cloudinary_url,
-                    }
-                ]
-            }
+            gallery.add(email, encoding)
+            publish_encoding(email, encoding, new_cloudinary_url)
+            # Delete the old Cloudinary image; a failure only leaves an orphaned image behind
+            if not delete_cloudinary_image(cloudinary_url):
+                record_outcome("login", "orphaned_image")
+
+            record_outcome("login", "success")
+            return login_response(user, email, mac_address, new_cloudinary_url)
 
         else:
+            record_outcome("login", "mismatch")
             return {"error": "Login failed. Face does not match.", "Status": "False"}
 
+    except FacePoolError as e:
+        record_outcome("login", "busy")
+        return {"error": str(e), "Status": "False", "code": 503}
+
+    except (CircuitOpenError, DeadlineExceeded) as e:
+        record_outcome("login", "upstream_unavailable")
+        return {"error": str(e), "Status": "False", "code": 503}
+
     except Exception as e:
         print(f"Unexpected error: {str(e)}")
+        record_outcome("login", "error")
         return {"status": "error", "message": "Application failed to respond", "code": 502}
-    finally:
-        # 🧹 Cleanup: Delete the local image after processing (success or fail)
-        if image_path and os.path.exists(image_path):
-            try:
-                os.remove(image_path)
-                print(f"Deleted temp image: {image_path}")
-            except Exception as e:
-                print(f"Failed to delete image {image_path}: {e}")
@@ -0,0 +1,93 @@
+import os
+import time
+from contextlib import contextmanager
+from pymongo import monitoring
+from prometheus_client import (Counter, Gauge, Histogram, CollectorRegistry, REGISTRY,
+                               CONTENT_TYPE_LATEST, generate_latest, multiprocess)
+
+# With several gunicorn workers set PROMETHEUS_MULTIPROC_DIR (an empty, writable
+# directory) before start-up; every worker then writes its samples there and
+# /metrics aggregates them, whichever worker serves the scrape.
+MULTIPROC_DIR = os.getenv("PROMETHEUS_MULTIPROC_DIR")
+
+# Spans fast in-memory stages up to slow upstream calls and CNN detection
+_SECONDS_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
+
+STAGE_SECONDS = Histogram(
+    "face_auth_stage_seconds", "Time spent in each processing stage", ["stage"],
+    buckets=_SECONDS_BUCKETS
+)
+REQUEST_SECONDS = Histogram(
+    "face_auth_request_seconds", "End-to-end request latency", ["endpoint", "status"],
+    buckets=_SECONDS_BUCKETS
+)
+OUTCOMES = Counter(
+    "face_auth_outcomes_total", "Request outcomes (success, no_face, mismatch, upstream_error, ...)",
+    ["endpoint", "outcome"]
+)
+QUALITY_REJECTIONS = Counter(
+    "face_auth_quality_rejections_total",
+    "Images rejected by the quality gate before detection and encoding", ["endpoint", "reason"]
+)
+COALESCED = Counter(
+    "face_auth_coalesced_requests_total",
+    "Requests answered with the result of an identical in-flight request", ["endpoint"]
+)
+CIRCUIT_STATE = Gauge(
+    "face_auth_circuit_state", "Circuit breaker state per dependency (0 closed, 1 half-open, 2 open)",
+    ["dependency"], multiprocess_mode="max"
+)
+MATCH_DISTANCE = Histogram(
+    "face_auth_match_distance", "Best face distance of each login attempt",
+    buckets=(0.1, 0.2, 0.25, 0.3, 0.35, 0.4, 0.45, 0.5, 0.6, 0.7, 0.8, 1.0)
+)
+
+
+@contextmanager
+def timed(stage):
+    """Observe the duration of the block under face_auth_stage_seconds{stage=...}."""
+    started = time.perf_counter()
+    try:
+        yield
+    finally:
+        STAGE_SECONDS.labels(stage).observe(time.perf_counter() - started)
+
+
+def observe_timings(timings):
+    """Record a preprocess timings dict ({"detect_ms": 12.3, ...}) as stage samples."""
+    for name, ms in timings.items():
+        STAGE_SECONDS.labels(name[:-3] if name.endswith("_ms") else name).observe(ms / 1000)
+
+
+def record_outcome(endpoint, outcome):
+    OUTCOMES.labels(endpoint, outcome).inc()
+
+
+class MongoCommandTimer(monitoring.CommandListener):
+    """Times every Mongo command (find, update, insert, ...) as a mongo_<command> stage."""
+
+    def started(self, event):
+        pass
+
+    def succeeded(self, event):
+        STAGE_SECONDS.labels(f"mongo_{event.command_name}").observe(event.duration_micros / 1e6)
+
+    def failed(self, event):
+        STAGE_SECONDS.labels(f"mongo_{event.command_name}").observe(event.duration_micros / 1e6)
+        record_outcome("mongo", "upstream_error")
+
+
+def metrics_payload():
+    """Return (body, content_type) for the /metrics endpoint."""
+    if MULTIPROC_DIR:
+        registry = CollectorRegistry()
+        multiprocess.MultiProcessCollector(registry)
+    else:
+        registry = REGISTRY
+    return generate_latest(registry), CONTENT_TYPE_LATEST
+
+
+def mark_process_dead(pid):
+    """Drop a dead worker's live gauges (call from gunicorn's child_exit hook)."""
+    if MULTIPROC_DIR:
+        multiprocess.mark_process_dead(pid)
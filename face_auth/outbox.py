@@ -0,0 +1,132 @@
+import os
+import time
+import random
+import threading
+from bson.binary import Binary
+from pymongo import ReturnDocument
+from face_auth.utils import db, users_collection, upload_to_cloudinary, encode_jpeg
+
+CLOUDINARY_FOLDER = os.getenv("CLOUDINARY_FOLDER", "face_recognition")
+ARCHIVE_FOLDER = os.getenv("CLOUDINARY_ARCHIVE_FOLDER", f"{CLOUDINARY_FOLDER}/archive")
+ARCHIVE_KEEP = int(os.getenv("ARCHIVE_KEEP", "10"))  # archived image URLs kept per user
+OUTBOX_MAX_ATTEMPTS = int(os.getenv("OUTBOX_MAX_ATTEMPTS", "5"))
+OUTBOX_POLL_INTERVAL = float(os.getenv("OUTBOX_POLL_INTERVAL", "2"))  # seconds
+OUTBOX_CLAIM_TIMEOUT = float(os.getenv("OUTBOX_CLAIM_TIMEOUT", "300"))  # seconds before a stuck job is retried
+
+outbox_collection = db[os.getenv("OUTBOX_COLLECTION_NAME", "cloudinary_outbox")]
+
+_worker = None
+_worker_pid = None
+_worker_lock = threading.Lock()
+_wake = threading.Event()
+
+
+def enqueue_archive(email, image):
+    """Queue a login photo for upload to Cloudinary; returns immediately."""
+    data = encode_jpeg(image)
+    if data is None:
+        return False
+    outbox_collection.insert_one({
+        "email": email,
+        "image": Binary(data),
+        "status": "pending",
+        "attempts": 0,
+        "next_attempt_at": time.time(),
+        "created_at": time.time()
+    })
+    start_outbox_worker()
+    _wake.set()
+    return True
+
+
+def ensure_outbox_indexes():
+    # Backs the claim query and its sort
+    outbox_collection.create_index([("status", 1), ("next_attempt_at", 1)], name="status_next_attempt")
+
+
+def _claim_job():
+    # Atomic claim, so several gunicorn workers can drain the same outbox.
+    # Jobs left "processing" by a worker that died are picked up again after OUTBOX_CLAIM_TIMEOUT.
+    now = time.time()
+    return outbox_collection.find_one_and_update(
+        {"$or": [
+            {"status": "pending", "next_attempt_at": {"$lte": now}},
+            {"status": "processing", "claimed_at": {"$lt": now - OUTBOX_CLAIM_TIMEOUT}}
+        ]},
+        {"$set": {"status": "processing", "claimed_at": now}},
+        sort=[("next_attempt_at", 1)],
+        return_document=ReturnDocument.AFTER
+    )
+
+
+def _process_job(job):
+    url = upload_to_cloudinary(bytes(job["image"]), folder=ARCHIVE_FOLDER)
+    if url:
+        users_collection.update_one(
+            {"email": job["email"]},
+            {"$push": {"archived_images": {"$each": [url], "$slice": -ARCHIVE_KEEP}}}
+        )
+        outbox_collection.delete_one({"_id": job["_id"]})
+        return
+    _retry_later(job)
+
+
+def _retry_later(job):
+    """Put a failed job back with exponential backoff, or give up after OUTBOX_MAX_ATTEMPTS."""
+    attempts = job["attempts"] + 1
+    if attempts >= OUTBOX_MAX_ATTEMPTS:
+        print(f"Archive upload for {job['email']} failed {attempts} times; giving up")
+        outbox_collection.update_one({"_id": job["_id"]}, {"$set": {"status": "failed", "attempts": attempts}})
+        return
+
+    # Exponential backoff with jitter: ~2s, 4s, 8s, ...
+    delay = (2 ** attempts) * (0.5 + random.random())
+    outbox_collection.update_one(
+        {"_id": job["_id"]},
+        {"$set": {"status": "pending", "attempts": attempts, "next_attempt_at": time.time() + delay}}
+    )
+
+
+def drain_outbox(max_jobs=None):
+    """Process due jobs until none are left (or max_jobs were handled). Returns the count."""
+    processed = 0
+    while max_jobs is None or processed < max_jobs:
+        job = _claim_job()
+        if job is None:
+            break
+        try:
+            _process_job(job)
+        except Exception as e:
+            # Same backoff as a failed upload, or the job is claimed again at once
+            print(f"Outbox job {job['_id']} error: {e}")
+            _retry_later(job)
+        processed += 1
+    return processed
+
+
+def _run():
+    while True:
+        try:
+            drain_outbox()
+        except Exception as e:
+            print(f"Outbox worker error: {e}")
+        _wake.wait(OUTBOX_POLL_INTERVAL)
+        _wake.clear()
+
+
+def start_outbox_worker():
+    """Start the background archive thread for this process (idempotent, fork-aware)."""
+    global _worker, _worker_pid
+    with _worker_lock:
+        if _worker is not None and _worker.is_alive() and _worker_pid == os.getpid():
+            return
+        _worker = threading.Thread(target=_run, name="cloudinary-outbox", daemon=True)
+        _worker.start()
+        _worker_pid = os.getpid()
+
+
+def outbox_stats():
+    return {
+        status: outbox_collection.count_documents({"status": status})
+        for status in ("pending", "processing", "failed")
+    }
@@ -0,0 +1,114 @@
+import io
+import os
+import time
+from collections import namedtuple
+from contextlib import contextmanager
+import cv2
+import numpy as np
+from PIL import Image
+from face_auth.encodings import compute_face_encoding
+
+# Longest side kept after decoding; larger uploads are decoded at reduced size and downscaled
+PREPROCESS_MAX_SIDE = int(os.getenv("PREPROCESS_MAX_SIDE", "1024"))
+# Longest side of the copy the detector runs on; boxes are mapped back to the full image
+DETECTION_MAX_SIDE = int(os.getenv("DETECTION_MAX_SIDE", "640"))
+DETECTION_MODEL = os.getenv("FACE_DETECTION_MODEL", "hog")  # "hog" or "cnn"
+DETECTION_UPSAMPLE = int(os.getenv("FACE_DETECTION_UPSAMPLE", "1"))
+
+FaceResult = namedtuple("FaceResult", ["face_count", "encoding", "timings"])
+
+_REDUCED_FLAGS = (
+    (8, cv2.IMREAD_REDUCED_COLOR_8),
+    (4, cv2.IMREAD_REDUCED_COLOR_4),
+    (2, cv2.IMREAD_REDUCED_COLOR_2),
+)
+
+
+@contextmanager
+def stage_timer(timings, stage):
+    """Record the duration of the block in timings[f"{stage}_ms"]."""
+    started = time.perf_counter()
+    try:
+        yield
+    finally:
+        if timings is not None:
+            timings[f"{stage}_ms"] = round((time.perf_counter() - started) * 1000, 2)
+
+
+def _decode_flag(data, max_side):
+    """Pick the largest JPEG DCT reduction that still leaves at least max_side pixels."""
+    try:
+        with Image.open(io.BytesIO(data)) as header:  # Reads the header only
+            if header.format != "JPEG":
+                return cv2.IMREAD_COLOR
+            longest = max(header.size)
+    except Exception:
+        return cv2.IMREAD_COLOR
+    for factor, flag in _REDUCED_FLAGS:
+        if longest // factor >= max_side:
+            return flag
+    return cv2.IMREAD_COLOR
+
+
+def cap_longest_side(image, max_side):
+    """Downscale image so its longest side is at most max_side. Returns (image, scale)."""
+    longest = max(image.shape[:2])
+    if max_side <= 0 or longest <= max_side:
+        return image, 1.0
+    scale = max_side / longest
+    size = (round(image.shape[1] * scale), round(image.shape[0] * scale))
+    return cv2.resize(image, size, interpolation=cv2.INTER_AREA), scale
+
+
+def decode_upload(data, max_side=PREPROCESS_MAX_SIDE, timings=None):
+    """Decode uploaded bytes into an OpenCV (BGR) image no larger than max_side, or None."""
+    if not data:
+        return None
+    with stage_timer(timings, "decode"):
+        flag = _decode_flag(data, max_side) if max_side > 0 else cv2.IMREAD_COLOR
+        image = cv2.imdecode(np.frombuffer(data, np.uint8), flag)
+    if image is None:
+        return None
+    with stage_timer(timings, "resize"):
+        image, _ = cap_longest_side(image, max_side)
+    return image
+
+
+def detect_faces(rgb_image, max_side=DETECTION_MAX_SIDE):
+    """Run the detector on a downscaled copy and return boxes in rgb_image coordinates."""
+    import face_recognition  # Loads the dlib models; deferred until detection is needed
+    small, scale = cap_longest_side(rgb_image, max_side)
+    locations = face_recognition.face_locations(
+        small,
+        number_of_times_to_upsample=DETECTION_UPSAMPLE,
+        model=DETECTION_MODEL
+    )
+    if scale == 1.0:
+        return locations
+    height, width = rgb_image.shape[:2]
+    return [
+        (max(int(top / scale), 0), min(int(right / scale), width - 1),
+         min(int(bottom / scale), height - 1), max(int(left / scale), 0))
+        for top, right, bottom, left in locations
+    ]
+
+
+def detect_and_encode(image):
+    """Detect faces in an OpenCV (BGR) image and encode the first one.
+
+    Returns a FaceResult with per-stage timings in milliseconds.
+    """
+    timings = {}
+    with stage_timer(timings, "convert"):
+        rgb_image = cv2.cvtColor(image, cv2.COLOR_BGR2RGB)
+    with stage_timer(timings, "detect"):
+        face_locations = detect_faces(rgb_image)
+    if not face_locations:
+        return FaceResult(0, None, timings)
+    with stage_timer(timings, "encode"):
+        encoding = compute_face_encoding(rgb_image, face_locations)
+    return FaceResult(len(face_locations), encoding, timings)
+
+
+def log_timings(label, timings):
+    print(f"{label} timings: " + ", ".join(f"{stage}={ms}" for stage, ms in timings.items()))
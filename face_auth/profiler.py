@@ -0,0 +1,155 @@
+"""Sampling profiler for individual requests.
+
+A profiled request has its thread's stack sampled every PROFILE_INTERVAL_MS
+by one background thread (sys._current_frames), so the request itself runs
+unmodified. Each profile is written to PROFILE_DIR in collapsed-stack format
+("frame;frame;frame count" per line), which flamegraph.pl and speedscope
+open directly:
+
+    flamegraph.pl profiles/20240101T120000-login-1234-840ms.folded > login.svg
+
+Work done inside the face pool processes shows up as time spent waiting for
+the pool (face_task_result); run with FACE_POOL_WORKERS=0 to profile dlib
+inline.
+"""
+import hmac
+import os
+import sys
+import time
+import threading
+from collections import Counter
+
+PROFILE_SAMPLE_RATE = float(os.getenv("PROFILE_SAMPLE_RATE", "0"))  # share of requests profiled
+# Requests carrying X-Profile-Token with this value are always profiled; also guards /admin/profiles
+PROFILE_TOKEN = os.getenv("PROFILE_TOKEN", "")
+PROFILE_DIR = os.getenv("PROFILE_DIR", "profiles")
+PROFILE_INTERVAL_MS = float(os.getenv("PROFILE_INTERVAL_MS", "5"))
+PROFILE_KEEP = int(os.getenv("PROFILE_KEEP", "200"))  # newest files kept, across all workers
+
+
+def _frame_name(code):
+    folder = os.path.basename(os.path.dirname(code.co_filename))
+    return f"{code.co_name} ({folder}/{os.path.basename(code.co_filename)}:{code.co_firstlineno})"
+
+
+class Sampler:
+    """Samples the stacks of registered threads from a single daemon thread."""
+
+    def __init__(self, interval=PROFILE_INTERVAL_MS / 1000):
+        self.interval = interval
+        self._profiles = {}  # thread id -> Counter of collapsed stacks
+        self._lock = threading.Lock()
+        self._thread = None
+        self._thread_pid = None
+
+    def start(self, thread_id=None):
+        thread_id = thread_id or threading.get_ident()
+        with self._lock:
+            self._profiles[thread_id] = Counter()
+            # The sampling thread does not survive a fork
+            if self._thread is None or not self._thread.is_alive() or self._thread_pid != os.getpid():
+                self._thread = threading.Thread(target=self._run, name="request-profiler", daemon=True)
+                self._thread_pid = os.getpid()
+                self._thread.start()
+        return thread_id
+
+    def stop(self, thread_id):
+        """Stop sampling thread_id and return its Counter of collapsed stacks (or None)."""
+        with self._lock:
+            return self._profiles.pop(thread_id, None)
+
+    def _run(self):
+        while True:
+            time.sleep(self.interval)
+            with self._lock:
+                if not self._profiles:
+                    self._thread = None
+                    return
+                frames = sys._current_frames()
+                for thread_id, stacks in self._profiles.items():
+                    frame = frames.get(thread_id)
+                    names = []
+                    while frame is not None:
+                        names.append(_frame_name(frame.f_code))
+                        frame = frame.f_back
+                    if names:
+                        stacks[";".join(reversed(names))] += 1
+
+
+sampler = Sampler()
+
+
+def token_matches(headers):
+    """True if the request carries PROFILE_TOKEN (compared in constant time); never when it is unset."""
+    token = headers.get("X-Profile-Token", "")
+    return bool(PROFILE_TOKEN) and hmac.compare_digest(token.encode(), PROFILE_TOKEN.encode())
+
+
+def should_profile(headers, roll):
+    """Profile this request? roll is a uniform random number in [0, 1)."""
+    if token_matches(headers):
+        return True
+    return roll < PROFILE_SAMPLE_RATE
+
+
+def write_profile(stacks, label, duration_ms):
+    """Write one request's stacks as a .folded file and drop the oldest files beyond PROFILE_KEEP."""
+    if not stacks:
+        return None
+    os.makedirs(PROFILE_DIR, exist_ok=True)
+    name = f"{time.strftime('%Y%m%dT%H%M%S')}-{label}-{os.getpid()}-{duration_ms:.0f}ms.folded"
+    path = os.path.join(PROFILE_DIR, name)
+    with open(f"{path}.tmp", "w") as f:
+        f.writelines(f"{stack} {count}\n" for stack, count in stacks.most_common())
+    os.replace(f"{path}.tmp", path)
+
+    files = recent_profiles(limit=None)
+    for old in files[PROFILE_KEEP:]:
+        try:
+            os.remove(os.path.join(PROFILE_DIR, old["name"]))
+        except OSError:
+            pass  # Another worker rotated it first
+    return name
+
+
+def recent_profiles(limit=20):
+    """Newest profile files first, as dicts with name, size and mtime."""
+    try:
+        entries = [entry for entry in os.scandir(PROFILE_DIR) if entry.name.endswith(".folded")]
+    except FileNotFoundError:
+        return []
+    profiles = []
+    for entry in entries:
+        try:
+            stat = entry.stat()
+        except OSError:
+            continue  # Deleted by another worker's rotation meanwhile
+        profiles.append({"name": entry.name, "bytes": stat.st_size, "mtime": stat.st_mtime})
+    profiles.sort(key=lambda profile: profile["mtime"], reverse=True)
+    return profiles[:limit]
+
+
+def hot_functions(limit=20, profiles=50):
+    """Aggregate the newest profiles into the functions with the most self and total samples."""
+    self_samples, total_samples = Counter(), Counter()
+    samples = 0
+    for profile in recent_profiles(profiles):
+        try:
+            with open(os.path.join(PROFILE_DIR, profile["name"])) as f:
+                lines = f.readlines()
+        except OSError:
+            continue
+        for line in lines:
+            stack, _, count = line.rstrip("\n").rpartition(" ")
+            frames, count = stack.split(";"), int(count)
+            samples += count
+            self_samples[frames[-1]] += count
+            for frame in set(frames):
+                total_samples[frame] += count
+
+    def top(counter):
+        return [
+            {"function": name, "samples": count, "share": round(count / samples, 4)}
+            for name, count in counter.most_common(limit)
+        ]
+    return {"samples": samples, "self": top(self_samples), "total": top(total_samples)}
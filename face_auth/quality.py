@@ -0,0 +1,113 @@
+import os
+import threading
+from collections import namedtuple
+import cv2
+from face_auth.preprocess import cap_longest_side, stage_timer
+from face_auth.metrics import QUALITY_REJECTIONS
+
+# Cheap checks on a small grayscale copy, run before an image is sent to dlib
+QUALITY_GATE = os.getenv("QUALITY_GATE", "true").lower() in ("1", "true", "yes")
+QUALITY_ANALYSIS_SIDE = int(os.getenv("QUALITY_ANALYSIS_SIDE", "320"))
+QUALITY_MIN_SIDE = int(os.getenv("QUALITY_MIN_SIDE", "120"))  # shortest side of the upload, px
+QUALITY_MIN_SHARPNESS = float(os.getenv("QUALITY_MIN_SHARPNESS", "25"))  # Laplacian variance
+QUALITY_MIN_BRIGHTNESS = float(os.getenv("QUALITY_MIN_BRIGHTNESS", "40"))  # mean gray level, 0-255
+QUALITY_MAX_BRIGHTNESS = float(os.getenv("QUALITY_MAX_BRIGHTNESS", "220"))
+QUALITY_MAX_CLIPPED = float(os.getenv("QUALITY_MAX_CLIPPED", "0.4"))  # share of pure black/white pixels
+# "haar" counts and sizes the faces OpenCV's cascade finds (a few ms); "off" leaves that to dlib.
+# Finding none is not a rejection: dlib's detector, which login uses, decides that.
+# OpenCV builds without CascadeClassifier (5.x) skip it, as "off" does
+QUALITY_FACE_DETECTOR = os.getenv("QUALITY_FACE_DETECTOR", "haar")
+QUALITY_MIN_FACE_SIDE = int(os.getenv("QUALITY_MIN_FACE_SIDE", "60"))  # face width in the upload, px
+QUALITY_MAX_FACES = int(os.getenv("QUALITY_MAX_FACES", "1"))
+
+QualityResult = namedtuple("QualityResult", ["ok", "reason", "message", "measures"])
+
+MESSAGES = {
+    "image_too_small": "Image resolution is too low. Use a larger photo.",
+    "image_blurry": "Image is too blurry. Hold the camera still and retake the photo.",
+    "image_too_dark": "Image is too dark. Move to a brighter place and retake the photo.",
+    "image_overexposed": "Image is overexposed. Avoid direct light and retake the photo.",
+    "multiple_faces": "More than one face detected. Only the user should be in the photo.",
+    "face_too_small": "Face is too small. Move closer to the camera."
+}
+
+_local = threading.local()
+
+
+def _cascade():
+    """Return this thread's Haar cascade, or None when the OpenCV build has none (OpenCV 5 dropped it)."""
+    if not hasattr(cv2, "CascadeClassifier"):
+        return None
+    # CascadeClassifier is not safe to share between threads
+    cascade = getattr(_local, "cascade", None)
+    if cascade is None:
+        cascade = _local.cascade = cv2.CascadeClassifier(
+            os.path.join(cv2.data.haarcascades, "haarcascade_frontalface_default.xml"))
+    return cascade
+
+
+def assess_image(image):
+    """Check an OpenCV (BGR) image for resolution, faces, blur and exposure.
+
+    Returns a QualityResult; reason is one of the MESSAGES keys when the image
+    should be rejected, and measures holds the values that were checked.
+    """
+    height, width = image.shape[:2]
+    measures = {"width": width, "height": height}
+    if min(height, width) < QUALITY_MIN_SIDE:
+        return QualityResult(False, "image_too_small", MESSAGES["image_too_small"], measures)
+
+    small, scale = cap_longest_side(image, QUALITY_ANALYSIS_SIDE)
+    gray = cv2.cvtColor(small, cv2.COLOR_BGR2GRAY)
+
+    # Blur and exposure are measured on the face when one is found, else on the whole frame
+    region = gray
+    cascade = _cascade() if QUALITY_FACE_DETECTOR == "haar" else None
+    if cascade is not None:
+        min_side = max(int(QUALITY_MIN_FACE_SIDE * scale), 20)
+        faces = cascade.detectMultiScale(gray, scaleFactor=1.1, minNeighbors=5, minSize=(20, 20))
+        measures["faces"] = len(faces)
+        # The cascade misses faces dlib finds, so no face here is left for dlib to decide
+        if len(faces):
+            large = [face for face in faces if face[2] >= min_side]
+            if len(large) > QUALITY_MAX_FACES:
+                return QualityResult(False, "multiple_faces", MESSAGES["multiple_faces"], measures)
+            x, y, w, h = max(faces, key=lambda face: face[2] * face[3])
+            measures["face_side"] = int(w / scale)
+            if w < min_side:
+                return QualityResult(False, "face_too_small", MESSAGES["face_too_small"], measures)
+            region = gray[y:y + h, x:x + w]
+
+    sharpness = float(cv2.Laplacian(region, cv2.CV_64F).var())
+    brightness = float(region.mean())
+    clipped = float(((region <= 5) | (region >= 250)).mean())
+    measures.update(sharpness=round(sharpness, 1), brightness=round(brightness, 1), clipped=round(clipped, 3))
+    if sharpness < QUALITY_MIN_SHARPNESS:
+        return QualityResult(False, "image_blurry", MESSAGES["image_blurry"], measures)
+    if brightness < QUALITY_MIN_BRIGHTNESS or (clipped > QUALITY_MAX_CLIPPED and brightness < 128):
+        return QualityResult(False, "image_too_dark", MESSAGES["image_too_dark"], measures)
+    if brightness > QUALITY_MAX_BRIGHTNESS or clipped > QUALITY_MAX_CLIPPED:
+        return QualityResult(False, "image_overexposed", MESSAGES["image_overexposed"], measures)
+    return QualityResult(True, None, None, measures)
+
+
+def check_quality(endpoint, image, timings=None):
+    """Run the gate for endpoint ("login", "register", ...). Returns an error response, or None.
+
+    Every rejection is counted in face_auth_quality_rejections_total; each one
+    is a detection + encoding the face pool did not have to run. The gate fails
+    open: an error while assessing the image never fails the request.
+    """
+    if not QUALITY_GATE:
+        return None
+    try:
+        with stage_timer(timings, "quality"):
+            result = assess_image(image)
+    except Exception as e:
+        print(f"Quality gate skipped for {endpoint}: {e}")
+        return None
+    if result.ok:
+        return None
+    QUALITY_REJECTIONS.labels(endpoint, result.reason).inc()
+    print(f"{endpoint.capitalize()} rejected by quality gate: {result.reason} {result.measures}")
+    return {"error": result.message, "error_code": result.reason, "quality": result.measures, "Status": "False"}
@@ -1,23 +1,32 @@
-import cv2
-import face_recognition
 import os
-from face_auth.utils import get_device_mac, resize_image, upload_to_cloudinary, users_collection
-from dotenv import load_dotenv
+from face_auth.utils import get_device_mac, resize_image, upload_to_cloudinary
+from face_auth.users import reserve_user, complete_user, release_user
+from face_auth.encodings import encoding_fields
+from face_auth.workers import encode_image, FacePoolError
+from face_auth.preprocess import log_timings
+from face_auth.metrics import observe_timings, record_outcome
+from face_auth.cache import encoding_cache
+from face_auth.gallery import gallery
+from face_auth.quality import check_quality
+from face_auth.resilience import CircuitOpenError, DeadlineExceeded
+from face_auth.shared_store import publish_encoding
 
-load_dotenv()
 CLOUDINARY_FOLDER = os.getenv("CLOUDINARY_FOLDER", "face_recognition")
 
-def register_user(name, email, mobile, image_path=None):
-    temp_image_path = None  # track local file path for cleanup
-    try:
+def register_user(name, email, mobile, image=None, timings=None):
+    """Register a user from an already decoded OpenCV (BGR) image.
 
-        # **Check if user already exists**
-        existing_user = users_collection.find_one({"$or": [{"email": email}]})
-        if existing_user:
-            # **Delete Uploaded Image if User Exists**
-            if image_path and os.path.exists(image_path):   # Check if image_path is not None
-                os.remove(image_path)
+    Per-stage timings are added to the timings dict (if given) and logged.
+    """
+    timings = {} if timings is None else timings
+    user_id = None
+    completed = False
+    try:
 
+        # **Atomically claim the email (unique index) before doing any expensive work**
+        user_id = reserve_user(email, name, mobile)
+        if user_id is None:
+            record_outcome("register", "duplicate")
             return {"error": "User with this email already registered"}
 
         # **If no image provided, capture from webcam**
@@ -33,34 +42,52 @@ def register_user(name, email, mobile, image_path=None):
         #     image_path = temp_image_path  # assign for processing
 
         # **Resize Image Before Processing**
-        resized_path = resize_image(image_path)
-        if resized_path is None:
+        resized_image = resize_image(image)
+        if resized_image is None:
+            record_outcome("register", "invalid_image")
             return {"error": "Invalid image file"}
 
-        # **Perform face detection on uploaded image**
-        image = face_recognition.load_image_file(resized_path)
-        face_locations = face_recognition.face_locations(image)
+        # **Reject blurry, dark, tiny or multi-face photos before any dlib work**
+        # (on the upload itself: resize_image scales small photos up)
+        rejection = check_quality("register", image, timings)
+        if rejection is not None:
+            record_outcome("register", rejection["error_code"])
+            return rejection
+
+        # **Perform face detection and encode once, so login can compare against the stored vector**
+        result = encode_image(resized_image)
+        timings.update(result.timings)
+        log_timings("Register", timings)
+        observe_timings(timings)
+        face_count, encoding = result.face_count, result.encoding
 
-        if len(face_locations) == 0:
+        if face_count == 0 or encoding is None:
+            record_outcome("register", "no_face")
             return {"error": "In this image, no face is detected"}
 
         # **Upload to Cloudinary**
-        cloudinary_url = upload_to_cloudinary(resized_path, folder=CLOUDINARY_FOLDER)
+        cloudinary_url = upload_to_cloudinary(resized_image, folder=CLOUDINARY_FOLDER)
         if not cloudinary_url:
+            record_outcome("register", "upstream_error")
             return {"error": "Failed to upload image to Cloudinary"}
 
         # Get MAC address and IP address
         mac_address = get_device_mac()
 
         # **Store user data in MongoDB**
-        users_collection.insert_one({
+        complete_user(user_id, {
             "name": name,
-            "email": email,
             "mobile": mobile,
             "mac_address": mac_address,
-            "image_url": cloudinary_url  # Store Cloudinary image URL
+            "image_url": cloudinary_url,  # Store Cloudinary image URL
+            **encoding_fields(encoding, cloudinary_url)
         })
+        completed = True
+        encoding_cache.invalidate(email)
+        gallery.add(email, encoding)
+        publish_encoding(email, encoding, cloudinary_url)
 
+        record_outcome("register", "success")
         return {
             "message": "User registered successfully",
             "Status": "True",
@@ -75,15 +102,20 @@ def register_user(name, email, mobile, image_path=None):
             ]
         }
 
+    except FacePoolError as e:
+        record_outcome("register", "busy")
+        return {"error": str(e), "code": 503}
+
+    except (CircuitOpenError, DeadlineExceeded) as e:
+        record_outcome("register", "upstream_unavailable")
+        return {"error": str(e), "code": 503}
+
     except Exception as e:
+        record_outcome("register", "error")
         return {"error": str(e)}
 
     finally:
-        # 🧹 Cleanup temp image file
-        if image_path and os.path.exists(image_path):
-            try:
-                os.remove(image_path)
-                print(f"Deleted temp image: {image_path}")
-            except Exception as e:
-                print(f"Error deleting image: {e}")
+        # Free the email again if registration did not finish
+        if user_id is not None and not completed:
+            release_user(user_id)
 
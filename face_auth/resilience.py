@@ -0,0 +1,165 @@
+import os
+import time
+import random
+import threading
+from face_auth.metrics import CIRCUIT_STATE, record_outcome
+from face_auth.workers import request_deadline
+
+BREAKER_FAILURE_THRESHOLD = int(os.getenv("BREAKER_FAILURE_THRESHOLD", "5"))  # consecutive failures
+BREAKER_RESET_TIMEOUT = float(os.getenv("BREAKER_RESET_TIMEOUT", "30"))  # seconds open before a trial call
+RETRY_BASE_DELAY = float(os.getenv("RETRY_BASE_DELAY", "0.2"))  # seconds, doubled per attempt
+RETRY_MAX_DELAY = float(os.getenv("RETRY_MAX_DELAY", "2"))
+# Client timeouts can fire a little before the deadline they were given
+DEADLINE_SLACK = 0.05
+
+CLOSED, HALF_OPEN, OPEN = "closed", "half_open", "open"
+_STATE_VALUES = {CLOSED: 0, HALF_OPEN: 1, OPEN: 2}
+
+
+class CircuitOpenError(Exception):
+    """The dependency is failing; the call was not attempted."""
+
+
+class DeadlineExceeded(Exception):
+    """No time was left for the call (or another attempt) before its deadline."""
+
+
+class CircuitBreaker:
+    """Fails calls fast while a dependency is down.
+
+    After failure_threshold consecutive failures the breaker opens and every
+    call is refused for reset_timeout seconds; then a single trial call is let
+    through (half-open), and its result closes or re-opens the breaker.
+    """
+
+    def __init__(self, name, failure_threshold=BREAKER_FAILURE_THRESHOLD, reset_timeout=BREAKER_RESET_TIMEOUT):
+        self.name = name
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self._state = CLOSED
+        self._failures = 0
+        self._opened_at = 0.0
+        self._trial_running = False
+        self._lock = threading.Lock()
+        self.rejected = 0
+        self.opened = 0
+        CIRCUIT_STATE.labels(name).set(0)
+
+    def _set_state(self, state):
+        self._state = state
+        CIRCUIT_STATE.labels(self.name).set(_STATE_VALUES[state])
+
+    @property
+    def state(self):
+        with self._lock:
+            if self._state == OPEN and time.monotonic() - self._opened_at >= self.reset_timeout:
+                return HALF_OPEN
+            return self._state
+
+    def allow(self):
+        """Return True if a call may go ahead now."""
+        with self._lock:
+            if self._state == OPEN and time.monotonic() - self._opened_at >= self.reset_timeout:
+                self._set_state(HALF_OPEN)
+            if self._state == CLOSED:
+                return True
+            if self._state == HALF_OPEN and not self._trial_running:
+                self._trial_running = True
+                return True
+            self.rejected += 1
+            return False
+
+    def record_success(self):
+        with self._lock:
+            self._failures = 0
+            self._trial_running = False
+            if self._state != CLOSED:
+                print(f"Circuit {self.name} closed")
+                self._set_state(CLOSED)
+
+    def record_failure(self):
+        with self._lock:
+            self._failures += 1
+            self._trial_running = False
+            if self._state == HALF_OPEN or (self._state == CLOSED and self._failures >= self.failure_threshold):
+                print(f"Circuit {self.name} opened after {self._failures} failures")
+                self._set_state(OPEN)
+                self._opened_at = time.monotonic()
+                self.opened += 1
+
+    def record_abandoned(self):
+        """The call was cut short by its caller; count it neither way."""
+        with self._lock:
+            self._trial_running = False
+
+    def stats(self):
+        state = self.state
+        with self._lock:
+            return {
+                "state": state,
+                "consecutive_failures": self._failures,
+                "opened": self.opened,
+                "rejected": self.rejected
+            }
+
+
+def remaining_time(timeout):
+    """Seconds left for a call allowed `timeout`, capped by the current request's deadline."""
+    deadline = request_deadline.get()
+    if deadline is None:
+        return timeout
+    return min(timeout, deadline - time.time())
+
+
+def call_with_retries(breaker, fn, timeout, attempts=1, retryable=lambda e: True):
+    """Call fn(timeout=seconds) through breaker with bounded retries and a deadline.
+
+    timeout is the budget for the whole call, retries and backoff included;
+    fn receives what is left of it for each attempt. Exceptions for which
+    retryable(e) is true count against the breaker and are retried with
+    full-jitter exponential backoff; others (the dependency answered, but
+    rejected the request) are raised at once. An attempt that ran into the
+    request's deadline, which a client can set as low as it likes, raises
+    DeadlineExceeded and does not count against the breaker.
+    """
+    own_deadline = time.monotonic() + timeout
+    deadline = time.monotonic() + remaining_time(timeout)
+    for attempt in range(max(attempts, 1)):
+        left = deadline - time.monotonic()
+        if left <= 0:
+            raise DeadlineExceeded(f"{breaker.name}: deadline exceeded")
+        if not breaker.allow():
+            record_outcome(breaker.name, "circuit_open")
+            raise CircuitOpenError(f"{breaker.name} is unavailable (circuit open)")
+        try:
+            result = fn(timeout=left)
+        except Exception as e:
+            if not retryable(e):
+                breaker.record_success()
+                raise
+            if deadline < own_deadline and time.monotonic() >= deadline - DEADLINE_SLACK:
+                breaker.record_abandoned()
+                raise DeadlineExceeded(f"{breaker.name}: request deadline exceeded") from e
+            breaker.record_failure()
+            if attempt + 1 >= attempts:
+                raise
+            delay = random.uniform(0, min(RETRY_MAX_DELAY, RETRY_BASE_DELAY * 2 ** attempt))
+            print(f"{breaker.name} attempt {attempt + 1} failed ({e}); retrying in {delay:.2f}s")
+            time.sleep(min(delay, max(deadline - time.monotonic(), 0)))
+        else:
+            breaker.record_success()
+            return result
+    raise DeadlineExceeded(f"{breaker.name}: deadline exceeded")
+
+
+# One breaker per dependency, per process
+cloudinary_api_breaker = CircuitBreaker("cloudinary_api")  # upload / destroy
+cloudinary_cdn_breaker = CircuitBreaker("cloudinary_cdn")  # image downloads
+mongo_breaker = CircuitBreaker("mongo")
+
+
+def breaker_stats():
+    return {
+        breaker.name: breaker.stats()
+        for breaker in (cloudinary_api_breaker, cloudinary_cdn_breaker, mongo_breaker)
+    }
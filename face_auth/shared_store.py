@@ -0,0 +1,418 @@
+"""Encoding store shared by all gunicorn workers through memory-mapped files.
+
+A generation is a sorted, fixed-width email array, a float32 matrix and the
+image_url hash of every row, written once as .npy files and mapped read-only
+(np.load(mmap_mode="r")) by every worker, so the page cache holds one copy
+whatever the worker count. Changes are appended to the generation's log as
+fixed-size, checksummed records; readers replay complete records only, so a
+row being written is never seen half-done. When the log grows past
+SHARED_STORE_COMPACT_RECORDS a background thread folds it into a new
+generation and the CURRENT pointer is swapped with os.replace.
+
+Generations and records carry the encoding_signature() they were computed
+with. A generation from other settings (after a FACE_ENCODING_VERSION,
+landmark model or jitter change) is ignored until ensure_built replaces it,
+and log records from other settings are skipped.
+
+Set SHARED_STORE_DIR (local disk or /dev/shm) to enable it; write the first
+generation with `python -m face_auth.shared_store` or let the first worker
+build it from Mongo. While no usable generation exists, /identify retries the
+build (at most every SHARED_STORE_RETRY_SECONDS) and searches the worker's own
+gallery meanwhile.
+"""
+import fcntl
+import hashlib
+import json
+import os
+import threading
+import time
+import zlib
+from contextlib import contextmanager
+import numpy as np
+from face_auth.encodings import ENCODING_SIZE, encoding_signature, get_stored_encoding
+
+SHARED_STORE_DIR = os.getenv("SHARED_STORE_DIR", "")
+SHARED_STORE_COMPACT_RECORDS = int(os.getenv("SHARED_STORE_COMPACT_RECORDS", "10000"))
+SHARED_STORE_RETRY_SECONDS = float(os.getenv("SHARED_STORE_RETRY_SECONDS", "60"))  # between failed builds
+
+EMAIL_DTYPE = np.dtype("S254")  # Longest valid email address
+PUT, DELETE = 1, 2
+RECORD_DTYPE = np.dtype([
+    ("email", EMAIL_DTYPE),
+    ("op", "u1"),
+    ("url_hash", "<u8"),
+    ("vector", "<f4", (ENCODING_SIZE,)),
+    ("signature", "S32"),
+    ("crc", "<u4")
+])
+
+
+def url_hash(image_url):
+    return int.from_bytes(hashlib.blake2b((image_url or "").encode(), digest_size=8).digest(), "little")
+
+
+def _email_key(email):
+    return email.encode()[:EMAIL_DTYPE.itemsize]
+
+
+class SharedEncodingStore:
+    """Read-mostly view of the shared store, one per worker process."""
+
+    def __init__(self, directory):
+        self.directory = directory
+        self._lock = threading.Lock()
+        self._generation = None
+        self._signature = None
+        self._emails = self._matrix = self._hashes = None
+        self._overlay = {}  # email -> (url_hash, vector or None) from the log
+        self._log_offset = 0
+        self._compactor = None
+        self._compactor_pid = None
+        self._compactor_lock = threading.Lock()
+        self._compact_wanted = threading.Event()
+        self._build_retry_at = 0.0
+        os.makedirs(directory, exist_ok=True)
+
+    # ---- Files ----
+
+    def _path(self, name):
+        return os.path.join(self.directory, name)
+
+    def _current_generation(self):
+        try:
+            with open(self._path("CURRENT")) as f:
+                return int(f.read().strip())
+        except (OSError, ValueError):
+            return None
+
+    def _generation_signature(self, generation):
+        try:
+            with open(self._path(f"gen-{generation}-meta.json")) as f:
+                return json.load(f).get("signature")
+        except (OSError, ValueError):
+            return None  # Written before generations recorded their settings
+
+    @contextmanager
+    def _file_lock(self, name="store.lock", blocking=True):
+        """Yields True once the lock is held, or False if blocking is off and it is taken.
+
+        store.lock serialises log appends and generation swaps across worker
+        processes; compact.lock lets one process at a time write a new generation.
+        """
+        with open(self._path(name), "a") as lock_file:
+            try:
+                fcntl.flock(lock_file, fcntl.LOCK_EX | (0 if blocking else fcntl.LOCK_NB))
+            except BlockingIOError:
+                yield False
+                return
+            try:
+                yield True
+            finally:
+                fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+    # ---- Reading ----
+
+    def _load_generation(self, generation):
+        self._generation, self._overlay, self._log_offset = generation, {}, 0
+        self._signature = self._generation_signature(generation)
+        if self._signature != encoding_signature():
+            self._emails = self._matrix = self._hashes = None
+            return
+        prefix = self._path(f"gen-{generation}")
+        self._emails = np.load(f"{prefix}-emails.npy", mmap_mode="r")
+        self._matrix = np.load(f"{prefix}-matrix.npy", mmap_mode="r")
+        self._hashes = np.load(f"{prefix}-hashes.npy", mmap_mode="r")
+
+    def _refresh(self):
+        """Map a newer generation if one was published, then replay new log records.
+
+        Returns False while there is no usable generation: none was built yet,
+        or the current one holds encodings computed with other settings.
+        """
+        generation = self._current_generation()
+        if generation is None:
+            return False
+        if generation != self._generation:
+            self._load_generation(generation)
+        if self._signature != encoding_signature():
+            return False
+
+        log_path = self._path(f"gen-{generation}.log")
+        try:
+            size = os.path.getsize(log_path)
+        except OSError:
+            return True
+        complete = (size - self._log_offset) // RECORD_DTYPE.itemsize
+        if complete <= 0:
+            return True
+        signature = self._signature.encode()
+        with open(log_path, "rb") as f:
+            f.seek(self._log_offset)
+            data = f.read(complete * RECORD_DTYPE.itemsize)
+        for record_bytes, record in zip(
+                (data[i:i + RECORD_DTYPE.itemsize] for i in range(0, len(data), RECORD_DTYPE.itemsize)),
+                np.frombuffer(data, dtype=RECORD_DTYPE)):
+            if zlib.crc32(record_bytes[:-4]) != record["crc"]:
+                break  # Still being written; picked up on a later refresh
+            self._log_offset += RECORD_DTYPE.itemsize
+            if record["signature"] != signature:
+                continue  # Appended by a worker still running with other encoding settings
+            email = record["email"].decode()
+            self._overlay[email] = (int(record["url_hash"]),
+                                    record["vector"].copy() if record["op"] == PUT else None)
+        return True
+
+    def get(self, email, image_url):
+        """Return the encoding stored for email and image_url, or None."""
+        with self._lock:
+            if not self._refresh():
+                return None
+            expected = url_hash(image_url)
+            if email in self._overlay:
+                stored_hash, vector = self._overlay[email]
+                return vector if vector is not None and stored_hash == expected else None
+            key = _email_key(email)
+            row = int(np.searchsorted(self._emails, key))
+            if row < len(self._emails) and self._emails[row] == key and self._hashes[row] == expected:
+                return np.asarray(self._matrix[row])
+            return None
+
+    def search(self, encoding, k=5, threshold=0.4):
+        """Return up to k (email, distance) pairs closest to encoding, nearest first."""
+        probe = np.asarray(encoding, dtype=np.float32)
+        with self._lock:
+            if not self._refresh():
+                return []
+            distances = np.linalg.norm(self._matrix - probe, axis=1) if len(self._emails) else np.empty(0)
+            # Enough nearest rows that k remain after dropping those the log has replaced
+            count = min(k + len(self._overlay), len(distances))
+            rows = np.argpartition(distances, count - 1)[:count] if count else []
+            candidates = {}
+            for row in rows:
+                email = self._emails[row].decode()
+                if email not in self._overlay:
+                    candidates[email] = float(distances[row])
+            for email, (_, vector) in self._overlay.items():
+                if vector is not None:
+                    candidates[email] = float(np.linalg.norm(vector - probe))
+        matches = sorted(candidates.items(), key=lambda item: item[1])[:k]
+        return [(email, distance) for email, distance in matches if distance <= threshold]
+
+    def ready(self):
+        """True once a generation built with the current encoding settings is mapped."""
+        with self._lock:
+            return self._refresh()
+
+    def stats(self):
+        with self._lock:
+            self._refresh()
+            return {
+                "generation": self._generation,
+                "signature": self._signature,
+                "rows": 0 if self._emails is None else len(self._emails),
+                "log_records": len(self._overlay),
+                "mapped_mb": 0 if self._matrix is None else round(self._matrix.nbytes / 2 ** 20, 2)
+            }
+
+    # ---- Writing ----
+
+    def _append(self, email, op, image_url, vector):
+        if len(email.encode()) > EMAIL_DTYPE.itemsize:
+            return
+        record = np.zeros(1, dtype=RECORD_DTYPE)
+        record["email"] = _email_key(email)
+        record["op"] = op
+        record["url_hash"] = url_hash(image_url)
+        if vector is not None:
+            record["vector"] = np.asarray(vector, dtype=np.float32)
+        record["signature"] = encoding_signature().encode()
+        record["crc"] = zlib.crc32(record.tobytes()[:-4])
+        with self._file_lock():
+            generation = self._current_generation()
+            if generation is None:
+                return  # Nothing built yet; the first build reads Mongo
+            log_path = self._path(f"gen-{generation}.log")
+            with open(log_path, "ab") as f:
+                # Drop the partial record of a writer that died mid-append, or every later record is misaligned
+                torn = f.tell() % RECORD_DTYPE.itemsize
+                if torn:
+                    f.truncate(f.tell() - torn)
+                    f.seek(0, os.SEEK_END)
+                f.write(record.tobytes())
+                size = f.tell()
+        if size >= SHARED_STORE_COMPACT_RECORDS * RECORD_DTYPE.itemsize:
+            self._request_compaction()
+
+    def publish(self, email, encoding, image_url):
+        self._append(email, PUT, image_url, encoding)
+
+    def remove(self, email):
+        self._append(email, DELETE, "", None)
+
+    def _write_arrays(self, generation, emails, matrix, hashes):
+        """Write a generation's files; nothing reads them until _publish points CURRENT at them."""
+        order = np.argsort(emails)
+        prefix = self._path(f"gen-{generation}")
+        for name, array in (("emails", emails[order]), ("matrix", matrix[order]), ("hashes", hashes[order])):
+            np.save(f"{prefix}-{name}.tmp.npy", array)
+            os.replace(f"{prefix}-{name}.tmp.npy", f"{prefix}-{name}.npy")
+        with open(f"{prefix}-meta.json", "w") as f:
+            json.dump({"signature": encoding_signature(), "rows": len(emails)}, f)
+
+    def _publish(self, generation, log_records=b""):
+        """Start the generation's log, then point CURRENT at it (caller holds store.lock)."""
+        with open(self._path(f"gen-{generation}.log"), "wb") as f:
+            f.write(log_records)
+        with open(self._path("CURRENT.tmp"), "w") as f:
+            f.write(str(generation))
+        os.replace(self._path("CURRENT.tmp"), self._path("CURRENT"))
+        # Workers still mapping older generations keep them until they refresh (unlinked files stay mapped)
+        for name in os.listdir(self.directory):
+            if name.startswith("gen-") and int(name[4:].split("-")[0].split(".")[0]) < generation - 1:
+                os.remove(self._path(name))
+        print(f"Shared encoding store generation {generation} ({encoding_signature()})")
+
+    def compact(self, min_records=0):
+        """Fold the current log into a new generation. Returns True if a new generation was published.
+
+        The new arrays are written without holding store.lock, so appends from
+        requests carry on meanwhile; the lock is only taken to move the records
+        appended since then into the new log and swap CURRENT.
+        """
+        with self._file_lock("compact.lock", blocking=False) as locked:
+            if not locked:
+                return False  # Another process is compacting
+            reader = SharedEncodingStore(self.directory)
+            if not reader._refresh():
+                return False
+            generation = reader._generation
+            if reader._log_offset < max(min_records, 1) * RECORD_DTYPE.itemsize:
+                return False
+
+            keep = np.array([email.decode() not in reader._overlay for email in reader._emails], dtype=bool)
+            puts = [(email, value) for email, value in reader._overlay.items() if value[1] is not None]
+            emails = np.concatenate([np.asarray(reader._emails)[keep],
+                                     np.array([_email_key(email) for email, _ in puts], dtype=EMAIL_DTYPE)])
+            matrix = np.concatenate([np.asarray(reader._matrix)[keep],
+                                     np.array([vector for _, (_, vector) in puts], dtype=np.float32)
+                                     .reshape(-1, ENCODING_SIZE)])
+            hashes = np.concatenate([np.asarray(reader._hashes)[keep],
+                                     np.array([hashed for _, (hashed, _) in puts], dtype=np.uint64)])
+            self._write_arrays(generation + 1, emails, matrix, hashes)
+
+            with self._file_lock():
+                if self._current_generation() != generation:
+                    return False
+                with open(self._path(f"gen-{generation}.log"), "rb") as f:
+                    f.seek(reader._log_offset)
+                    tail = f.read()
+                self._publish(generation + 1, tail[:len(tail) - len(tail) % RECORD_DTYPE.itemsize])
+            return True
+
+    def _request_compaction(self):
+        """Wake this process's compaction thread (started on first use, again after a fork)."""
+        with self._compactor_lock:
+            if self._compactor is None or not self._compactor.is_alive() or self._compactor_pid != os.getpid():
+                self._compactor = threading.Thread(target=self._run_compactor, name="shared-store-compactor",
+                                                   daemon=True)
+                self._compactor_pid = os.getpid()
+                self._compactor.start()
+        self._compact_wanted.set()
+
+    def _run_compactor(self):
+        while True:
+            self._compact_wanted.wait()
+            self._compact_wanted.clear()
+            try:
+                self.compact(SHARED_STORE_COMPACT_RECORDS)
+            except Exception as e:
+                print(f"Shared encoding store compaction failed: {e}")
+
+    def build(self, collection):
+        """Write a new generation from every current encoding in Mongo.
+
+        Holds store.lock for the whole scan, so updates published meanwhile
+        wait and land in the new generation's log instead of being lost.
+        """
+        with self._file_lock("compact.lock"), self._file_lock():
+            self._build(collection)
+
+    def _build(self, collection, batch_size=5000):
+        emails, vectors, hashes = [], [], []
+        cursor = collection.find(
+            {"face_encoding": {"$exists": True}},
+            {"email": 1, "image_url": 1, "face_encoding": 1, "encoding_version": 1, "encoding_image_url": 1}
+        ).batch_size(batch_size)
+        for user in cursor:
+            encoding = get_stored_encoding(user)
+            if encoding is not None and len(user["email"].encode()) <= EMAIL_DTYPE.itemsize:
+                emails.append(_email_key(user["email"]))
+                vectors.append(encoding)
+                hashes.append(url_hash(user["image_url"]))
+        generation = (self._current_generation() or 0) + 1
+        self._write_arrays(
+            generation, np.array(emails, dtype=EMAIL_DTYPE),
+            np.array(vectors, dtype=np.float32).reshape(-1, ENCODING_SIZE), np.array(hashes, dtype=np.uint64))
+        self._publish(generation)
+
+    def _needs_build(self):
+        generation = self._current_generation()
+        return generation is None or self._generation_signature(generation) != encoding_signature()
+
+    def ensure_built(self, collection):
+        """Build a generation unless another worker already has one for the current encoding settings."""
+        if self._needs_build():
+            with self._file_lock("compact.lock"), self._file_lock():
+                if self._needs_build():
+                    self._build(collection)
+
+    def ensure_ready(self, collection):
+        """ready(), building a missing or outdated generation first; for the request path.
+
+        A failed build is logged and not retried for SHARED_STORE_RETRY_SECONDS,
+        so callers fall back to another index instead of rebuilding on every request.
+        """
+        if self.ready():
+            return True
+        with self._lock:
+            now = time.monotonic()
+            if now < self._build_retry_at:
+                return False
+            self._build_retry_at = now + SHARED_STORE_RETRY_SECONDS
+        try:
+            self.ensure_built(collection)
+        except Exception as e:
+            print(f"Failed to build the shared encoding store: {e}")
+            return False
+        return self.ready()
+
+
+# One reader per worker process, or None when SHARED_STORE_DIR is unset
+encoding_store = SharedEncodingStore(SHARED_STORE_DIR) if SHARED_STORE_DIR else None
+
+
+def lookup_encoding(email, image_url):
+    """Encoding for email as published for image_url, or None (also without a shared store)."""
+    return encoding_store.get(email, image_url) if encoding_store is not None else None
+
+
+def publish_encoding(email, encoding, image_url):
+    """Make a new encoding visible to every worker (no-op without a shared store)."""
+    if encoding_store is not None:
+        encoding_store.publish(email, encoding, image_url)
+
+
+def unpublish_encoding(email):
+    if encoding_store is not None:
+        encoding_store.remove(email)
+
+
+def main():
+    from face_auth.utils import users_collection
+    if encoding_store is None:
+        raise SystemExit("Set SHARED_STORE_DIR to the store directory")
+    encoding_store.build(users_collection)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,98 @@
+import hashlib
+import threading
+from face_auth.metrics import COALESCED
+from face_auth.resilience import DeadlineExceeded
+
+
+class _Call:
+
+    def __init__(self):
+        self.done = threading.Event()
+        self.result = None
+        self.error = None
+
+
+class SingleFlight:
+    """Per-user single-flight execution.
+
+    Concurrent calls with the same (user, operation, fingerprint) share one
+    execution: the first caller runs fn and the others wait for its result (a
+    double-submitted login is encoded once). Different operations for the
+    same user run one at a time. Coordination is per process; across gunicorn
+    workers the Mongo updates themselves are guarded.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._calls = {}  # (user, operation, fingerprint) -> _Call
+        self._user_locks = {}  # user -> [lock, callers holding a reference]
+        self.executed = 0
+        self.coalesced = 0
+
+    def do(self, user, operation, fingerprint, fn, timeout):
+        """Run fn() once for all concurrent identical calls and return its result to each.
+
+        Raises DeadlineExceeded if the result (or the user's turn) does not come within timeout
+        seconds, and at once if timeout is not positive (the request's deadline has passed).
+        """
+        if timeout <= 0:
+            raise DeadlineExceeded(f"{operation}: request deadline exceeded")
+        key = (user, operation, fingerprint)
+        with self._lock:
+            call = self._calls.get(key)
+            leader = call is None
+            if leader:
+                call = self._calls[key] = _Call()
+                entry = self._user_locks.setdefault(user, [threading.Lock(), 0])
+                entry[1] += 1
+                self.executed += 1
+            else:
+                self.coalesced += 1
+
+        if not leader:
+            COALESCED.labels(operation).inc()
+            if not call.done.wait(timeout):
+                raise DeadlineExceeded(f"{operation}: timed out waiting for an identical request")
+            if call.error is not None:
+                raise call.error
+            return call.result
+
+        try:
+            # Another operation for this user (e.g. a re-capture during a login) goes first
+            if not entry[0].acquire(timeout=timeout):
+                raise DeadlineExceeded(f"{operation}: timed out waiting for another request of this user")
+            try:
+                call.result = fn()
+            finally:
+                entry[0].release()
+        except Exception as e:
+            call.error = e
+            raise
+        finally:
+            with self._lock:
+                del self._calls[key]
+                entry[1] -= 1
+                if entry[1] == 0:
+                    del self._user_locks[user]
+            call.done.set()
+        return call.result
+
+    def stats(self):
+        with self._lock:
+            return {
+                "in_flight": len(self._calls),
+                "executed": self.executed,
+                "coalesced": self.coalesced
+            }
+
+
+def request_fingerprint(data, fields=()):
+    """Digest of the uploaded bytes and form fields that identifies an identical resubmission."""
+    digest = hashlib.blake2b(data, digest_size=16)
+    for name, value in fields:
+        digest.update(f"\0{name}={value}".encode())
+    return digest.hexdigest()
+
+
+# One per worker process
+single_flight = SingleFlight()
@@ -0,0 +1,77 @@
+import os
+import time
+from pymongo.errors import DuplicateKeyError
+from face_auth.utils import users_collection
+from face_auth.outbox import ensure_outbox_indexes
+
+# Seconds after which an unfinished registration is considered abandoned (well past
+# REQUEST_DEADLINE and the gunicorn timeout, so no live request still owns it)
+REGISTRATION_PENDING_TIMEOUT = float(os.getenv("REGISTRATION_PENDING_TIMEOUT", "300"))
+
+# Everything login_user needs: the response fields plus the stored face data
+LOGIN_PROJECTION = {
+    field: 1 for field in (
+        "firstName", "lastName", "companyId", "companyName", "designation", "email", "phone",
+        "status", "role", "isNewUser", "token", "dailyTotalWorkingHour", "weeklyTotalWorkingHour",
+        "requiresPasswordReset", "empCode", "name", "mobile", "mac_address",
+        "image_url", "face_encoding", "encoding_version", "encoding_image_url",
+        "face_templates", "templates_version"
+    )
+}
+
+
+def ensure_indexes():
+    """Create the indexes the app relies on (idempotent)."""
+    users_collection.create_index("email", unique=True, name="email_unique")
+    ensure_outbox_indexes()
+
+
+def find_user(email, projection=LOGIN_PROJECTION):
+    """Fetch one user by email (index-backed) with only the projected fields, or None.
+
+    A registration still in progress is not a user yet, so it is not returned.
+    """
+    return users_collection.find_one({"email": email, "registration": {"$ne": "pending"}}, projection)
+
+
+def reserve_user(email, name, mobile):
+    """Atomically claim email for a new registration. Returns the new _id, or None if taken.
+
+    The unique email index makes this safe against concurrent registrations;
+    the placeholder is completed with complete_user or removed with release_user.
+    A placeholder older than REGISTRATION_PENDING_TIMEOUT was left by a worker
+    that died mid-registration, and is taken over.
+    """
+    now = time.time()
+    try:
+        result = users_collection.update_one(
+            {"email": email},
+            {"$setOnInsert": {"email": email, "name": name, "mobile": mobile,
+                              "registration": "pending", "reserved_at": now}},
+            upsert=True
+        )
+    except DuplicateKeyError:
+        return None
+    if result.upserted_id is not None:
+        return result.upserted_id
+
+    stale = users_collection.find_one_and_update(
+        {"email": email, "registration": "pending", "$or": [
+            {"reserved_at": {"$lt": now - REGISTRATION_PENDING_TIMEOUT}},
+            {"reserved_at": {"$exists": False}}  # Placeholders from before reserved_at was recorded
+        ]},
+        {"$set": {"name": name, "mobile": mobile, "reserved_at": now}},
+        projection={"_id": 1}
+    )
+    if stale is None:
+        return None
+    print(f"Took over a stale pending registration for {email}")
+    return stale["_id"]
+
+
+def complete_user(user_id, fields):
+    users_collection.update_one({"_id": user_id}, {"$set": fields, "$unset": {"registration": "", "reserved_at": ""}})
+
+
+def release_user(user_id):
+    users_collection.delete_one({"_id": user_id, "registration": "pending"})
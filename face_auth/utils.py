@@ -1,23 +1,40 @@
+import io
 import time
 import cv2
 import os
-import face_recognition
 import numpy as np
 import requests
 from getmac import get_mac_address
 import cloudinary.uploader
+import cloudinary.exceptions
 from face_auth.cloudinary_config import cloudinary  # Import Cloudinary configuration
 from face_auth.db import db_connection
-from dotenv import load_dotenv
+from face_auth.http_session import http_get, HTTP_TIMEOUT
+from face_auth.metrics import timed, record_outcome
+from face_auth.resilience import (call_with_retries, cloudinary_api_breaker, cloudinary_cdn_breaker,
+                                  CircuitOpenError, DeadlineExceeded)
 
-load_dotenv()
 CLOUDINARY_FOLDER = os.getenv("CLOUDINARY_FOLDER", "face_recognition")
+# Budget per Cloudinary call, retries included (seconds), and attempts per call
+CLOUDINARY_TIMEOUT = float(os.getenv("CLOUDINARY_TIMEOUT", "15"))
+CLOUDINARY_UPLOAD_ATTEMPTS = int(os.getenv("CLOUDINARY_UPLOAD_ATTEMPTS", "2"))
+CLOUDINARY_DELETE_ATTEMPTS = int(os.getenv("CLOUDINARY_DELETE_ATTEMPTS", "3"))
+
+# Errors where Cloudinary answered and refused the request; retrying cannot help
+_CLOUDINARY_CLIENT_ERRORS = (
+    cloudinary.exceptions.BadRequest, cloudinary.exceptions.AuthorizationRequired,
+    cloudinary.exceptions.NotAllowed, cloudinary.exceptions.NotFound, cloudinary.exceptions.AlreadyExists
+)
+
+
+def _cloudinary_retryable(error):
+    return not isinstance(error, _CLOUDINARY_CLIENT_ERRORS)
 
 # Fetch DB name from environment variable
 db_name = os.getenv("MONGO_DB_NAME", "face_auth_db")  # Default to 'face_auth_db' if not set
 collection_name = os.getenv("MONGO_COLLECTION_NAME", "users")  # Default 'users'
 
-# Create Database Connection
+# Database handle backed by the shared, pooled per-process client
 db = db_connection(db_name)
 
 # Fetch Collection Name from .env
@@ -28,94 +45,108 @@ def get_device_mac():
     mac = get_mac_address()
     return mac if mac else "Unknown"
 
+# Function to decode uploaded image bytes into an OpenCV (BGR) image
+def decode_image(data):
+    if not data:
+        return None
+    img_array = np.frombuffer(data, np.uint8)
+    image = cv2.imdecode(img_array, cv2.IMREAD_COLOR)
+    return image if image is not None else None  # None for invalid image data
+
 # Function to Resize Image (Maintaining Aspect Ratio)
-def resize_image(image_path, width=500):
-    image = cv2.imread(image_path)
+def resize_image(image, width=500):
     if image is None:
-        return None  # Invalid image file
+        return None  # Invalid image
 
     height = int((image.shape[0] / image.shape[1]) * width)  # Maintain aspect ratio
-    resized_image = cv2.resize(image, (width, height))  # Resize image
+    return cv2.resize(image, (width, height))  # Resize image
 
-    cv2.imwrite(image_path, resized_image)  # Overwrite original image with resized image
-    return image_path
+# Function to encode an OpenCV image as JPEG bytes for upload
+def encode_jpeg(image, quality=95):
+    ok, buffer = cv2.imencode(".jpg", image, [cv2.IMWRITE_JPEG_QUALITY, quality])
+    return buffer.tobytes() if ok else None
 
-# Function to upload image to Cloudinary
-def upload_to_cloudinary(image_path, folder=CLOUDINARY_FOLDER):
+# Function to upload image to Cloudinary (file path, JPEG bytes or OpenCV image)
+def upload_to_cloudinary(image, folder=CLOUDINARY_FOLDER):
     try:
-        print(f"Uploading image: {image_path}")
-
-        if not os.path.exists(image_path):
-            print(f"Error: Image file {image_path} does not exist!")
-            return None
+        if isinstance(image, np.ndarray):
+            image = encode_jpeg(image)
+            if image is None:
+                print("Error: Could not encode image for upload!")
+                return None
+
+        if isinstance(image, (bytes, bytearray)):
+            print(f"Uploading image: {len(image)} bytes")
+            upload_file = io.BytesIO(image)  # Uploaded straight from memory, no temp file
+        else:
+            print(f"Uploading image: {image}")
+            if not os.path.exists(image):
+                print(f"Error: Image file {image} does not exist!")
+                return None
+            upload_file = image
 
         timestamp = int(time.time())  # Get the correct UNIX timestamp
 
-        response = cloudinary.uploader.upload(
-            image_path,
-            folder=folder,
-            timestamp=timestamp
-        )
+        def upload(timeout):
+            if hasattr(upload_file, "seek"):
+                upload_file.seek(0)  # A retry re-sends the whole image
+            return cloudinary.uploader.upload(
+                upload_file,
+                folder=folder,
+                timestamp=timestamp,
+                timeout=timeout
+            )
+
+        with timed("cloudinary_upload"):
+            response = call_with_retries(cloudinary_api_breaker, upload, CLOUDINARY_TIMEOUT,
+                                         CLOUDINARY_UPLOAD_ATTEMPTS, _cloudinary_retryable)
 
         # print("Cloudinary Response:", response)
         return response.get("secure_url")
+    except (CircuitOpenError, DeadlineExceeded) as e:
+        # Not a failed upload: the caller answers 503 so the client retries later
+        print(f"Cloudinary upload unavailable: {e}")
+        raise
     except Exception as e:
         print(f"Cloudinary upload error: {e}")
-        return None
-    except Exception as e:
-        print(f"Unexpected error: {e}")
+        record_outcome("cloudinary_upload", "upstream_error")
         return None
 
 
 # Function to get Cloudinary Image as OpenCV format
 
-def get_cloudinary_image(url):
+def fetch_cloudinary_response(url):
+    """Download a Cloudinary image without decoding it.
+
+    Returns (data, status): the raw bytes or None, and the HTTP status or
+    None when no response arrived (timeout, connection error, open breaker).
+    """
     try:
-        response = requests.get(url, timeout=10)
+        # The session already retries with backoff; the breaker stops calls while the CDN is down
+        with timed("cloudinary_fetch"):
+            response = call_with_retries(cloudinary_cdn_breaker, lambda timeout: http_get(url, timeout=timeout),
+                                         HTTP_TIMEOUT, retryable=lambda e: isinstance(e, requests.RequestException))
         if response.status_code != 200:
-            return None
-        # Convert to NumPy array and load into OpenCV
-        img_array = np.frombuffer(response.content, np.uint8)
-        image = cv2.imdecode(img_array, cv2.IMREAD_COLOR)
-        return image if image is not None else None
-    except requests.RequestException as e:
+            record_outcome("cloudinary_fetch", "upstream_error")
+            return None, response.status_code
+        return response.content, response.status_code
+    except (requests.RequestException, CircuitOpenError, DeadlineExceeded) as e:
         print(f"Cloudinary image fetch error: {e}")
-        return None
+        record_outcome("cloudinary_fetch", "upstream_error")
+        return None, None
 
-def upload_to_cloudinary_use_login(image, folder=CLOUDINARY_FOLDER):
-    try:
-        # If the image is a numpy array (e.g., from webcam), save it as a temporary file
-        if isinstance(image, np.ndarray):  # Check if the input is a numpy array (image frame)
-            # Create a temporary file to save the image (using time-based naming)
-            timestamp = int(time.time())  # Generate a unique timestamp for file naming
-            temp_file_path = f"temp_image_{timestamp}.jpg"
-            cv2.imwrite(temp_file_path, image)  # Save the numpy array to a .jpg file
-            image_path = temp_file_path  # Update image_path to point to the temporary file
-        else:
-            # If the image is already a file path (for mobile upload), use it directly
-            image_path = image
-
-        print(f"Uploading image: {image_path}")
+def fetch_cloudinary_bytes(url):
+    """Download a Cloudinary image without decoding it; returns the raw bytes or None."""
+    return fetch_cloudinary_response(url)[0]
 
-        if not os.path.exists(image_path):
-            print(f"Error: Image file {image_path} does not exist!")
-            return None
-
-        # Upload the image file to Cloudinary
-        response = cloudinary.uploader.upload(
-            image_path,
-            folder=folder,
-            timestamp=int(time.time())
-        )
-
-        # Clean up by removing the temporary image file if it was created
-        if isinstance(image, np.ndarray):
-            os.remove(image_path)
+def get_cloudinary_image(url):
+    data = fetch_cloudinary_bytes(url)
+    # Convert to NumPy array and load into OpenCV
+    return decode_image(data) if data is not None else None
 
-        return response.get("secure_url")
-    except Exception as e:
-        print(f"Cloudinary upload error: {e}")
-        return None
+def upload_to_cloudinary_use_login(image, folder=CLOUDINARY_FOLDER):
+    # Numpy frames (e.g. from webcam) and file paths are both handled by upload_to_cloudinary
+    return upload_to_cloudinary(image, folder=folder)
 
 
 def delete_cloudinary_image(image_url):
@@ -126,7 +157,12 @@ def delete_cloudinary_image(image_url):
 
         print(f"Deleting Cloudinary Image: {public_id}")  # Debugging
 
-        response = cloudinary.uploader.destroy(public_id)
+        with timed("cloudinary_delete"):
+            response = call_with_retries(
+                cloudinary_api_breaker,
+                lambda timeout: cloudinary.uploader.destroy(public_id, timeout=timeout),
+                CLOUDINARY_TIMEOUT, CLOUDINARY_DELETE_ATTEMPTS, _cloudinary_retryable
+            )
 
         if response.get("result") == "ok":
             print("✅ Old image deleted successfully.")
@@ -137,6 +173,7 @@ def delete_cloudinary_image(image_url):
 
     except Exception as e:
         print(f"❌ Error deleting image from Cloudinary: {e}")
+        record_outcome("cloudinary_delete", "upstream_error")
         return False
 
 
@@ -194,6 +231,7 @@ def delete_cloudinary_image(image_url):
 
 
 def detect_face_encoding(image):
+    import face_recognition
     rgb_image = cv2.cvtColor(image, cv2.COLOR_BGR2RGB)
     encodings = face_recognition.face_encodings(rgb_image)
     return encodings[0] if encodings else None
\ No newline at end of file
@@ -0,0 +1,188 @@
+import os
+import time
+import atexit
+import threading
+import contextvars
+import multiprocessing
+import numpy as np
+from concurrent.futures import Future, ProcessPoolExecutor, TimeoutError as FutureTimeoutError
+from concurrent.futures.process import BrokenProcessPool
+
+# 0 runs detection/encoding inline on the request thread
+FACE_POOL_WORKERS = int(os.getenv("FACE_POOL_WORKERS", str(os.cpu_count() or 1)))
+FACE_POOL_QUEUE_DEPTH = int(os.getenv("FACE_POOL_QUEUE_DEPTH", str(FACE_POOL_WORKERS * 4)))
+FACE_POOL_TIMEOUT = float(os.getenv("FACE_POOL_TIMEOUT", "20"))  # seconds per task
+FACE_POOL_START_METHOD = os.getenv("FACE_POOL_START_METHOD", "spawn")
+
+
+class FacePoolError(Exception):
+    """Detection/encoding could not be run; the request should be retried later."""
+
+
+class FacePoolBusy(FacePoolError):
+    pass
+
+
+class FacePoolTimeout(FacePoolError):
+    pass
+
+
+class FaceDeadlineExceeded(FacePoolError):
+    pass
+
+
+# Wall-clock (time.time()) deadline of the request being served, set by admission control
+request_deadline = contextvars.ContextVar("request_deadline", default=None)
+
+
+def _check_deadline(deadline):
+    if deadline is not None and time.time() >= deadline:
+        raise FaceDeadlineExceeded("Request deadline passed before face processing started")
+
+
+# ---- Functions below run inside the pool processes ----
+
+def warm_up_models():
+    """Load the dlib models and run one dummy detection + encoding so the first task is fast."""
+    import face_recognition
+    blank = np.zeros((64, 64, 3), dtype=np.uint8)
+    face_recognition.face_locations(blank)
+    face_recognition.face_encodings(blank, known_face_locations=[(0, 63, 63, 0)])
+
+
+def _started():
+    return os.getpid()
+
+
+def _encode_image(image):
+    from face_auth.preprocess import detect_and_encode
+    return detect_and_encode(image)
+
+
+def _run_before_deadline(deadline, fn, *args):
+    # A task that waited in the queue past its request's deadline is dropped unstarted
+    _check_deadline(deadline)
+    return fn(*args)
+
+
+# ---- Pool management (request side) ----
+
+_pool = None
+_pool_pid = None
+_pool_lock = threading.Lock()
+_slots = threading.BoundedSemaphore(max(FACE_POOL_QUEUE_DEPTH, 1))
+
+
+def _get_pool():
+    global _pool, _pool_pid
+    with _pool_lock:
+        # A pool inherited across fork (e.g. gunicorn preload) belongs to the parent
+        if _pool is None or _pool_pid != os.getpid():
+            context = multiprocessing.get_context(FACE_POOL_START_METHOD)
+            _pool = ProcessPoolExecutor(max_workers=FACE_POOL_WORKERS, mp_context=context,
+                                        initializer=warm_up_models)
+            _pool_pid = os.getpid()
+        return _pool
+
+
+def _discard_pool(pool):
+    global _pool
+    with _pool_lock:
+        if _pool is pool:
+            _pool = None
+    pool.shutdown(wait=False, cancel_futures=True)
+
+
+def submit_face_task(fn, *args):
+    """Start fn(*args) in the face pool and return its future; collect it with face_task_result.
+
+    Raises FacePoolBusy when FACE_POOL_QUEUE_DEPTH tasks are already pending and
+    FaceDeadlineExceeded when the current request's deadline has passed.
+    Without a pool (FACE_POOL_WORKERS=0) fn runs inline and the future is already done.
+    """
+    deadline = request_deadline.get()
+    _check_deadline(deadline)
+    if FACE_POOL_WORKERS <= 0:
+        future = Future()
+        try:
+            future.set_result(fn(*args))
+        except Exception as e:
+            future.set_exception(e)
+        return future
+
+    if not _slots.acquire(blocking=False):
+        raise FacePoolBusy("Face processing queue is full. Try again shortly.")
+
+    pool = _get_pool()
+    try:
+        future = pool.submit(_run_before_deadline, deadline, fn, *args)
+    except (BrokenProcessPool, RuntimeError) as e:
+        _slots.release()
+        _discard_pool(pool)
+        raise FacePoolError(f"Face processing pool unavailable: {e}")
+    future.add_done_callback(lambda _: _slots.release())
+    future.face_pool = pool
+    return future
+
+
+def face_task_result(future, timeout=FACE_POOL_TIMEOUT):
+    """Wait at most timeout seconds for a submitted task. Raises FacePoolTimeout when it is late.
+
+    The wait is also cut short at the current request's deadline.
+    """
+    deadline = request_deadline.get()
+    if deadline is not None:
+        timeout = max(min(timeout, deadline - time.time()), 0)
+    try:
+        return future.result(timeout=timeout)
+    except FutureTimeoutError:
+        future.cancel()
+        raise FacePoolTimeout("Face processing timed out")
+    except BrokenProcessPool as e:
+        _discard_pool(future.face_pool)
+        raise FacePoolError(f"Face processing pool crashed: {e}")
+
+
+def run_face_task(fn, *args, timeout=FACE_POOL_TIMEOUT):
+    """Run fn(*args) in the face pool and wait at most timeout seconds for the result.
+
+    Raises FacePoolBusy when FACE_POOL_QUEUE_DEPTH tasks are already pending and
+    FacePoolTimeout when the task does not finish in time.
+    """
+    return face_task_result(submit_face_task(fn, *args), timeout)
+
+
+def encode_image(image):
+    """Detect faces in an OpenCV (BGR) image and encode the first one. Returns a FaceResult."""
+    return run_face_task(_encode_image, image)
+
+
+def submit_encode_image(image):
+    """Start encode_image in the background; returns a future for face_task_result."""
+    return submit_face_task(_encode_image, image)
+
+
+def prestart_pool():
+    """Start this process's face pool now, so the first request pays neither process start-up nor model loading.
+
+    Returns without waiting for the pool processes to finish warming up.
+    Without a pool (FACE_POOL_WORKERS=0) the models are warmed inline.
+    """
+    if FACE_POOL_WORKERS <= 0:
+        warm_up_models()
+        return
+    pool = _get_pool()
+    # The executor starts processes as tasks arrive; one task per worker starts all of them
+    for _ in range(FACE_POOL_WORKERS):
+        pool.submit(_started)
+
+
+def shutdown_pool(wait=True):
+    global _pool
+    with _pool_lock:
+        pool, _pool = _pool, None
+    if pool is not None and _pool_pid == os.getpid():
+        pool.shutdown(wait=wait, cancel_futures=True)
+
+
+atexit.register(shutdown_pool)
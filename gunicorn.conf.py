@@ -0,0 +1,48 @@
+import os
+import time
+
+# FACE_PRELOAD=true imports the app once in the master and starts each worker's face
+# pool as soon as the worker boots, so the first request does not wait for pool
+# processes to start and load the dlib models. Mongo clients and HTTP sessions are
+# still created lazily inside each worker after fork. The master only warms the
+# models itself when that helps: with FACE_POOL_WORKERS=0 (workers encode inline)
+# or FACE_POOL_START_METHOD=fork (pool processes inherit them copy-on-write).
+preload_app = os.getenv("FACE_PRELOAD", "false").lower() in ("1", "true", "yes")
+
+# Face work runs in each worker's process pool (FACE_POOL_WORKERS processes, all
+# cores by default), so a worker must have enough requests in flight to keep that
+# pool busy and let admission control queue and shed. The sync worker serves one
+# request at a time; gthread serves `threads` at once. One or two workers per
+# machine is enough: every worker starts its own pool.
+worker_class = os.getenv("GUNICORN_WORKER_CLASS", "gthread")
+workers = int(os.getenv("WEB_CONCURRENCY", "1"))
+
+
+def _default_threads():
+    # Every admitted request plus every queued one needs a thread of its own
+    from face_auth.admission import ADMISSION_CONCURRENCY, ADMISSION_QUEUE_DEPTH
+    return max(ADMISSION_CONCURRENCY + ADMISSION_QUEUE_DEPTH, 4)
+
+
+threads = int(os.getenv("GUNICORN_THREADS", "0")) or _default_threads()
+
+_fork_times = {}
+
+
+def post_fork(server, worker):
+    _fork_times[worker.pid] = time.perf_counter()
+
+
+def post_worker_init(worker):
+    if preload_app:
+        from face_auth.workers import prestart_pool
+        prestart_pool()
+    started = _fork_times.pop(worker.pid, None)
+    if started is not None:
+        worker.log.info("Worker %s ready in %.1f ms", worker.pid, (time.perf_counter() - started) * 1000)
+
+
+def child_exit(server, worker):
+    # Only meaningful with PROMETHEUS_MULTIPROC_DIR set; see face_auth/metrics.py
+    from face_auth.metrics import mark_process_dead
+    mark_process_dead(worker.pid)
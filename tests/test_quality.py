@@ -0,0 +1,58 @@
+import cv2
+import numpy as np
+import pytest
+from face_auth import quality
+from face_auth.quality import assess_image, check_quality
+
+
+def noise(size, low, high, seed=0):
+    """A sharp, evenly textured frame with gray levels in [low, high)."""
+    return np.random.default_rng(seed).integers(low, high, size=(size, size, 3), dtype=np.uint8)
+
+
+@pytest.fixture(params=["haar", "off"])
+def face_detector(request, monkeypatch):
+    monkeypatch.setattr(quality, "QUALITY_FACE_DETECTOR", request.param)
+    return request.param
+
+
+def test_sharp_well_exposed_image_passes(face_detector):
+    result = assess_image(noise(400, 60, 200))
+    assert result.ok and result.reason is None
+
+
+def test_tiny_image_is_rejected(face_detector):
+    assert assess_image(noise(80, 60, 200)).reason == "image_too_small"
+
+
+def test_flat_image_is_rejected_as_blurry(face_detector):
+    assert assess_image(np.full((400, 400, 3), 128, dtype=np.uint8)).reason == "image_blurry"
+
+
+def test_dark_and_overexposed_images_are_rejected(face_detector):
+    assert assess_image(noise(400, 0, 40)).reason == "image_too_dark"
+    assert assess_image(noise(400, 225, 256)).reason == "image_overexposed"
+
+
+def test_opencv_without_cascade_skips_face_checks(monkeypatch):
+    monkeypatch.setattr(quality, "QUALITY_FACE_DETECTOR", "haar")
+    monkeypatch.delattr(cv2, "CascadeClassifier", raising=False)
+    result = assess_image(noise(400, 60, 200))
+    assert result.ok
+    assert "faces" not in result.measures
+
+
+def test_rejection_becomes_an_error_response():
+    timings = {}
+    response = check_quality("login", np.full((400, 400, 3), 128, dtype=np.uint8), timings)
+    assert response["error_code"] == "image_blurry"
+    assert response["Status"] == "False"
+    assert "quality_ms" in timings
+
+
+def test_gate_fails_open(monkeypatch):
+    def broken(image):
+        raise cv2.error("assess failed")
+
+    monkeypatch.setattr(quality, "assess_image", broken)
+    assert check_quality("register", noise(400, 60, 200)) is None
@@ -0,0 +1,207 @@
+import os
+import time
+import numpy as np
+import pytest
+from face_auth import shared_store
+from face_auth.encodings import ENCODING_SIZE, encoding_fields
+from face_auth.shared_store import RECORD_DTYPE, SharedEncodingStore
+
+
+class FakeCursor(list):
+
+    def batch_size(self, size):
+        return self
+
+
+class FakeCollection:
+
+    def __init__(self, users):
+        self.users = users
+
+    def find(self, query, projection):
+        return FakeCursor(self.users)
+
+
+def vector(seed):
+    return np.random.default_rng(seed).normal(size=ENCODING_SIZE).astype(np.float32)
+
+
+def user(email, seed):
+    image_url = f"https://cdn.example.com/{email}.jpg"
+    return {"email": email, "image_url": image_url, **encoding_fields(vector(seed), image_url)}
+
+
+@pytest.fixture
+def store(tmp_path):
+    store = SharedEncodingStore(str(tmp_path))
+    store.build(FakeCollection([user("a@example.com", 1), user("b@example.com", 2)]))
+    return store
+
+
+def log_path(store):
+    return store._path(f"gen-{store._current_generation()}.log")
+
+
+def test_build_maps_encodings_for_the_current_image(store):
+    np.testing.assert_array_equal(store.get("a@example.com", "https://cdn.example.com/a@example.com.jpg"), vector(1))
+    assert store.get("a@example.com", "https://cdn.example.com/old.jpg") is None
+    assert store.get("c@example.com", "https://cdn.example.com/c@example.com.jpg") is None
+
+
+def test_log_records_reach_other_readers(store, tmp_path):
+    reader = SharedEncodingStore(str(tmp_path))
+    store.publish("c@example.com", vector(3), "https://cdn.example.com/c.jpg")
+    store.publish("a@example.com", vector(4), "https://cdn.example.com/a2.jpg")
+    store.remove("b@example.com")
+
+    np.testing.assert_array_equal(reader.get("c@example.com", "https://cdn.example.com/c.jpg"), vector(3))
+    np.testing.assert_array_equal(reader.get("a@example.com", "https://cdn.example.com/a2.jpg"), vector(4))
+    assert reader.get("b@example.com", "https://cdn.example.com/b@example.com.jpg") is None
+    assert [email for email, _ in reader.search(vector(3), k=2, threshold=10)][0] == "c@example.com"
+
+
+def test_partial_record_is_not_replayed_until_complete(store, tmp_path):
+    store.publish("c@example.com", vector(3), "https://cdn.example.com/c.jpg")
+    with open(log_path(store), "rb") as f:
+        record = f.read()
+    with open(log_path(store), "wb") as f:
+        f.write(record[:100])  # A writer is half-way through
+
+    reader = SharedEncodingStore(str(tmp_path))
+    assert reader.get("c@example.com", "https://cdn.example.com/c.jpg") is None
+    with open(log_path(store), "ab") as f:
+        f.write(record[100:])
+    np.testing.assert_array_equal(reader.get("c@example.com", "https://cdn.example.com/c.jpg"), vector(3))
+
+
+def test_record_failing_its_checksum_stops_replay(store, tmp_path):
+    store.publish("c@example.com", vector(3), "https://cdn.example.com/c.jpg")
+    with open(log_path(store), "r+b") as f:
+        f.seek(300)
+        f.write(b"\xff\xff")
+
+    reader = SharedEncodingStore(str(tmp_path))
+    assert reader.get("c@example.com", "https://cdn.example.com/c.jpg") is None
+    assert reader._log_offset == 0
+
+
+def test_append_drops_the_torn_record_of_a_dead_writer(store, tmp_path):
+    with open(log_path(store), "ab") as f:
+        f.write(b"\x00" * 50)
+    store.publish("c@example.com", vector(3), "https://cdn.example.com/c.jpg")
+
+    assert os.path.getsize(log_path(store)) == RECORD_DTYPE.itemsize
+    reader = SharedEncodingStore(str(tmp_path))
+    np.testing.assert_array_equal(reader.get("c@example.com", "https://cdn.example.com/c.jpg"), vector(3))
+
+
+def test_compaction_folds_the_log_into_a_new_generation(store, tmp_path):
+    store.publish("c@example.com", vector(3), "https://cdn.example.com/c.jpg")
+    store.publish("a@example.com", vector(4), "https://cdn.example.com/a2.jpg")
+    store.remove("b@example.com")
+    generation = store._current_generation()
+
+    assert store.compact() is True
+    assert store._current_generation() == generation + 1
+    assert os.path.getsize(log_path(store)) == 0
+
+    reader = SharedEncodingStore(str(tmp_path))
+    assert reader.stats()["rows"] == 2
+    np.testing.assert_array_equal(reader.get("c@example.com", "https://cdn.example.com/c.jpg"), vector(3))
+    np.testing.assert_array_equal(reader.get("a@example.com", "https://cdn.example.com/a2.jpg"), vector(4))
+    assert reader.get("b@example.com", "https://cdn.example.com/b@example.com.jpg") is None
+
+
+def test_compaction_waits_for_enough_records(store):
+    store.publish("c@example.com", vector(3), "https://cdn.example.com/c.jpg")
+    generation = store._current_generation()
+    assert store.compact(min_records=2) is False
+    assert store._current_generation() == generation
+
+
+def test_compaction_carries_over_records_appended_meanwhile(store, tmp_path, monkeypatch):
+    store.publish("c@example.com", vector(3), "https://cdn.example.com/c.jpg")
+    write_arrays = store._write_arrays
+
+    def write_arrays_then_append(*args):
+        write_arrays(*args)
+        # Published by a request while the new generation was being written
+        SharedEncodingStore(str(tmp_path)).publish("d@example.com", vector(5), "https://cdn.example.com/d.jpg")
+
+    monkeypatch.setattr(store, "_write_arrays", write_arrays_then_append)
+    assert store.compact() is True
+
+    reader = SharedEncodingStore(str(tmp_path))
+    assert reader.stats()["log_records"] == 1
+    np.testing.assert_array_equal(reader.get("d@example.com", "https://cdn.example.com/d.jpg"), vector(5))
+    np.testing.assert_array_equal(reader.get("c@example.com", "https://cdn.example.com/c.jpg"), vector(3))
+
+
+def test_reaching_the_threshold_compacts_in_the_background(store, monkeypatch):
+    monkeypatch.setattr(shared_store, "SHARED_STORE_COMPACT_RECORDS", 2)
+    generation = store._current_generation()
+    store.publish("c@example.com", vector(3), "https://cdn.example.com/c.jpg")
+    store.publish("d@example.com", vector(5), "https://cdn.example.com/d.jpg")
+    deadline = time.monotonic() + 5
+    while store._current_generation() == generation and time.monotonic() < deadline:
+        time.sleep(0.01)
+
+    assert store._current_generation() == generation + 1
+    np.testing.assert_array_equal(store.get("d@example.com", "https://cdn.example.com/d.jpg"), vector(5))
+
+
+def test_generation_from_other_settings_is_ignored_and_rebuilt(store, tmp_path, monkeypatch):
+    monkeypatch.setattr(shared_store, "encoding_signature", lambda: "v2:small:j1")
+    reader = SharedEncodingStore(str(tmp_path))
+    assert reader.get("a@example.com", "https://cdn.example.com/a@example.com.jpg") is None
+    assert reader.search(vector(1), threshold=10) == []
+
+    generation = store._current_generation()
+    reader.ensure_built(FakeCollection([]))
+    assert store._current_generation() == generation + 1
+    assert reader.stats()["signature"] == "v2:small:j1"
+
+
+def test_records_from_other_settings_are_skipped(store, tmp_path, monkeypatch):
+    with monkeypatch.context() as patch:
+        patch.setattr(shared_store, "encoding_signature", lambda: "v0:small:j1")
+        store.publish("c@example.com", vector(3), "https://cdn.example.com/c.jpg")
+    store.publish("d@example.com", vector(5), "https://cdn.example.com/d.jpg")
+
+    reader = SharedEncodingStore(str(tmp_path))
+    assert reader.get("c@example.com", "https://cdn.example.com/c.jpg") is None
+    np.testing.assert_array_equal(reader.get("d@example.com", "https://cdn.example.com/d.jpg"), vector(5))
+
+
+def test_ensure_built_keeps_a_current_generation(store):
+    generation = store._current_generation()
+    store.ensure_built(FakeCollection([]))
+    assert store._current_generation() == generation
+
+
+class FailingCollection:
+
+    def __init__(self):
+        self.calls = 0
+
+    def find(self, query, projection):
+        self.calls += 1
+        raise RuntimeError("mongo unavailable")
+
+
+def test_ensure_ready_builds_a_missing_generation(tmp_path):
+    store = SharedEncodingStore(str(tmp_path))
+    assert store.ready() is False
+    assert store.ensure_ready(FakeCollection([user("a@example.com", 1)])) is True
+    assert [email for email, _ in store.search(vector(1), k=1, threshold=10)] == ["a@example.com"]
+
+
+def test_failed_build_is_not_retried_on_every_call(tmp_path):
+    store = SharedEncodingStore(str(tmp_path))
+    failing = FailingCollection()
+    assert store.ensure_ready(failing) is False
+    assert store.ensure_ready(failing) is False
+    assert failing.calls == 1
+
+    store._build_retry_at = 0.0  # The retry interval has passed
+    assert store.ensure_ready(FakeCollection([user("a@example.com", 1)])) is True
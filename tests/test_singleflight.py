@@ -0,0 +1,144 @@
+import threading
+import time
+import pytest
+from face_auth.resilience import DeadlineExceeded
+from face_auth.singleflight import SingleFlight, request_fingerprint
+
+
+def run_concurrently(*targets):
+    results, threads = [None] * len(targets), []
+    for index, target in enumerate(targets):
+        def run(index=index, target=target):
+            try:
+                results[index] = target()
+            except Exception as e:
+                results[index] = e
+        threads.append(threading.Thread(target=run))
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join(5)
+    return results
+
+
+def test_identical_calls_share_one_execution():
+    flight = SingleFlight()
+    started, release = threading.Event(), threading.Event()
+    calls = []
+
+    def fn():
+        calls.append(1)
+        started.set()
+        release.wait(5)
+        return "result"
+
+    def leader():
+        return flight.do("a@example.com", "login", "same", fn, 5)
+
+    def follower():
+        started.wait(5)  # Join while the leader is still running
+        threading.Timer(0.1, release.set).start()
+        return flight.do("a@example.com", "login", "same", fn, 5)
+
+    assert run_concurrently(leader, follower) == ["result", "result"]
+    assert len(calls) == 1
+    assert flight.stats() == {"in_flight": 0, "executed": 1, "coalesced": 1}
+
+
+def test_error_reaches_every_waiting_caller():
+    flight = SingleFlight()
+    started, release = threading.Event(), threading.Event()
+
+    def fn():
+        started.set()
+        release.wait(5)
+        raise ValueError("encode failed")
+
+    def leader():
+        return flight.do("a@example.com", "login", "same", fn, 5)
+
+    def follower():
+        started.wait(5)
+        threading.Timer(0.1, release.set).start()
+        return flight.do("a@example.com", "login", "same", fn, 5)
+
+    results = run_concurrently(leader, follower)
+    assert all(isinstance(result, ValueError) for result in results)
+    assert flight.stats()["in_flight"] == 0
+
+
+def test_different_operations_for_a_user_run_one_at_a_time():
+    flight = SingleFlight()
+    running, overlaps = [], []
+    lock = threading.Lock()
+
+    def work(name):
+        def fn():
+            with lock:
+                if running:
+                    overlaps.append((running[0], name))
+                running.append(name)
+            time.sleep(0.1)
+            with lock:
+                running.remove(name)
+            return name
+        return fn
+
+    results = run_concurrently(
+        lambda: flight.do("a@example.com", "login", "x", work("login"), 5),
+        lambda: flight.do("a@example.com", "capture", "y", work("capture"), 5)
+    )
+    assert sorted(results) == ["capture", "login"]
+    assert overlaps == []
+    assert flight.stats()["executed"] == 2
+
+
+def test_different_users_run_in_parallel():
+    flight = SingleFlight()
+    barrier = threading.Barrier(2, timeout=2)
+
+    def fn():
+        barrier.wait()  # Only passes if both calls are running at once
+        return "done"
+
+    results = run_concurrently(
+        lambda: flight.do("a@example.com", "login", "x", fn, 5),
+        lambda: flight.do("b@example.com", "login", "x", fn, 5)
+    )
+    assert results == ["done", "done"]
+
+
+def test_waiting_for_the_user_times_out():
+    flight = SingleFlight()
+    started, release = threading.Event(), threading.Event()
+
+    def slow():
+        started.set()
+        release.wait(5)
+        return "slow"
+
+    def second():
+        started.wait(5)
+        try:
+            return flight.do("a@example.com", "capture", "y", lambda: "fast", 0.1)
+        finally:
+            release.set()
+
+    results = run_concurrently(lambda: flight.do("a@example.com", "login", "x", slow, 5), second)
+    assert results[0] == "slow"
+    assert isinstance(results[1], DeadlineExceeded)
+
+
+@pytest.mark.parametrize("timeout", [0, -5])
+def test_passed_deadline_raises_deadline_exceeded(timeout):
+    flight = SingleFlight()
+    with pytest.raises(DeadlineExceeded):
+        flight.do("a@example.com", "login", "x", lambda: "never", timeout)
+    assert flight.stats() == {"in_flight": 0, "executed": 0, "coalesced": 0}
+
+
+def test_fingerprint_covers_image_and_form_fields():
+    base = request_fingerprint(b"image", [("email", "a@example.com")])
+    assert base == request_fingerprint(b"image", [("email", "a@example.com")])
+    assert base != request_fingerprint(b"other", [("email", "a@example.com")])
+    assert base != request_fingerprint(b"image", [("email", "b@example.com")])